@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Approximate nearest neighbour index over the (region, year) series of many
+cubes, to find analog years anywhere in the archive.
+
+Example:
+    python analog_index.py build archive.index cubes/ --feature Temperature
+    python analog_index.py query archive.index --region Nanjing --year 2019
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from cube_store import CubeStore, find_cubes
+from distance_fn import _prepare, dist_mat
+
+def _paa(X, seg_len):
+    '''piecewise aggregate approximation: means of ``seg_len`` day segments of
+    every row of ``X`` (series x days), scaled by sqrt(seg_len) so Euclidean
+    distances between sketches never exceed those between the series
+    '''
+    n, L = X.shape
+    nseg = L // seg_len
+    S = X[:, :nseg*seg_len].reshape(n, nseg, seg_len).mean(axis=2)
+    return S*np.sqrt(seg_len)
+
+def _sq_dists(X, C):
+    '''squared Euclidean distances between the rows of ``X`` and of ``C``
+    '''
+    d = (X**2).sum(axis=1)[:, None] - 2*X @ C.T + (C**2).sum(axis=1)[None, :]
+    return np.maximum(d, 0)
+
+def _nearest(X, C, memory = 2**27):
+    '''index of the nearest row of ``C`` for every row of ``X``, a block of
+    rows at a time so the distances use about ``memory`` bytes
+    '''
+    block = max(1, memory//(8*4*max(len(C), 1)))
+    return np.concatenate([np.argmin(_sq_dists(np.asarray(X[i:i+block], dtype=float), C),
+                                     axis=1)
+                           for i in range(0, len(X), block)])
+
+def _kmeans(X, n_clusters, iters = 20, seed = 0):
+    '''Lloyd's k-means on the rows of ``X``, centroids start at random rows
+    '''
+    rng = np.random.default_rng(seed)
+    C = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+    for _ in range(iters):
+        assign = _nearest(X, C)
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(C)
+        np.add.at(sums, assign, X)
+        # empty clusters keep their centroid
+        full = counts > 0
+        C[full] = sums[full]/counts[full, None]
+    return C
+
+class AnalogIndex:
+    """index of many (region, year) series by short sketches, for finding
+    the series most similar to a query across every region.
+
+    Series are reduced to PAA sketches (means of ``seg_len`` day segments),
+    optionally projected further on their top ``dims`` principal components,
+    and split into lists by k-means on the sketches (an inverted file). A
+    query only scans the sketches of the ``nprobe`` lists with the nearest
+    centroids, then re-ranks the best ``candidates`` exactly with
+    ``dist_mat`` on the full series.
+
+    The index is a directory of .npy files, opened memory-mapped, so loading
+    it is instant and queries only touch the lists they probe.
+
+    Example:
+        index = AnalogIndex.build('archive.index', ['cubes/'], 'Temperature')
+        index = AnalogIndex('archive.index')
+        index.query_label('Nanjing', 2019, k=10)
+    """
+    def __init__(self, path):
+        """
+        Inputs:
+            ``path`` - directory of the index, see ``build``
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.meta = meta
+        self.regions = meta['regions']
+        self.days = meta['days']
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.sketches = np.load(os.path.join(path, 'sketches.npy'), mmap_mode='r')
+        self.series = np.load(os.path.join(path, 'series.npy'), mmap_mode='r')
+        self.region_codes = np.load(os.path.join(path, 'region_codes.npy'), mmap_mode='r')
+        self.years = np.load(os.path.join(path, 'years.npy'), mmap_mode='r')
+        if meta['sketch'] == 'pca':
+            pca = np.load(os.path.join(path, 'pca.npz'))
+            self._mean, self._components = pca['mean'], pca['components']
+
+    def __len__(self):
+        return len(self.years)
+
+    @staticmethod
+    def _sketch(X, meta, mean = None, components = None):
+        S = _paa(np.asarray(X, dtype=float), meta['seg_len'])
+        if meta['sketch'] == 'pca':
+            S = (S - mean) @ components.T
+        return S
+
+    @classmethod
+    def build(cls, path, sources, feature = None, sketch = 'paa', seg_len = 7,
+              dims = 16, n_lists = None, handle_na = 'interpolate',
+              dtype = np.float32, sample = 100000, seed = 0):
+        """indexes every (region, year) series of ``feature`` in some cubes
+
+        Inputs:
+            ``path`` - directory to write the index to
+            ``sources`` - ``CubeStore``s, cube directories or directories of
+                          cubes. Regions are labelled by name, or by
+                          ``cube/region`` if names repeat across cubes
+            ``feature`` - (default the first of each cube) feature to index
+            ``sketch`` - ``paa`` or ``pca`` (PAA sketches reduced to ``dims``
+                         principal components)
+            ``seg_len`` - (default 7) days per PAA segment
+            ``dims`` - (default 16) principal components kept by ``pca``
+            ``n_lists`` - (default about sqrt of the number of series) lists
+                          of the inverted file
+            ``handle_na`` - (default interpolate) see ``dist``, applied to
+                            every series before sketching
+            ``dtype`` - (default float32) type of the stored series
+            ``sample`` - (default 100000) series used to fit PCA and k-means
+            ``seed`` - (default 0) random seed
+
+        NOTE - the series are read one region at a time and go through a
+        scratch file into ``series.npy``, so only the sketches (a few dozen
+        values per series) are held in memory.
+        """
+        stores = []
+        for source in sources:
+            if isinstance(source, CubeStore):
+                stores.append(source)
+            else:
+                stores += [CubeStore(p) for p in find_cubes([source]).values()]
+        if not stores:
+            raise ValueError('no cubes to index')
+        days = stores[0].days
+        if any(s.days != days for s in stores):
+            raise ValueError('every cube must cover the same days')
+        names = [r for s in stores for r in s.regions]
+        unique = len(set(names)) == len(names)
+        if sketch not in ('paa', 'pca'):
+            raise ValueError('``sketch`` must be paa or pca')
+
+        # one region at a time, the series are sketched and appended to a
+        # scratch file, so they never all sit in memory together
+        os.makedirs(path, exist_ok=True)
+        scratch = os.path.join(path, 'series.tmp')
+        regions, codes, years, paa = [], [], [], []
+        with open(scratch, 'wb') as tmp:
+            for s in stores:
+                f = feature if feature is not None else s.features[0]
+                cube_name = os.path.splitext(os.path.basename(os.path.normpath(s.path)))[0]
+                for region in s.regions:
+                    A = _prepare(np.asarray(s.read(f, region)), handle_na)
+                    keep = ~np.all(np.isnan(A), axis=0)
+                    X = A[:, keep].T
+                    tmp.write(np.ascontiguousarray(X, dtype=dtype).tobytes())
+                    # NaN days left by 'drop' or 'fill' count as 0 in the sketches
+                    paa.append(np.nan_to_num(_paa(X, seg_len)).astype(np.float32))
+                    codes.append(np.full(keep.sum(), len(regions)))
+                    years.append(np.asarray(s.years)[keep])
+                    regions.append(region if unique else cube_name + '/' + str(region))
+        codes = np.concatenate(codes)
+        years = np.concatenate(years)
+        S = np.concatenate(paa)
+        del paa
+        n = len(years)
+        if not n:
+            os.remove(scratch)
+            raise ValueError('no series to index')
+
+        meta = {'regions': regions, 'days': list(days), 'sketch': sketch,
+                'seg_len': int(seg_len), 'handle_na': handle_na, 'n': int(n)}
+        rng = np.random.default_rng(seed)
+        fit = np.sort(rng.choice(n, min(n, sample), replace=False))
+        mean = components = None
+        if sketch == 'pca':
+            P = S[fit].astype(float)
+            mean = P.mean(axis=0)
+            _, _, Vt = np.linalg.svd(P - mean, full_matrices=False)
+            components = Vt[:dims]
+            S = np.concatenate([((S[i:i+65536] - mean) @ components.T).astype(np.float32)
+                                for i in range(0, n, 65536)])
+
+        if n_lists is None:
+            n_lists = int(np.sqrt(n))
+        n_lists = max(1, min(n_lists, len(fit)))
+        C = _kmeans(S[fit].astype(float), n_lists, seed=seed)
+        assign = _nearest(S, C)
+        # store every list contiguously
+        order = np.argsort(assign, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+
+        np.save(os.path.join(path, 'centroids.npy'), C)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'sketches.npy'), S[order])
+        np.save(os.path.join(path, 'region_codes.npy'), codes[order])
+        np.save(os.path.join(path, 'years.npy'), years[order])
+
+        # copy the series into list order a chunk at a time
+        del S, assign
+        unordered = np.memmap(scratch, dtype=dtype, mode='r', shape=(n, len(days)))
+        series = np.lib.format.open_memmap(os.path.join(path, 'series.npy'),
+                                           mode='w+', dtype=dtype,
+                                           shape=(n, len(days)))
+        chunk = max(1, 2**26//(len(days)*np.dtype(dtype).itemsize))
+        for i in range(0, n, chunk):
+            rows = order[i:i+chunk]
+            # reading in file order is quicker, then put the rows back in order
+            by_pos = np.argsort(rows)
+            block = np.empty((len(rows), len(days)), dtype=dtype)
+            block[by_pos] = unordered[rows[by_pos]]
+            series[i:i+len(rows)] = block
+        series.flush()
+        del series, unordered
+        os.remove(scratch)
+        if sketch == 'pca':
+            np.savez(os.path.join(path, 'pca.npz'), mean=mean, components=components)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return cls(path)
+
+    def label(self, i):
+        """(region, year) of the ``i``-th indexed series
+        """
+        return self.regions[self.region_codes[i]], int(self.years[i])
+
+    def position(self, region, year):
+        """row of the series of ``region`` in ``year``
+        """
+        if region not in self.regions:
+            raise ValueError(str(region) + ' is not in the index')
+        # a scan of the two label arrays, quicker than building a lookup table
+        rows = np.flatnonzero((self.region_codes == self.regions.index(region)) &
+                              (self.years == int(year)))
+        if not len(rows):
+            raise ValueError(str((region, year)) + ' is not in the index')
+        return int(rows[0])
+
+    def query(self, a, k = 10, nprobe = 8, candidates = None, exclude = (),
+              metric = 'Euclidean', shift = False, max_shift = 7, band = 7):
+        """the ``k`` indexed series most similar to ``a``
+
+        Inputs:
+            ``a`` - the query, one value per day of the index
+            ``k`` - (default 10) number of analogs
+            ``nprobe`` - (default 8) lists scanned, more is slower but finds
+                         more of the true nearest neighbours
+            ``candidates`` - (default 50*k) series re-ranked exactly
+            ``exclude`` - (default none) rows of the index to leave out
+            ``metric``, ``shift``, ``max_shift``, ``band`` - see ``dist``,
+                         used for the exact re-ranking
+        Outputs:
+            list of (score, region, year), most similar first
+        """
+        handle_na = self.meta['handle_na']
+        a = _prepare(np.asarray(a, dtype=float), handle_na)[:, 0]
+        if len(a) != len(self.days):
+            raise ValueError('query must have one value per day of the index')
+        pca = (self._mean, self._components) if self.meta['sketch'] == 'pca' else ()
+        q = np.nan_to_num(self._sketch(a[None, :], self.meta, *pca))
+
+        lists = np.argsort(_sq_dists(q, self.centroids)[0])[:nprobe]
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l+1])
+                               for l in lists])
+        if len(exclude):
+            rows = rows[~np.isin(rows, list(exclude))]
+        if candidates is None:
+            candidates = 50*k
+        d = _sq_dists(q, np.asarray(self.sketches[rows], dtype=float))[0]
+        if len(rows) > candidates:
+            best = np.argpartition(d, candidates)[:candidates]
+            rows = rows[best]
+        rows = np.sort(rows)
+
+        # exact distances, the same as ``dist``
+        D = dist_mat(a, np.asarray(self.series[rows], dtype=float).T,
+                     metric=metric, handle_na=handle_na, shift=shift,
+                     max_shift=max_shift, band=band)[0]
+        top = np.argsort(D, kind='stable')[:k]
+        return [(float(D[j]),) + self.label(rows[j]) for j in top]
+
+    def query_label(self, region, year, **kwargs):
+        """analogs of the indexed series of ``region`` in ``year``, leaving
+        that series itself out. Takes the arguments of ``query``.
+        """
+        i = self.position(region, year)
+        return self.query(self.series[i], exclude=[i], **kwargs)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Cross-region analog index')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='index cubes')
+    build.add_argument('index', help='directory to write the index to')
+    build.add_argument('sources', nargs='+',
+                       help='cube directories or directories holding cubes')
+    build.add_argument('--feature', help='feature to index')
+    build.add_argument('--sketch', default='paa', help='``paa`` or ``pca``')
+    build.add_argument('--seg_len', type=int, default=7,
+                       help='days per PAA segment')
+    build.add_argument('--dims', type=int, default=16,
+                       help='principal components kept by ``pca``')
+    query = sub.add_parser('query', help='find analogs of an indexed series')
+    query.add_argument('index', help='directory of the index')
+    query.add_argument('--region', required=True, help='region of the query')
+    query.add_argument('--year', type=int, required=True, help='year of the query')
+    query.add_argument('--k', type=int, default=10, help='number of analogs')
+    query.add_argument('--nprobe', type=int, default=8, help='lists scanned')
+    query.add_argument('--similarity', default='Euclidean',
+                       help='similarity measurement for the re-ranking')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = AnalogIndex.build(args.index, args.sources, args.feature,
+                                  sketch=args.sketch, seg_len=args.seg_len,
+                                  dims=args.dims)
+        print('indexed ' + str(len(index)) + ' series')
+    else:
+        index = AnalogIndex(args.index)
+        for score, region, year in index.query_label(args.region, args.year,
+                                                     k=args.k, nprobe=args.nprobe,
+                                                     metric=args.similarity):
+            print(str(region) + ' ' + str(year) + ':   ' + str(score))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Local HTTP/JSON service answering analog year queries from preprocessed
+cubes (see ``CubeStore``) that stay open between requests.
+
+Example:
+    python analog_service.py nanjing.cube cubes/ --port 8765 --workers 4
+
+    GET  /cubes
+    GET  /query?cube=nanjing&region=Nanjing&feature=Temperature&year=2018&k=5
+    POST /query    {"cube": "nanjing", "year": 2018, "smooth": [7, 0]}
+    POST /reload
+"""
+
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cube_store import CubeStore, find_cubes
+from year_score_comp import get_sorted_years
+
+# query parameters and how to read them from a url
+_PARAM_TYPES = {'cube': str, 'region': str, 'feature': str, 'similarity': str,
+                'handle_na': str, 'year': int, 'k': int, 'max_shift': int,
+                'band': int, 'start_day': int, 'end_day': int,
+                'shift': lambda s: s.lower() in ('1', 'true', 'yes'),
+                'dropnasim': lambda s: s.lower() in ('1', 'true', 'yes'),
+                'smooth': lambda s: [int(x) for x in s.split(',')],
+                'years': lambda s: [int(x) for x in s.split(',')]}
+
+class AnalogService:
+    """keeps the cubes in ``paths`` open (memory-mapped, read only) and
+    answers ``get_sorted_years`` queries on them.
+
+    Since the cubes are read-only memory maps, worker processes serving the
+    same cubes share one copy of the data through the OS page cache.
+    """
+    def __init__(self, paths, generation = None):
+        """
+        Inputs:
+            ``paths`` - cube directories or directories holding cubes
+            ``generation`` - (default None) shared ``multiprocessing.Value``
+                             counting reloads, so every worker process picks
+                             up a reload asked of any of them
+        """
+        self.paths = list(paths)
+        self.generation = generation
+        self._lock = threading.Lock()
+        self._seen = None
+        self.stores = {}
+        self._load()
+
+    def _load(self):
+        stores = {name: CubeStore(path, mode = 'r')
+                  for name, path in find_cubes(self.paths).items()}
+        # swap in one go, so running queries keep the stores they started with
+        self.stores = stores
+        if self.generation is not None:
+            self._seen = self.generation.value
+
+    def reload(self):
+        """re-opens every cube and picks up new ones, in this process and,
+        through ``generation``, in the other workers
+        """
+        with self._lock:
+            self._load()
+            if self.generation is not None:
+                with self.generation.get_lock():
+                    self.generation.value += 1
+                self._seen = self.generation.value
+        return self.cubes()
+
+    def _check_reload(self):
+        if self.generation is not None and self.generation.value != self._seen:
+            with self._lock:
+                if self.generation.value != self._seen:
+                    self._load()
+
+    def cubes(self):
+        """features, regions and years of every cube
+        """
+        self._check_reload()
+        return {name: {'features': s.features, 'regions': s.regions,
+                       'years': s.years, 'days': [s.days[0], s.days[-1]]
+                                                 if s.days else []}
+                for name, s in self.stores.items()}
+
+    def query(self, params):
+        """years most similar to ``params['year']``
+
+        Inputs:
+            ``params`` - dict with ``cube``, ``year`` and optionally
+                         ``region``, ``feature`` (default the first of the
+                         cube) and any argument of ``get_sorted_years``
+        Outputs:
+            dict with the query and a list of {year, score}, most similar first
+        """
+        self._check_reload()
+        t0 = time.perf_counter()
+        params = dict(params)
+        stores = self.stores
+        if 'year' not in params:
+            raise ValueError('``year`` is required')
+        name = params.pop('cube', None)
+        if name is None and len(stores) == 1:
+            name = next(iter(stores))
+        if name not in stores:
+            raise ValueError('unknown cube ' + str(name))
+        store = stores[name]
+        region = params.pop('region', store.regions[0])
+        feature = params.pop('feature', store.features[0])
+        if region not in store.regions or feature not in store.features:
+            raise ValueError('unknown region or feature ' + str((region, feature)))
+        year = int(params.pop('year'))
+        if year not in store.years:
+            raise ValueError('year ' + str(year) + ' not in cube ' + name)
+        if params.get('smooth'):
+            params['smooth'] = tuple(params['smooth'])
+        unknown = set(params) - set(_PARAM_TYPES)
+        if unknown:
+            raise ValueError('unknown parameters ' + str(sorted(unknown)))
+
+        df = store.to_frame(region, feature)
+        years = params.pop('years', None) or list(store.years)
+        years = [y for y in years if y != year]
+        # no candidates would mean all years to ``get_sorted_years``
+        dists = get_sorted_years(year, df, years = years,
+                                 **params) if years else []
+        return {'cube': name, 'region': region, 'feature': feature,
+                'year': year,
+                # JSON has no infinity, years that can't be compared get null
+                'results': [{'year': int(y),
+                             'score': float(d) if np.isfinite(d) else None}
+                            for d, y in dists],
+                'ms': 1000*(time.perf_counter() - t0)}
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, params):
+        path = urlparse(self.path).path.rstrip('/')
+        try:
+            if path == '/cubes':
+                self._send(200, self.service.cubes())
+            elif path == '/query':
+                self._send(200, self.service.query(params))
+            elif path == '/reload' and self.command == 'POST':
+                self._send(200, self.service.reload())
+            else:
+                self._send(404, {'error': 'no such endpoint ' + path})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': type(e).__name__ + ': ' + str(e)})
+
+    def do_GET(self):
+        try:
+            params = {k: _PARAM_TYPES.get(k, str)(v[-1])
+                      for k, v in parse_qs(urlparse(self.path).query).items()}
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        self._route(params)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            return self._send(400, {'error': 'bad json: ' + str(e)})
+        self._route(params)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def make_server(paths, host = '127.0.0.1', port = 8765, generation = None,
+                verbose = False):
+    '''threaded HTTP server for an ``AnalogService`` on ``paths``
+    '''
+    handler = type('Handler', (_Handler,),
+                   {'service': AnalogService(paths, generation)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.verbose = verbose
+    return server
+
+def serve(paths, host = '127.0.0.1', port = 8765, workers = 1, verbose = False):
+    '''serves queries on ``paths`` until interrupted
+
+    Inputs::
+        paths (list of str) -- cube directories or directories holding cubes
+        host (str) -- (default 127.0.0.1) address to listen on
+        port (int) -- (default 8765) port to listen on
+        workers (int) -- (default 1) processes accepting requests on the same
+                         socket. More than one needs ``fork`` (not Windows)
+        verbose (boolean) -- (default False) if True, log every request
+    '''
+    if workers > 1:
+        ctx = multiprocessing.get_context('fork')
+        generation = ctx.Value('l', 0)
+    else:
+        generation = None
+    server = make_server(paths, host, port, generation, verbose)
+    procs = []
+    if workers > 1:
+        # the children inherit the listening socket and the open cubes
+        procs = [ctx.Process(target=server.serve_forever, daemon=True)
+                 for _ in range(workers - 1)]
+        for p in procs:
+            p.start()
+    print('serving ' + str(sorted(server.RequestHandlerClass.service.stores)) +
+          ' on http://' + host + ':' + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
+        server.server_close()
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Serve analog year queries')
+    parser.add_argument('paths', nargs='+',
+                        help='cube directories or directories holding cubes')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='port to listen on')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    args = parser.parse_args()
+    serve(args.paths, args.host, args.port, args.workers, args.verbose)
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+"""
+
+import os
+import json
+import itertools
+import importlib.util
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from multiprocessing import shared_memory
+from preprocessing_fns import get_gro_data_many, preprocess
+from year_score_comp import get_mat
+import result_cache
+
+# order of the fields in a (item, region, source, metric) spec
+SPEC_KEYS = ['item', 'region', 'source', 'metric']
+
+def _spec_dict(spec):
+    '''turns a (item, region, source, metric) tuple into ``get_gro_data``
+    keyword arguments. Dicts are passed through, so they can also set e.g.
+    ``frequency``.
+    '''
+    if isinstance(spec, dict):
+        return dict(spec)
+    return {key: val for key, val in zip(SPEC_KEYS, spec)}
+
+def _init_worker():
+    # every worker gets distinct jobs, so memoizing them only costs memory
+    result_cache.default_cache.max_bytes = 0
+
+def _preprocess_worker(args):
+    raw, preprocess_args = args
+    return preprocess(raw, **preprocess_args)
+
+def _mat_worker(args):
+    '''computes the similarity matrix of one series of the shared year cube
+    '''
+    shm_name, shape, dtype, k, cols, years, days, mat_args = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        cube = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # fancy indexing copies, so nothing points into the block once we close it
+        A = cube[k][:, cols]
+        del cube
+    finally:
+        shm.close()
+    df = pd.DataFrame(A, columns=years)
+    df.insert(0, 'day', days)
+    return get_mat(df, **mat_args)
+
+def run_batch(specs, gro_token = None, host = 'api.gro-intelligence.com',
+              data = None, processes = None,
+              preprocess_args = None, mat_args = None):
+    '''computes similarity matrices for many data series, spreading the work
+    over a process pool
+
+    Inputs::
+        specs (list) -- (item, region, source, metric) tuples, or dicts of
+                        ``get_gro_data`` arguments
+        gro_token (string) -- token for GRO account
+        host (string) -- GRO API host
+        data (list of DataFrames) -- (default None) raw GRO data for each spec,
+                                     if given nothing is fetched
+        processes (int) -- (default None) number of worker processes, by
+                           default the number of CPUs
+        preprocess_args (dict) -- (default None) keyword arguments for ``preprocess``
+        mat_args (dict) -- (default None) keyword arguments for ``get_mat``
+
+    Outputs::
+        DataFrame of similarity scores, indexed by item, region, source,
+        metric and year, with one column per year
+
+    NOTE: the preprocessed series are stacked into one series x day x year
+    cube in shared memory, so workers read their slice of it directly instead
+    of having it pickled to them.
+    '''
+    specs = [_spec_dict(spec) for spec in specs]
+    if preprocess_args is None:
+        preprocess_args = {'handle_na': 'interpolate'}
+    if mat_args is None:
+        mat_args = {}
+
+    if data is None:
+        data = get_gro_data_many(specs, gro_token, host=host)
+
+    with Pool(processes, initializer=_init_worker) as pool:
+        processed = pool.map(_preprocess_worker,
+                             [(raw, preprocess_args) for raw in data])
+
+    # every series gets the same days, but not necessarily the same years
+    days = processed[0]['day'].values
+    all_years = sorted(set().union(*[list(p.columns[1:]) for p in processed]))
+    col_of = {year: i for i, year in enumerate(all_years)}
+    shape = (len(processed), len(days), len(all_years))
+    dtype = np.float64
+
+    # the block is created before the second pool starts, so the workers share
+    # our resource tracker and don't report it as leaked when they exit
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=max(int(np.prod(shape))*8, 1))
+    try:
+        cube = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        cube[:] = np.nan
+        jobs = []
+        for k, p in enumerate(processed):
+            years = list(p.columns[1:])
+            cols = [col_of[year] for year in years]
+            cube[k][:, cols] = p[years].values
+            jobs.append((shm.name, shape, dtype, k, cols, years, days, mat_args))
+        del cube
+
+        with Pool(processes, initializer=_init_worker) as pool:
+            results = pool.map(_mat_worker, jobs)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    frames = []
+    for spec, (mat, years) in zip(specs, results):
+        label = tuple(spec.get(key) for key in SPEC_KEYS)
+        index = pd.MultiIndex.from_tuples([label + (year,) for year in years],
+                                          names=SPEC_KEYS + ['year'])
+        frames.append(pd.DataFrame(mat, index=index, columns=years))
+    return pd.concat(frames)
+
+# manifest fields that can list several values, each expanding the job,
+# with the ``get_gro_data`` or ``get_mat`` argument they set
+_SERIES_FIELDS = {'items': 'item', 'regions': 'region', 'sources': 'source',
+                  'metrics': 'metric', 'frequencies': 'frequency'}
+_MAT_FIELDS = {'similarities': 'similarity', 'windows': 'window'}
+_PREPROCESS_KEYS = ['handle_na', 'leapyear', 'standardization']
+_MAT_KEYS = ['smooth', 'dropnasim', 'handle_na', 'shift', 'max_shift', 'band',
+             'min_overlap']
+
+def load_manifest(path):
+    '''reads a JSON or YAML (needs PyYAML) manifest of batch jobs
+
+    A manifest has a list of ``jobs`` and optional ``defaults`` shared by
+    them. Every job sets ``get_gro_data``, ``preprocess`` and ``get_mat``
+    arguments, where ``items``, ``regions``, ``sources``, ``metrics``,
+    ``frequencies``, ``similarities`` and ``windows`` (start_day, end_day
+    pairs) may list several values, and the job is run for every combination.
+    ``years`` restricts the years compared, and ``rank`` lists years to rank
+    the ``k`` most similar years for.
+
+    Example:
+        defaults:
+            source: GHCN Daily
+            metric: Temperature
+            smooth: [7, 0]
+        jobs:
+            - items: [Temperature max, Temperature min]
+              regions: [Nanjing, Shanghai]
+              similarities: [Euclidean, L1]
+              windows: [[1, 365], [91, 273]]
+              rank: [2018]
+              k: 5
+    '''
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+    if not isinstance(manifest, dict) or 'jobs' not in manifest:
+        raise ValueError('manifest needs a list of ``jobs``')
+    return manifest
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+def has_parquet():
+    '''whether pandas can write Parquet, i.e. pyarrow or fastparquet is
+    installed
+    '''
+    return any(importlib.util.find_spec(engine) is not None
+               for engine in ('pyarrow', 'fastparquet'))
+
+def expand_jobs(manifest):
+    '''one dict per combination of the listed values of every manifest job,
+    with the manifest defaults filled in
+    '''
+    defaults = manifest.get('defaults', {})
+    runs = []
+    for i, job in enumerate(manifest['jobs']):
+        job = dict(defaults, **job)
+        lists = {}
+        for fields in (_SERIES_FIELDS, _MAT_FIELDS):
+            for plural, single in fields.items():
+                if plural in job:
+                    lists[single] = _as_list(job.pop(plural))
+                elif single in job:
+                    lists[single] = [job.pop(single)]
+        # ``rank: 2018`` and ``years: 2018`` mean a list of one year
+        for key in ('rank', 'years'):
+            if job.get(key) is not None:
+                job[key] = _as_list(job[key])
+        if 'window' not in lists:
+            lists['window'] = [(job.pop('start_day', 1), job.pop('end_day', 365))]
+        keys = list(lists)
+        for values in itertools.product(*[lists[key] for key in keys]):
+            run = dict(job, **dict(zip(keys, values)))
+            run['job'] = i
+            runs.append(run)
+    return runs
+
+def _key(d, keys):
+    return json.dumps({key: d.get(key) for key in keys}, sort_keys=True,
+                      default=str)
+
+def _job_mat_worker(args):
+    df, mat_args = args
+    return get_mat(df, **mat_args)
+
+def run_manifest(manifest, out = None, gro_token = None,
+                 host = 'api.gro-intelligence.com', processes = None,
+                 fmt = 'parquet', **fetch_args):
+    '''runs every job of a manifest (see ``load_manifest``). Series shared by
+    several jobs are fetched and preprocessed once, identical computations
+    are only done once, and the rest is spread over a process pool.
+
+    Inputs::
+        manifest (dict or str) -- manifest, or the path of one
+        out (str) -- (default None) directory to write ``matrices`` and
+                     ``rankings`` to, partitioned by item and region
+        gro_token (string) -- token for GRO account
+        host (string) -- GRO API host
+        processes (int) -- (default None) number of worker processes, by
+                           default the number of CPUs
+        fmt (str) -- (default parquet) ``parquet`` (needs pyarrow) or ``csv``
+        fetch_args -- passed to ``get_gro_data_many``, e.g. ``cache``,
+                      ``offline`` or ``client``
+
+    Outputs::
+        DataFrames of the similarity scores (one row per pair of years) and
+        of the rankings (one row per ranked year and analog year)
+    '''
+    if fmt not in ('parquet', 'csv'):
+        raise ValueError('``fmt`` must be parquet or csv')
+    # fail before fetching anything rather than after all the work is done
+    if out and fmt == 'parquet' and not has_parquet():
+        raise ValueError('writing parquet needs pyarrow (or fastparquet), '
+                         'install it or use csv')
+    if isinstance(manifest, str):
+        manifest = load_manifest(manifest)
+    runs = expand_jobs(manifest)
+    series_keys = list(_SERIES_FIELDS.values())
+
+    # fetch every distinct series once
+    fetch_key = [_key(run, series_keys) for run in runs]
+    unique_fetch = list(dict.fromkeys(fetch_key))
+    specs = [{k: v for k, v in json.loads(key).items() if v is not None}
+             for key in unique_fetch]
+    raw = dict(zip(unique_fetch, get_gro_data_many(specs, gro_token, host=host,
+                                                   **fetch_args)))
+
+    # then preprocess every distinct (series, preprocess arguments) once
+    prep_key = [f + _key(run, _PREPROCESS_KEYS) for f, run in zip(fetch_key, runs)]
+    unique_prep = {}
+    for f, p, run in zip(fetch_key, prep_key, runs):
+        if p not in unique_prep:
+            args = {key: run[key] for key in _PREPROCESS_KEYS if key in run}
+            args.setdefault('handle_na', 'interpolate')
+            unique_prep[p] = (raw[f].copy(), args)
+
+    with Pool(processes, initializer=_init_worker) as pool:
+        processed = dict(zip(unique_prep,
+                             pool.map(_preprocess_worker, unique_prep.values())))
+
+        # and compute every distinct matrix once
+        mat_jobs = {}
+        mat_key = []
+        for p, run in zip(prep_key, runs):
+            df = processed[p]
+            if run.get('years'):
+                df = df[['day'] + [y for y in run['years'] if y in df.columns]]
+            mat_args = {key: run[key] for key in _MAT_KEYS if key in run}
+            if mat_args.get('smooth'):
+                mat_args['smooth'] = tuple(mat_args['smooth'])
+            mat_args['similarity'] = run.get('similarity', 'Euclidean')
+            mat_args['start_day'], mat_args['end_day'] = run['window']
+            key = p + _key(mat_args, sorted(mat_args)) + str(list(df.columns))
+            mat_key.append(key)
+            if key not in mat_jobs:
+                mat_jobs[key] = (df, mat_args)
+        mats = dict(zip(mat_jobs, pool.map(_job_mat_worker, mat_jobs.values())))
+
+    label_keys = ['job'] + series_keys + ['similarity', 'start_day', 'end_day']
+    mat_frames, rank_frames = [], []
+    for run, key in zip(runs, mat_key):
+        mat, years = mats[key]
+        label = dict(run, similarity=run.get('similarity', 'Euclidean'),
+                     start_day=run['window'][0], end_day=run['window'][1])
+        label = {k: label.get(k) for k in label_keys}
+        n = len(years)
+        frame = pd.DataFrame({'year': np.repeat(years, n),
+                              'analog_year': np.tile(years, n),
+                              'score': np.asarray(mat).ravel()})
+        mat_frames.append(frame.assign(**label))
+
+        for year in run.get('rank', []):
+            if year not in years:
+                raise ValueError('year ' + str(year) + ' not in the data of job '
+                                 + str(run['job']))
+            row = np.asarray(mat)[years.index(year)]
+            order = [j for j in np.argsort(row, kind='stable') if years[j] != year]
+            order = order[:run.get('k', len(order))]
+            rank_frames.append(pd.DataFrame({
+                'year': year, 'rank': np.arange(1, len(order) + 1),
+                'analog_year': [years[j] for j in order],
+                'score': row[order]}).assign(**label))
+
+    columns = label_keys + ['year', 'analog_year', 'score']
+    matrices = pd.concat(mat_frames, ignore_index=True)[columns]
+    rankings = (pd.concat(rank_frames, ignore_index=True)
+                [label_keys + ['year', 'rank', 'analog_year', 'score']]
+                if rank_frames else pd.DataFrame(columns=label_keys +
+                                                 ['year', 'rank', 'analog_year', 'score']))
+    if out:
+        write_partitioned(matrices, os.path.join(out, 'matrices'), fmt=fmt)
+        write_partitioned(rankings, os.path.join(out, 'rankings'), fmt=fmt)
+    return matrices, rankings
+
+def write_partitioned(df, path, partition_cols = ('item', 'region'),
+                      fmt = 'parquet'):
+    '''writes ``df`` as a dataset partitioned hive-style by ``partition_cols``
+    (``path/item=.../region=.../``), in Parquet (needs pyarrow) or CSV
+    '''
+    partition_cols = [c for c in partition_cols if df[c].notna().all()]
+    if fmt == 'parquet':
+        df.to_parquet(path, partition_cols=partition_cols or None, index=False)
+    elif fmt == 'csv':
+        groups = df.groupby(partition_cols) if partition_cols else [((), df)]
+        for values, part in groups:
+            values = values if isinstance(values, tuple) else (values,)
+            part_dir = os.path.join(path, *['%s=%s' % (c, v) for c, v in
+                                            zip(partition_cols, values)])
+            os.makedirs(part_dir, exist_ok=True)
+            part.drop(columns=partition_cols).to_csv(
+                os.path.join(part_dir, 'part-0.csv'), index=False)
+    else:
+        raise ValueError('``fmt`` must be parquet or csv')
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Benchmarks of the analog pipeline on synthetic data, no GRO token needed.
+
+Example:
+    python benchmark.py --years 10 20 40 --out bench.json
+    python benchmark.py --years 10 20 40 --compare bench.json
+"""
+
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+from preprocessing_fns import preprocess
+from win_iter import smooth_windows
+from distance_fn import dist
+import year_score_comp
+
+def synthetic_points(n_years = 20, start_year = 2000, n_regions = 1,
+                     missing = 0.1, frequency = 1, seed = 0):
+    '''GRO-shaped synthetic data points: a seasonal cycle with a random
+    phase and amplitude per year, noise, and randomly missing days.
+
+    Inputs::
+        n_years (int) -- (default 20) number of years of data
+        start_year (int) -- (default 2000) first year
+        n_regions (int) -- (default 1) number of regions
+        missing (float) -- (default 0.1) fraction of points left out
+        frequency (int) -- (default 1) days between points
+        seed (int) -- (default 0) random seed
+
+    Outputs::
+        DataFrame with columns end_date, value (and region_id if
+        ``n_regions`` > 1), like ``get_gro_data`` returns
+    '''
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(str(start_year) + '-01-01',
+                          str(start_year + n_years - 1) + '-12-31',
+                          freq = str(frequency) + 'D')
+    frames = []
+    for region in range(n_regions):
+        year = dates.year - start_year
+        phase = rng.normal(0, 10, n_years)[year]
+        amp = rng.normal(10, 1, n_years)[year]
+        value = (amp*np.sin(2*np.pi*(dates.dayofyear + phase)/365) +
+                 rng.normal(0, 2, len(dates)))
+        keep = rng.random(len(dates)) >= missing
+        df = pd.DataFrame({'end_date': dates[keep].strftime('%Y-%m-%dT00:00:00.000Z'),
+                           'value': value[keep]})
+        if n_regions > 1:
+            df['region_id'] = region
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+def time_it(fn, repeat = 3):
+    '''best and median wall time of ``fn()`` over ``repeat`` runs
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times), float(np.median(times))
+
+def run(years_list = (10, 20, 40), missing = 0.1, repeat = 3,
+        similarity = 'Euclidean', n_regions = 1):
+    '''times every stage of the pipeline for each number of years. The
+    ``end_to_end`` stage goes through all ``n_regions`` regions.
+
+    Outputs::
+        list of dicts with stage, n_years, n_regions, missing, best and
+        median seconds
+    '''
+    # time the computations, not the result cache
+    get_mat = year_score_comp.get_mat.__wrapped__
+    get_sorted_years = year_score_comp.get_sorted_years.__wrapped__
+
+    results = []
+    for n_years in years_list:
+        all_raw = synthetic_points(n_years = n_years, missing = missing,
+                                   n_regions = n_regions)
+        if n_regions > 1:
+            regions = [df.drop(columns = 'region_id')
+                       for _, df in all_raw.groupby('region_id')]
+        else:
+            regions = [all_raw]
+        raw = regions[0]
+        processed = preprocess(raw.copy(), handle_na = 'interpolate',
+                               leapyear = 366)
+        years = list(processed.columns[1:])
+        query = years[-1]
+        stages = {
+            'preprocess': lambda: preprocess(raw.copy(), handle_na = 'interpolate',
+                                             leapyear = 366),
+            'smooth_windows': lambda: smooth_windows(processed),
+            'dist': lambda: dist(processed[years[0]], processed[years[1]],
+                                 metric = similarity),
+            'dist_shift': lambda: dist(processed[years[0]], processed[years[1]],
+                                       metric = similarity, shift = True),
+            'get_mat': lambda: get_mat(processed, similarity = similarity),
+            'get_mat_smooth': lambda: get_mat(processed, similarity = similarity,
+                                              smooth = (7,0)),
+            'get_mat_shift': lambda: get_mat(processed, similarity = similarity,
+                                             shift = True),
+            'get_sorted_years': lambda: get_sorted_years(query, processed,
+                                                         similarity = similarity),
+            'end_to_end': lambda: [get_sorted_years(
+                query, preprocess(df.copy(), handle_na = 'interpolate',
+                                  leapyear = 366),
+                similarity = similarity, smooth = (7,0)) for df in regions],
+        }
+        for stage, fn in stages.items():
+            best, median = time_it(fn, repeat)
+            results.append({'stage': stage, 'n_years': n_years,
+                            'n_regions': n_regions, 'missing': missing,
+                            'similarity': similarity,
+                            'best': best, 'median': median})
+            print('%-18s %4d years  %10.4f s' % (stage, n_years, best))
+    return results
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    '''prints how much slower (>1) or faster (<1) each result in ``new`` is
+    than the matching one in ``old``
+    '''
+    old_times = {(r['stage'], r['n_years'], r['n_regions'], r['missing'],
+                  r['similarity']): r['best'] for r in old['results']}
+    print('\nratio to ' + str(old.get('commit')))
+    for r in new['results']:
+        key = (r['stage'], r['n_years'], r['n_regions'], r['missing'],
+               r['similarity'])
+        if key in old_times:
+            print('%-18s %4d years  %6.2fx' % (r['stage'], r['n_years'],
+                                              r['best']/old_times[key]))
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the analog pipeline')
+    parser.add_argument('--years', type=int, nargs='+', default=[10, 20, 40],
+                        help='numbers of years to benchmark')
+    parser.add_argument('--regions', type=int, default=1,
+                        help='number of regions for the end to end benchmark')
+    parser.add_argument('--missing', type=float, default=0.1,
+                        help='fraction of missing data points')
+    parser.add_argument('--similarity', default='Euclidean',
+                        help='similarity measurement to use')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each benchmark')
+    parser.add_argument('--out', type=str,
+                        help='json file to write the results to')
+    parser.add_argument('--compare', type=str,
+                        help='json file of earlier results to compare to')
+    args = parser.parse_args()
+
+    report = {'commit': _commit(), 'python': platform.python_version(),
+              'numpy': np.__version__, 'pandas': pd.__version__,
+              'results': run(args.years, args.missing, args.repeat,
+                             args.similarity, args.regions)}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
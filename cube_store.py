@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+
+def find_cubes(paths):
+    '''name -> path of every cube in ``paths``, which are cube directories or
+    directories holding cubes. The name is the directory name without its
+    extension.
+    '''
+    cubes = {}
+    for path in paths:
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            found = [path]
+        elif os.path.isdir(path):
+            found = [os.path.join(path, d) for d in sorted(os.listdir(path))
+                     if os.path.exists(os.path.join(path, d, 'meta.json'))]
+        else:
+            raise ValueError(str(path) + ' is not a cube or a directory of cubes')
+        for cube in found:
+            name = os.path.splitext(os.path.basename(os.path.normpath(cube)))[0]
+            cubes[name] = cube
+    return cubes
+
+class CubeStore:
+    """binary store of preprocessed data as feature x region x day x year
+    arrays.
+
+    The store is a directory with a ``meta.json`` (features, regions, days,
+    years, dtype) and one ``.npy`` file per feature and block of regions.
+    Files are memory-mapped, so reading a feature for a region is a view into
+    the file and nothing is loaded until it is used.
+
+    Example:
+        store = CubeStore.create('nanjing.cube', ['Temperature', 'Rainfall'],
+                                 ['Nanjing'], range(1,366), range(2001,2019))
+        store.write('Temperature', 'Nanjing', processed_T)
+        df = CubeStore('nanjing.cube').to_frame('Nanjing')
+    """
+    def __init__(self, path, mode = 'r'):
+        """
+        Inputs:
+            ``path`` - directory of the store
+            ``mode`` - ``r`` to read, ``r+`` to also write
+        """
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.features = meta['features']
+        self.regions = meta['regions']
+        self.days = meta['days']
+        self.years = meta['years']
+        self.dtype = np.dtype(meta['dtype'])
+        self.region_chunk = meta['region_chunk']
+        self._feature_ind = {f: i for i, f in enumerate(self.features)}
+        self._region_ind = {r: i for i, r in enumerate(self.regions)}
+        self._chunks = {}
+
+    @classmethod
+    def create(cls, path, features, regions, days, years,
+               dtype = np.float64, region_chunk = 64):
+        """creates an empty (all NaN) store and opens it for writing
+
+        Inputs:
+            ``features``, ``regions``, ``days``, ``years`` - labels of the axes
+            ``dtype`` - type of the stored values
+            ``region_chunk`` - number of regions in each file
+        """
+        os.makedirs(path, exist_ok=True)
+        meta = {'features': list(features), 'regions': list(regions),
+                'days': [int(d) if float(d).is_integer() else float(d)
+                         for d in days],
+                'years': [int(y) for y in years],
+                'dtype': np.dtype(dtype).str, 'region_chunk': int(region_chunk)}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        store = cls(path, mode = 'r+')
+        for i in range(len(store.features)):
+            for c in range(store.num_chunks):
+                n = min(store.region_chunk, len(store.regions) - c*store.region_chunk)
+                A = np.lib.format.open_memmap(store._chunk_file(i, c), mode='w+',
+                                              dtype=store.dtype,
+                                              shape=(n, len(store.days), len(store.years)))
+                A[:] = np.nan
+                A.flush()
+                del A
+        return store
+
+    @classmethod
+    def from_frame(cls, path, df, region, feature = None, **kwargs):
+        """creates a store for one region from a ``combine_series`` or
+        ``preprocess`` DataFrame. ``feature`` names the data if ``df`` has no
+        feature column.
+        """
+        if df.columns[0] == 'feature':
+            features = list(pd.unique(df['feature']))
+            frames = [df[df['feature'] == f].iloc[:,1:] for f in features]
+        else:
+            features = [feature]
+            frames = [df]
+        days = frames[0]['day'].values
+        years = list(frames[0].columns[1:])
+        store = cls.create(path, features, [region], days, years, **kwargs)
+        for f, frame in zip(features, frames):
+            store.write(f, region, frame)
+        return store
+
+    @property
+    def num_chunks(self):
+        return -(-len(self.regions) // self.region_chunk)
+
+    def _chunk_file(self, i, c):
+        return os.path.join(self.path, 'f%d_r%d.npy' % (i, c))
+
+    def _chunk(self, i, c):
+        if (i, c) not in self._chunks:
+            self._chunks[(i, c)] = np.load(self._chunk_file(i, c),
+                                           mmap_mode=self.mode)
+        return self._chunks[(i, c)]
+
+    def read(self, feature, region):
+        """day x year array of ``feature`` in ``region``, as a view into the file
+        """
+        r = self._region_ind[region]
+        c, k = divmod(r, self.region_chunk)
+        return self._chunk(self._feature_ind[feature], c)[k]
+
+    def cube(self, features = None, regions = None):
+        """feature x region x day x year array for the given features and
+        regions (default all). Unlike ``read`` this is a copy.
+        """
+        if features is None:
+            features = self.features
+        if regions is None:
+            regions = self.regions
+        A = np.empty((len(features), len(regions), len(self.days), len(self.years)),
+                     dtype=self.dtype)
+        for i, feature in enumerate(features):
+            for j, region in enumerate(regions):
+                A[i, j] = self.read(feature, region)
+        return A
+
+    def write(self, feature, region, df):
+        """stores a ``preprocess`` DataFrame (day, yr1, yr2, ...) as
+        ``feature`` in ``region``. Days and years missing from ``df`` stay NaN.
+        """
+        if self.mode == 'r':
+            raise ValueError('store was opened read only')
+        A = self.read(feature, region)
+        rows = pd.Index(self.days).get_indexer(df['day'].values)
+        years = [y for y in df.columns[1:] if int(y) in self.years]
+        cols = pd.Index(self.years).get_indexer([int(y) for y in years])
+        if np.any(rows < 0):
+            raise ValueError('days of ``df`` are not in the store')
+        A[np.ix_(rows, cols)] = df[years].values
+        A.flush()
+
+    def to_frame(self, region, feature = None):
+        """DataFrame of ``region`` in the ``preprocess`` layout (day, yr1, ...)
+        for a single ``feature``, or in the ``combine_series`` layout (feature,
+        day, yr1, ...) for all features.
+        """
+        features = self.features if feature is None else [feature]
+        frames = []
+        for f in features:
+            df = pd.DataFrame(np.asarray(self.read(f, region)), columns=self.years)
+            df.insert(0, 'day', self.days)
+            if feature is None:
+                df.insert(0, 'feature', f)
+            frames.append(df)
+        return pd.concat(frames, ignore_index=True)
+
+    def _region_frame(self, region):
+        df = self.to_frame(region)
+        df.insert(1, 'region', region)
+        # parquet wants string column names
+        df.columns = [str(c) for c in df.columns]
+        return df
+
+    def to_parquet(self, path, **kwargs):
+        """exports the store to Parquet, with columns feature, region, day and
+        one column per year. Regions are written one at a time, as a row group
+        each, so only one region is in memory at once. Needs pyarrow or
+        fastparquet; ``kwargs`` go to ``pyarrow.parquet.ParquetWriter`` (or to
+        ``fastparquet.write``).
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            # fastparquet appends a row group to the file instead
+            for i, region in enumerate(self.regions):
+                self._region_frame(region).to_parquet(path, engine='fastparquet',
+                                                      index=False, append=i > 0,
+                                                      **kwargs)
+            return
+        writer = None
+        try:
+            for region in self.regions:
+                # every region gets the schema of the first one
+                table = pa.Table.from_pandas(self._region_frame(region),
+                                             preserve_index=False,
+                                             schema=writer and writer.schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema, **kwargs)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
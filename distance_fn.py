@@ -10,11 +10,16 @@ non-commercial applications. However, we retain the right to use this code or
 parts of this code for any purpose.
 """
 
+import os
 import numpy as np
 import pandas as pd
-from sklearn.metrics import r2_score
+import heapq
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from profiling import profiled
 
-def dist( t1, t2, shift=False, metric='Euclidean',handle_na='interpolate'):
+def dist( t1, t2, shift=False, metric='Euclidean',handle_na='interpolate',
+         max_shift=7, return_lag=False, band=7):
     '''
     Parameters
     ----------
@@ -25,12 +30,26 @@ def dist( t1, t2, shift=False, metric='Euclidean',handle_na='interpolate'):
         
     shift (bool):
         determines whether we perform (left and right) shift on the time series data. If yes, find the minmum distance
-        between time series for shift values between 1 and max_shift=7 (days). The shift is periodic, for example,
+        between time series for shift values between 1 and max_shift (days). The shift is periodic, for example,
         [0,0,0,1] will be shifted to [1,0,0,0] if we want to shift right by 1 index.
+
+    max_shift (int):
+        (default 7) largest shift (in days) considered when ``shift`` is True.
+        Shifted Euclidean and R2 distances are searched with FFT cross-correlation
+        (see ``dist_mat``), so large values are cheap.
+
+    return_lag (bool):
+        (default False) if True, also return the shift of ``t2`` giving the minimum distance.
     
-    metric {'R2','Euclidean', 'L1', or 'Linf'}: 
+    metric {'R2','Euclidean', 'L1', 'Linf' or 'DTW'}: 
         the metric used to compare those two time series, 
-        by default the Euclidean distance is used.
+        by default the Euclidean distance is used. 'DTW' is dynamic time warping
+        with squared differences (the square root of the total is returned, so
+        it is never more than the Euclidean distance).
+
+    band (int):
+        (default 7) width of the Sakoe-Chiba band for 'DTW', i.e. day i of ``t1``
+        can only be matched to days i-band to i+band of ``t2``. None for no band.
     
     handle_na {'interpolate', 'fill', 'drop'}
         the way missing values are handled, 'interpolat' interpolates the missing value based on neighbouring values.
@@ -42,11 +61,21 @@ def dist( t1, t2, shift=False, metric='Euclidean',handle_na='interpolate'):
     ----------
     
     min_shift_dist(float): the distance between the two (shifted) time series using the selected metric.
+
+    lag(int): the best shift, only returned if ``return_lag`` is True.
     
     '''
+    if shift:
+        D, lags = dist_mat(t1.values, t2.values, shift=True, max_shift=max_shift,
+                           metric=metric, handle_na=handle_na, return_lag=True,
+                           band=band)
+        if return_lag:
+            return D[0,0], lags[0,0]
+        return D[0,0]
+
     if handle_na == 'interpolate':
-        t1 = t1.interpolate().fillna(method='ffill').fillna(method='bfill')
-        t2 = t2.interpolate().fillna(method='ffill').fillna(method='bfill')
+        t1 = t1.interpolate().ffill().bfill()
+        t2 = t2.interpolate().ffill().bfill()
     elif handle_na == 'fill':
         t1 = t1.fillna(t1.mean())
         t2 = t2.fillna(t1.mean())
@@ -59,10 +88,7 @@ def dist( t1, t2, shift=False, metric='Euclidean',handle_na='interpolate'):
     t1 = t1.values
     t2 = t2.values
     
-    if shift:
-        max_shift = 7
-    else:
-        max_shift = 0
+    max_shift = 0
         
     min_shift_dist = np.inf
     #Consider both left and right shift, so the metric is symmetric
@@ -88,15 +114,995 @@ def dist( t1, t2, shift=False, metric='Euclidean',handle_na='interpolate'):
                 dist = np.nanmax(np.abs(t1-t2_shifted))
         
         elif metric == 'R2':
+            # sklearn is slow to import, and only this branch needs it
+            from sklearn.metrics import r2_score
             if handle_na == 'interpolate' or handle_na == 'fill':
                 dist = 1-r2_score(t1,t2_shifted)
             else:
                 mask = ~np.isnan(t1)&~np.isnan(t2_shifted)
                 dist = 1-r2_score(t1[mask],t2_shifted[mask])
+
+        elif metric == 'DTW':
+            dist = _dtw(t1[:, None], t2_shifted[:, None], band, handle_na)[0]
         else:
-            raise ValueError("metric should be one of 'Euclidean', 'L1','Linf' or 'R2'.")
+            raise ValueError("metric should be one of 'Euclidean', 'L1','Linf', 'R2' or 'DTW'.")
         
         if dist <= min_shift_dist:
             min_shift_dist = dist
         
+    if return_lag:
+        return min_shift_dist, 0
     return min_shift_dist
+
+
+def _prepare(A, handle_na, dtype=float):
+    '''handles missing data once for every column of ``A``, the same way
+    ``dist`` does for a single pair.
+
+    Parameters
+    ----------
+
+    A (ndarray): days x years array of observations.
+
+    handle_na {'interpolate', 'fill', 'drop'}: see ``dist``.
+
+    dtype: (default float) floating point type to work in.
+
+    Returns
+    ----------
+
+    A (ndarray): the array with missing values handled. For 'fill' the NaNs
+    are kept, since ``dist`` fills the second series with the mean of the first
+    one, so the fill value depends on the pair.
+    '''
+    A = np.asarray(A, dtype=dtype)
+    if A.ndim == 1:
+        A = A[:, None]
+    if handle_na == 'interpolate':
+        # only the columns with gaps need to go through pandas
+        nan_cols = np.isnan(A).any(axis=0)
+        if nan_cols.any():
+            A = A.copy()
+            A[:, nan_cols] = pd.DataFrame(A[:, nan_cols]).interpolate().ffill().bfill().values
+        return A
+    elif handle_na in ('fill', 'drop'):
+        return A
+    else:
+        raise ValueError("handle_na should be one of 'interpolate', 'fill','Linf'")
+
+
+def _dtw(A, B, band, handle_na):
+    '''banded DTW distances between the columns of ``A`` and ``B`` (pair by
+    pair, or ``A`` may have a single column), after missing values have been
+    handled. With ``handle_na='drop'`` days where either series is missing
+    cost nothing.
+
+    Cells (i,j) on an anti-diagonal i+j=k only depend on the two previous
+    anti-diagonals, so we fill one anti-diagonal of every pair at a time,
+    keeping only the cells inside the band.
+    '''
+    L, P = B.shape
+    if A.shape[0] != L:
+        raise ValueError('DTW needs series of the same length')
+    if not L:
+        return np.full(max(P, A.shape[1]), np.nan)
+    r = L if band is None else int(band)
+    P = max(P, A.shape[1])
+
+    # three rolling anti-diagonals, indexed by i+1 so index 0 (i=-1) stays inf
+    bufs = [np.full((L+1, P), np.inf) for _ in range(3)]
+    written = [None]*3
+    for k in range(2*L - 1):
+        lo = max(0, k - L + 1, -((r - k)//2))
+        hi = min(k, L - 1, (k + r)//2)
+        cur, prev, prev2 = bufs[k % 3], bufs[(k-1) % 3], bufs[(k-2) % 3]
+        if written[k % 3] is not None:
+            cur[written[k % 3][0]:written[k % 3][1]] = np.inf
+        if lo > hi:
+            written[k % 3] = None
+            continue
+
+        i = np.arange(lo, hi + 1)
+        cost = (A[i] - B[k - i])**2
+        if handle_na == 'drop':
+            cost[np.isnan(cost)] = 0
+        if k == 0:
+            cur[1] = cost[0]
+        else:
+            # (i-1,j) and (i,j-1) are on the last anti-diagonal, (i-1,j-1) on
+            # the one before
+            cur[lo+1:hi+2] = cost + np.minimum(np.minimum(prev[lo:hi+1],
+                                                          prev[lo+1:hi+2]),
+                                               prev2[lo:hi+1])
+        written[k % 3] = (lo + 1, hi + 2)
+
+    return np.sqrt(bufs[(2*L - 2) % 3][L])
+
+
+def _lb_keogh(a, B, band):
+    '''LB_Keogh lower bounds of the banded DTW distance between ``a`` and every
+    column of ``B``: each day of ``a`` is at least as far from its match as
+    from the range of ``B`` within ``band`` days.
+    '''
+    L = B.shape[0]
+    r = L if band is None else min(int(band), L)
+    upper = B.copy()
+    lower = B.copy()
+    for s in range(1, r + 1):
+        upper[s:] = np.maximum(upper[s:], B[:-s])
+        upper[:-s] = np.maximum(upper[:-s], B[s:])
+        lower[s:] = np.minimum(lower[s:], B[:-s])
+        lower[:-s] = np.minimum(lower[:-s], B[s:])
+    a = a[:, None]
+    over = np.where(a > upper, a - upper, 0.)
+    under = np.where(a < lower, lower - a, 0.)
+    return np.sqrt(np.sum(over**2 + under**2, axis=0))
+
+
+def _row_dists(a, B, metric, handle_na, band=7):
+    '''distances between the series ``a`` and every column of ``B``, after
+    missing values have been handled.
+    '''
+    if metric == 'DTW':
+        return _dtw(a[:, None], B, band, handle_na)
+
+    diff = a[:, None] - B
+    if metric == 'Euclidean':
+        if handle_na == 'drop':
+            return np.sqrt(np.nansum(diff**2, axis=0))
+        return np.sqrt(np.sum(diff**2, axis=0))
+
+    elif metric == 'L1':
+        if handle_na == 'drop':
+            return np.nansum(np.abs(diff), axis=0)
+        return np.sum(np.abs(diff), axis=0)
+
+    elif metric == 'Linf':
+        if diff.shape[0] == 0:
+            return np.full(diff.shape[1], np.nan)
+        if handle_na == 'drop':
+            with warnings.catch_warnings():
+                # all-NaN pairs give NaN, as in ``dist``
+                warnings.simplefilter("ignore")
+                return np.nanmax(np.abs(diff), axis=0)
+        return np.max(np.abs(diff), axis=0)
+
+    elif metric == 'R2':
+        # 1 - r2_score(a, b) = SS_res / SS_tot, where SS_tot is taken around
+        # the mean of ``a`` over the days used for the pair
+        if handle_na == 'drop':
+            mask = ~np.isnan(diff)
+        else:
+            mask = np.ones(diff.shape, dtype=bool)
+        cnt = mask.sum(axis=0)
+        a_full = np.where(mask, a[:, None], 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a_mean = a_full.sum(axis=0)/cnt
+            ss_tot = np.where(mask, (a[:, None] - a_mean)**2, 0.).sum(axis=0)
+            ss_res = np.where(mask, diff**2, 0.).sum(axis=0)
+            # sklearn convention for a constant ``a``
+            d = np.where(ss_tot == 0, (ss_res != 0).astype(float),
+                         ss_res/ss_tot)
+        d[cnt < 2] = np.nan
+        return d
+    else:
+        raise ValueError("metric should be one of 'Euclidean', 'L1','Linf', 'R2' or 'DTW'.")
+
+
+def overlap_counts(A, B=None):
+    '''
+    Parameters
+    ----------
+
+    A, B (ndarray):
+        days x years arrays of observations, see ``dist_mat``.
+
+    Returns
+    ----------
+
+    C (ndarray of ints): C[i,j] is the number of days on which both A[:,i]
+    and B[:,j] are observed (not NaN), computed as one matrix product of the
+    validity masks.
+    '''
+    VA = ~np.isnan(np.asarray(A, dtype=float).reshape(len(A), -1))
+    VB = VA if B is None else ~np.isnan(np.asarray(B, dtype=float).reshape(len(B), -1))
+    # float products are exact for counts this size, and much faster than ints
+    return np.rint(VA.T.astype(float) @ VB.astype(float)).astype(int)
+
+
+def _masked_dists(A, B, metric):
+    '''Euclidean or R2 distances between all columns of ``A`` and ``B`` over
+    the days where both are observed (``handle_na='drop'``), from matrix
+    products of the zero-filled data and validity masks:
+
+        SS_res[i,j] = (A0^2)'VB + VA'(B0^2) - 2 A0'B0
+        SS_tot[i,j] = (A0^2)'VB - (A0'VB)^2/cnt,   cnt = VA'VB
+
+    Both are shifted by the same constant first, which leaves the distances
+    unchanged but keeps the products from losing precision for data far from
+    zero. Returns the distances and the overlap counts.
+    '''
+    # products in double precision, whatever the dtype of the data
+    A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+    VA, VB = ~np.isnan(A), ~np.isnan(B)
+    center = np.nanmean(np.concatenate([A[VA], B[VB]])) if VA.any() or VB.any() else 0.
+    A0 = np.where(VA, A - center, 0.)
+    B0 = np.where(VB, B - center, 0.)
+    VA, VB = VA.astype(A0.dtype), VB.astype(B0.dtype)
+    cnt = np.rint(VA.T @ VB)
+    a_sq = (A0**2).T @ VB
+    ss_res = np.maximum(a_sq + VA.T @ B0**2 - 2*A0.T @ B0, 0)
+    if metric == 'Euclidean':
+        return np.sqrt(ss_res), cnt
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ss_tot = np.maximum(a_sq - (A0.T @ VB)**2/cnt, 0)
+        # what is left of an exact zero after rounding
+        tiny = 1e-10*(a_sq + VA.T @ B0**2)
+        # sklearn convention for a constant ``a``
+        d = np.where(ss_tot <= tiny, (ss_res > tiny).astype(float),
+                     ss_res/ss_tot)
+    d[cnt < 2] = np.nan
+    return d, cnt
+
+
+def _xcorr(x, Y):
+    '''circular cross-correlation of ``x`` with every column of ``Y`` using the
+    FFT, C[s,j] = sum_k x[k]*Y[k-s,j], i.e. the dot product of ``x`` with
+    ``np.roll(Y[:,j], s)``.
+    '''
+    L = Y.shape[0]
+    return np.fft.irfft(np.fft.rfft(x)[:, None]*np.conj(np.fft.rfft(Y, axis=0)),
+                        n=L, axis=0)
+
+
+def _roll_columns(B, lags):
+    '''``np.roll`` each column of ``B`` by its own lag.
+    '''
+    L = B.shape[0]
+    rows = (np.arange(L)[:, None] - lags[None, :]) % L
+    return np.take_along_axis(B, rows, axis=0)
+
+
+def _best_lags(a, B, max_shift, metric, handle_na):
+    '''finds, for every column of ``B``, the shift in [-max_shift, max_shift]
+    minimizing the Euclidean or R2 distance to ``a``, for all shifts at once.
+
+    ||a - roll(b,s)||^2 = sum(a^2) + sum(b^2) - 2*xcorr(a,b)[s], and with
+    ``handle_na='drop'`` every term is restricted to the days where both
+    series are observed, which is again a cross-correlation with the masks.
+    '''
+    L = B.shape[0]
+    shifts = np.arange(-max_shift, max_shift+1)
+    rows = shifts % L
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if handle_na == 'drop':
+            va = (~np.isnan(a)).astype(float)
+            vB = (~np.isnan(B)).astype(float)
+            a0 = np.where(va > 0, a, 0.)
+            B0 = np.where(vB > 0, B, 0.)
+            cross = _xcorr(a0, B0)[rows]
+            a_sq = _xcorr(a0**2, vB)[rows]
+            ss_res = a_sq + _xcorr(va, B0**2)[rows] - 2*cross
+            if metric == 'R2':
+                cnt = np.round(_xcorr(va, vB)[rows])
+                a_sum = _xcorr(a0, vB)[rows]
+                ss_tot = a_sq - a_sum**2/cnt
+                score = ss_res/ss_tot
+                score[cnt < 2] = np.nan
+            else:
+                score = ss_res
+        else:
+            # the norms don't depend on the shift, and for R2 neither does SS_tot
+            score = -_xcorr(a, B)[rows]
+
+    score = np.where(np.isnan(score), np.inf, score)
+    # like ``dist``, ties go to the last shift tried
+    best = len(shifts) - 1 - np.argmin(score[::-1], axis=0)
+    return shifts[best]
+
+
+@profiled('distance', items=lambda D: (D[0] if isinstance(D, tuple) else D).size)
+def dist_mat(A, B=None, shift=False, metric='Euclidean', handle_na='interpolate',
+             max_shift=7, return_lag=False, band=7, pair_batch=4096,
+             dtype=float, condensed=False, min_overlap=0):
+    '''
+    Parameters
+    ----------
+
+    A, B (ndarray):
+        days x years arrays of observations (e.g. ``df[years].values``). If
+        ``B`` is None, the distances between all pairs of columns of ``A`` are
+        computed.
+
+    shift, metric, handle_na, max_shift, band:
+        see ``dist``.
+
+    return_lag (bool):
+        (default False) if True, also return the best shift of B[:,j] for each pair.
+
+    pair_batch (int):
+        (default 4096) number of pairs whose DTW is computed together.
+
+    dtype:
+        (default float) floating point type of the data and of ``D``.
+        ``np.float32`` halves the memory used.
+
+    condensed (bool):
+        (default False) if True, return only the upper triangle of ``D``
+        (without the diagonal) as a flat array, in the order of
+        ``scipy.spatial.distance.squareform``. Only for symmetric metrics, i.e.
+        ``B`` is None, ``metric`` is not R2 and ``handle_na`` is not 'fill'.
+        See ``condensed_row`` and ``square_mat``.
+
+    min_overlap (int):
+        (default 0) pairs observed together on fewer days than this (see
+        ``overlap_counts``, which counts the unshifted data before missing
+        values are handled) get an infinite distance.
+
+    Returns
+    ----------
+
+    D (ndarray): D[i,j] equals ``dist(A[:,i], B[:,j], ...)``.
+
+    lags (ndarray of ints): only returned if ``return_lag`` is True. Condensed
+    like ``D`` if ``condensed`` is True.
+
+    NOTE: missing values are handled once per column rather than once per pair,
+    and symmetric metrics only compute the upper triangle. For shifted Euclidean
+    and R2 distances the best shift of every pair is found for all shifts at
+    once with FFT cross-correlation, and the distance is then computed exactly
+    at that shift. L1, Linf and DTW have no such shortcut and try every shift.
+    Unshifted DTW runs the dynamic program for many pairs at once, and unshifted
+    Euclidean and R2 distances with ``handle_na='drop'`` come from a few matrix
+    products (see ``_masked_dists``), equal to the pair by pair ones up to
+    rounding.
+    '''
+    symmetric = B is None
+    if min_overlap:
+        cnt = overlap_counts(A, B)
+    A = _prepare(A, handle_na, dtype)
+    if B is None:
+        B = A
+    else:
+        B = _prepare(B, handle_na, dtype)
+
+    if A.ndim == 1:
+        A = A[:, None]
+    if B.ndim == 1:
+        B = B[:, None]
+
+    # R2 is not symmetric, and neither is 'fill', since the second series is
+    # filled with the mean of the first one
+    symmetric = symmetric and metric != 'R2' and handle_na != 'fill'
+    if condensed and not symmetric:
+        raise ValueError("condensed output needs a symmetric distance, i.e. no ``B``, "
+                         "a metric other than 'R2' and handle_na other than 'fill'")
+
+    if not shift:
+        max_shift = 0
+
+    n, m = A.shape[1], B.shape[1]
+    if condensed:
+        # row i of the upper triangle starts at offs[i]
+        offs = np.concatenate([[0], np.cumsum(np.arange(n-1, -1, -1))]).astype(int)
+        D = np.full(n*(n-1)//2, np.inf, dtype=dtype)
+        lags = np.zeros(n*(n-1)//2, dtype=int) if return_lag else None
+    else:
+        D = np.full((n, m), np.inf, dtype=dtype)
+        lags = np.zeros((n, m), dtype=int) if return_lag else None
+    if metric == 'DTW' and not max_shift and handle_na != 'fill':
+        for p0, pi, pj in _pair_batches(n, m, symmetric, condensed, pair_batch):
+            d = _dtw(A[:, pi], B[:, pj], band, handle_na)
+            d = np.where(np.isnan(d), np.inf, d)
+            if condensed:
+                D[p0:p0+pair_batch] = d
+            else:
+                D[pi, pj] = d
+        n = 0
+
+    if metric in ('Euclidean', 'R2') and not max_shift and handle_na == 'drop':
+        # blocks of rows, so the products stay a manageable size
+        block = max(1, 2**20//max(m, 1))
+        for i0 in range(0, n, block):
+            d, _ = _masked_dists(A[:, i0:i0+block], B, metric)
+            d = np.where(np.isnan(d), np.inf, d)
+            if symmetric:
+                # a series is always at distance 0 from itself, whatever the
+                # rounding in the products
+                rows = np.arange(i0, i0 + d.shape[0])
+                d[rows - i0, rows] = 0
+            if condensed:
+                for i in range(i0, i0 + d.shape[0]):
+                    D[offs[i]:offs[i+1]] = d[i - i0, i+1:]
+            else:
+                D[i0:i0 + d.shape[0]] = d
+        n = 0
+
+    for i in range(n):
+        j0 = i if symmetric else 0
+        a = A[:, i]
+        B_i = B[:, j0:]
+        if handle_na == 'fill':
+            a_mean = np.nanmean(a) if np.any(~np.isnan(a)) else np.nan
+            a = np.where(np.isnan(a), a_mean, a)
+            B_i = np.where(np.isnan(B_i), a_mean, B_i)
+
+        if max_shift and metric in ('Euclidean', 'R2') and B_i.shape[0]:
+            lag = _best_lags(a, B_i, max_shift, metric, handle_na)
+            d = _row_dists(a, _roll_columns(B_i, lag), metric, handle_na)
+            row = np.where(np.isnan(d), np.inf, d)
+            row_lag = lag
+        else:
+            row = np.full(m - j0, np.inf)
+            row_lag = np.zeros(m - j0, dtype=int)
+            for s in range(-max_shift, max_shift+1):
+                d = _row_dists(a, np.roll(B_i, s, axis=0), metric, handle_na, band)
+                # like ``dist``, NaN distances never replace the running minimum
+                better = d <= row
+                row[better] = d[better]
+                row_lag[better] = s
+
+        if condensed:
+            # drop the diagonal
+            D[offs[i]:offs[i+1]] = row[1:]
+            if return_lag:
+                lags[offs[i]:offs[i+1]] = row_lag[1:]
+        else:
+            D[i, j0:] = row
+            if return_lag:
+                lags[i, j0:] = row_lag
+
+    if symmetric and not condensed:
+        _mirror(D)
+        if return_lag:
+            _mirror(lags, -1)
+    if min_overlap:
+        if condensed:
+            cnt = np.concatenate([cnt[i, i+1:] for i in range(len(cnt))])
+        D[cnt < min_overlap] = np.inf
+    if return_lag:
+        return D, lags
+    return D
+
+
+def _pair_batches(n, m, symmetric, condensed, pair_batch):
+    '''batches of the pairs (i, j) ``dist_mat`` computes, in row major order:
+    j > i (j >= i unless ``condensed``) if ``symmetric``, all pairs otherwise.
+    Yields the position of the batch in that order and the rows and columns
+    of its pairs, without listing all pairs at once.
+    '''
+    k = 1 if condensed else 0
+    if symmetric:
+        lens = np.maximum(m - np.arange(n) - k, 0)
+    else:
+        lens = np.full(n, m)
+    offs = np.concatenate([[0], np.cumsum(lens)])
+    for p0 in range(0, int(offs[-1]), pair_batch):
+        p = np.arange(p0, min(p0 + pair_batch, int(offs[-1])))
+        pi = np.searchsorted(offs, p, side='right') - 1
+        pj = p - offs[pi] + (pi + k if symmetric else 0)
+        yield p0, pi, pj
+
+
+def _mirror(D, sign=1, block=256):
+    '''copies the upper triangle of the square ``D`` (times ``sign``) onto its
+    lower triangle in place, a block of rows at a time so no index arrays or
+    copies of the whole triangle are needed.
+    '''
+    n = D.shape[0]
+    lower = np.tri(block, k=-1, dtype=bool)
+    for i0 in range(0, n, block):
+        i1 = min(i0 + block, n)
+        D[i1:, i0:i1] = sign*D[i0:i1, i1:].T
+        sub = D[i0:i1, i0:i1]
+        tri = lower[:i1 - i0, :i1 - i0]
+        sub[tri] = sign*sub.T[tri]
+
+
+def _condensed_size(C):
+    n = int(round((1 + np.sqrt(1 + 8*len(C)))/2))
+    if n*(n-1)//2 != len(C):
+        raise ValueError('length of a condensed matrix must be n*(n-1)/2')
+    return n
+
+
+def condensed_index(n, i, j):
+    '''
+    Parameters
+    ----------
+
+    n (int): number of years.
+
+    i, j (int or ndarray of ints): row and column of the full matrix, i != j.
+
+    Returns
+    ----------
+
+    index of D[i,j] in the condensed matrix of ``dist_mat(..., condensed=True)``.
+    '''
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n*i - i*(i+1)//2 + j - i - 1
+
+
+def condensed_row(C, i, diag=0.):
+    '''
+    Parameters
+    ----------
+
+    C (ndarray): condensed matrix from ``dist_mat(..., condensed=True)``.
+
+    i (int): row of the full matrix.
+
+    diag (float): (default 0.) value to put at D[i,i].
+
+    Returns
+    ----------
+
+    row (ndarray): the distances from year ``i`` to every year, row ``i`` of
+    the full matrix.
+    '''
+    n = _condensed_size(C)
+    row = np.full(n, diag, dtype=C.dtype)
+    others = np.delete(np.arange(n), i)
+    row[others] = C[condensed_index(n, i, others)]
+    return row
+
+
+def square_mat(C, diag=0.):
+    '''
+    Parameters
+    ----------
+
+    C (ndarray): condensed matrix from ``dist_mat(..., condensed=True)``.
+
+    diag (float): (default 0.) value to put on the diagonal.
+
+    Returns
+    ----------
+
+    D (ndarray): the full symmetric matrix.
+    '''
+    n = _condensed_size(C)
+    D = np.full((n, n), diag, dtype=C.dtype)
+    iu = np.triu_indices(n, 1)
+    D[iu] = C
+    D[(iu[1], iu[0])] = C
+    return D
+
+
+def _tile_size(L, n, itemsize, memory, pair_batch):
+    '''largest number of columns per tile whose work fits in ``memory`` bytes
+    '''
+    t = max(n, 1)
+    while t > 1:
+        # the tile and its lags, a few days x tile temporaries for one row of
+        # the tile, and the DTW buffers of one batch of pairs (if any)
+        need = (t*t*(itemsize + 8) + 4*L*t*8 +
+                3*(L + 1)*min(pair_batch, t*t)*8)
+        if need <= memory:
+            break
+        t = (t + 1)//2
+    return t
+
+
+def tiled_dist_mat(A, B=None, out=None, callback=None, memory=256*2**20,
+                   threads=None, shift=False, metric='Euclidean',
+                   handle_na='interpolate', max_shift=7, band=7, dtype=float):
+    '''
+    Parameters
+    ----------
+
+    A, B (ndarray):
+        days x years arrays of observations, see ``dist_mat``.
+
+    out (str or ndarray):
+        (default None) where to write the matrix: the path of a .npy file,
+        which is created as a memory map, or an array (e.g. an ``np.memmap``)
+        of shape (years of A) x (years of B).
+
+    callback (function):
+        (default None) called as ``callback(i0, j0, tile)`` for every tile,
+        where ``tile`` equals D[i0:i0+len(tile), j0:j0+tile.shape[1]]. For
+        symmetric distances only the tiles with ``j0 >= i0`` are passed, the
+        others are their transposes.
+
+    memory (int):
+        (default 256MB) bytes of working memory shared by all threads, which
+        sets the size of the tiles.
+
+    threads (int):
+        (default number of CPUs) tiles computed at the same time.
+
+    shift, metric, handle_na, max_shift, band:
+        see ``dist``.
+
+    dtype:
+        (default float) floating point type of the data and of the matrix.
+
+    Returns
+    ----------
+
+    D (ndarray): the matrix written to ``out``, or None if ``out`` is None.
+
+    NOTE: the data is prepared once, then square tiles of the matrix are
+    computed by ``dist_mat`` on a thread pool (numpy releases the GIL for the
+    heavy lifting). Only a few tiles are held at a time, so with a memory map
+    or a callback the whole matrix is never in memory.
+    '''
+    if out is None and callback is None:
+        raise ValueError('give ``out`` and/or ``callback`` to receive the tiles')
+    symmetric = B is None and metric != 'R2' and handle_na != 'fill'
+    A = _prepare(A, handle_na, dtype)
+    B = A if B is None else _prepare(B, handle_na, dtype)
+    (L, n), m = A.shape, B.shape[1]
+
+    if isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(n, m))
+    elif out is not None and out.shape != (n, m):
+        raise ValueError('``out`` must have shape ' + str((n, m)))
+
+    threads = threads or os.cpu_count() or 1
+    per_thread = memory//threads
+    # DTW keeps three days x pairs buffers per batch of pairs
+    pair_batch = int(max(1, min(4096, per_thread//(4*(L + 1)*8))))
+    t = _tile_size(L, max(n, m), np.dtype(dtype).itemsize, per_thread,
+                   pair_batch if metric == 'DTW' else 0)
+
+    def work(i0, j0):
+        if symmetric and i0 == j0:
+            tile = dist_mat(A[:, i0:i0+t], shift=shift, metric=metric,
+                            handle_na=handle_na, max_shift=max_shift, band=band,
+                            pair_batch=pair_batch, dtype=dtype)
+        else:
+            tile = dist_mat(A[:, i0:i0+t], B[:, j0:j0+t], shift=shift,
+                            metric=metric, handle_na=handle_na,
+                            max_shift=max_shift, band=band,
+                            pair_batch=pair_batch, dtype=dtype)
+        return i0, j0, tile
+
+    def store(i0, j0, tile):
+        if out is not None:
+            out[i0:i0+tile.shape[0], j0:j0+tile.shape[1]] = tile
+            if symmetric and i0 != j0:
+                out[j0:j0+tile.shape[1], i0:i0+tile.shape[0]] = tile.T
+        if callback is not None:
+            callback(i0, j0, tile)
+
+    tiles = [(i0, j0) for i0 in range(0, n, t) for j0 in range(0, m, t)
+             if not symmetric or j0 >= i0]
+    # only a few tiles in flight, so finished ones don't pile up
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = set()
+        for i0, j0 in tiles:
+            if len(pending) >= 2*threads:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    store(*f.result())
+            pending.add(pool.submit(work, i0, j0))
+        for f in pending:
+            store(*f.result())
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _abandon_tol(thr):
+    # lower bounds and partial sums can come out a rounding error above the
+    # exact distance, so only prune when they are clearly worse
+    return thr*(1 + 1e-9) + 1e-12
+
+
+def _mean_lower_bound(a, B, metric, seg_len):
+    '''lower bounds of the distances between ``a`` and the columns of ``B``
+    from the means of segments of ``seg_len`` days.
+    '''
+    L, n = B.shape
+    starts = np.arange(0, L, seg_len)
+    lens = np.diff(np.append(starts, L))
+    diff_means = (np.add.reduceat(a, starts)[:, None] -
+                  np.add.reduceat(B, starts, axis=0))/lens[:, None]
+    if metric == 'Euclidean':
+        lb = np.sqrt(np.sum(lens[:, None]*diff_means**2, axis=0))
+    elif metric == 'L1':
+        lb = np.sum(lens[:, None]*np.abs(diff_means), axis=0)
+    elif metric == 'Linf':
+        lb = np.max(np.abs(diff_means), axis=0) if L else np.zeros(n)
+    else:
+        raise ValueError("metric should be one of 'Euclidean', 'L1','Linf' or 'R2'.")
+    return lb
+
+
+@profiled('distance', items=lambda ret: len(ret[0]))
+def top_k(a, B, k=5, shift=False, metric='Euclidean', handle_na='interpolate',
+          max_shift=7, band=7, seg_len=16, batch=64, chunk=32):
+    '''
+    Parameters
+    ----------
+
+    a (ndarray): the query series.
+
+    B (ndarray): days x candidates array of series to search.
+
+    k (int): number of closest candidates wanted.
+
+    shift, metric, handle_na, max_shift, band:
+        see ``dist``.
+
+    seg_len (int): number of days averaged together for the lower bounds.
+
+    batch, chunk (int): candidates and days handled at a time.
+
+    Returns
+    ----------
+
+    inds (ndarray of ints), D (ndarray): the candidates that can be among the k
+    closest to ``a`` and their exact distances (equal to ``dist_mat(a, B)``).
+    Every candidate at least as close as the k-th closest one is included, so
+    sorting these gives the same top k (ties included) as sorting all of them.
+
+    NOTE: for Euclidean, L1 and Linf distances without shifts, candidates are
+    visited in order of a lower bound computed from segment means (the
+    distance between segment averages never exceeds the distance between the
+    series), and we stop once the lower bound exceeds the k-th best distance
+    so far. The remaining candidates accumulate their distance over blocks of
+    days and are dropped as soon as the partial sum is too large. DTW uses
+    LB_Keogh envelopes as the lower bound instead, so only candidates whose
+    envelope is close enough get the full dynamic program. Shifted, R2 and
+    'drop' distances are computed for all candidates.
+    '''
+    a = np.asarray(a, dtype=float).ravel()
+    B = np.asarray(B, dtype=float)
+    if B.ndim == 1:
+        B = B[:, None]
+    n = B.shape[1]
+
+    def finish(inds, d):
+        d = np.where(np.isnan(d), np.inf, d)
+        if len(d) > k:
+            thr = np.partition(d, k-1)[k-1]
+            keep = d <= thr
+            inds, d = inds[keep], d[keep]
+        return inds, d
+
+    if shift or metric == 'R2' or handle_na == 'drop' or not n or not len(a):
+        d = dist_mat(a, B, shift=shift, metric=metric, handle_na=handle_na,
+                     max_shift=max_shift, band=band)[0]
+        return finish(np.arange(n), d)
+
+    a = _prepare(a[:, None], handle_na)[:, 0]
+    B = _prepare(B, handle_na)
+    if handle_na == 'fill':
+        a_mean = np.nanmean(a) if np.any(~np.isnan(a)) else np.nan
+        a = np.where(np.isnan(a), a_mean, a)
+        B = np.where(np.isnan(B), a_mean, B)
+
+    L = len(a)
+    if metric == 'DTW':
+        lb = _lb_keogh(a, B, band)
+    else:
+        lb = _mean_lower_bound(a, B, metric, seg_len)
+    # no bound for series we can't compare
+    lb[np.isnan(lb)] = 0
+
+    order = np.argsort(lb, kind='stable')
+    best = []  # max-heap of the k smallest distances, as negatives
+    inds, dists = [], []
+    for b0 in range(0, n, batch):
+        cand = order[b0:b0+batch]
+        thr = -best[0] if len(best) == k else np.inf
+        cand = cand[lb[cand] <= _abandon_tol(thr)]
+        if not len(cand):
+            break
+
+        # early abandoning: accumulate over blocks of days, drop candidates
+        # whose partial distance is already worse than the k-th best
+        partial = np.zeros(len(cand))
+        for d0 in range(0, L, chunk):
+            if metric == 'DTW' or not np.isfinite(thr) or not len(cand):
+                break
+            diff = np.abs(a[d0:d0+chunk, None] - B[d0:d0+chunk, cand])
+            if metric == 'Euclidean':
+                partial += np.sum(diff**2, axis=0)
+                alive = partial <= _abandon_tol(thr**2)
+            elif metric == 'L1':
+                partial += np.sum(diff, axis=0)
+                alive = partial <= _abandon_tol(thr)
+            else:
+                partial = np.maximum(partial, np.max(diff, axis=0))
+                alive = partial <= _abandon_tol(thr)
+            # NaN partial sums can't be ruled out here
+            alive |= np.isnan(partial)
+            cand, partial = cand[alive], partial[alive]
+
+        if len(cand):
+            # exact distances, computed the same way as ``dist_mat``
+            d = _row_dists(a, B[:, cand], metric, handle_na, band)
+            d = np.where(np.isnan(d), np.inf, d)
+            inds.extend(cand.tolist())
+            dists.extend(d.tolist())
+            for dj in d:
+                if len(best) < k:
+                    heapq.heappush(best, -dj)
+                elif dj < -best[0]:
+                    heapq.heapreplace(best, -dj)
+
+    return finish(np.array(inds, dtype=int), np.array(dists))
+
+
+def resample_weights(L, n=200, method='bootstrap', block=1, seed=0):
+    '''
+    Parameters
+    ----------
+
+    L (int): number of days.
+
+    n (int): (default 200) number of bootstrap replicates.
+
+    method {'bootstrap', 'jackknife'}:
+        'bootstrap' draws L days with replacement, in blocks of ``block``
+        consecutive days (a moving block bootstrap, wrapping around the end),
+        'jackknife' leaves out one block of ``block`` days at a time, giving
+        ceil(L/block) replicates and ignoring ``n``.
+
+    block (int): (default 1) days per block, e.g. the smoothing window, so
+        neighbouring days that move together are resampled together.
+
+    seed (int): (default 0) random seed for 'bootstrap'.
+
+    Returns
+    ----------
+
+    W (ndarray): replicates x days array of how often every day is used.
+    '''
+    block = max(1, int(block))
+    nb = -(-L // block)
+    if method == 'jackknife':
+        W = np.ones((nb, L))
+        W[np.arange(L)//block, np.arange(L)] = 0
+        return W
+    elif method != 'bootstrap':
+        raise ValueError("method should be 'bootstrap' or 'jackknife'")
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, L, size=(n, nb))
+    days = ((starts[:, :, None] + np.arange(block)) % L).reshape(n, -1)[:, :L]
+    W = np.bincount((np.arange(n)[:, None]*L + days).ravel(), minlength=n*L)
+    return W.reshape(n, L).astype(float)
+
+
+def resampled_dists(a, B, W, metric='Euclidean', handle_na='interpolate',
+                    chunk=64):
+    '''
+    Parameters
+    ----------
+
+    a (ndarray): the query series, one value per day.
+
+    B (ndarray): days x candidates array of observations.
+
+    W (ndarray): replicates x days weights, e.g. from ``resample_weights``.
+
+    metric {'Euclidean', 'L1', 'Linf', 'R2'}, handle_na: see ``dist``.
+
+    chunk (int): (default 64) replicates whose Linf distances are computed together.
+
+    Returns
+    ----------
+
+    D (ndarray): replicates x candidates array, D[r,j] is the distance between
+    ``a`` and B[:,j] using day t W[r,t] times. A row of ones gives ``dist``.
+
+    NOTE: Euclidean, L1 and R2 distances are weighted sums over days of a per
+    day term, so all replicates come from one matrix product of ``W`` with the
+    days x candidates terms (for R2 also with the mask of days used). Linf is a
+    max over the days used, taken for ``chunk`` replicates at a time. DTW
+    doesn't split into days, so it is not supported. With ``handle_na='fill'``
+    missing days are filled with the mean of ``a`` over all the days, not
+    over the resampled ones.
+    '''
+    if metric not in ('Euclidean', 'L1', 'Linf', 'R2'):
+        raise ValueError("metric should be one of 'Euclidean', 'L1', 'Linf' or 'R2'.")
+    a = _prepare(a, handle_na)[:, 0]
+    B = _prepare(B, handle_na)
+    W = np.asarray(W, dtype=float)
+    if handle_na == 'fill':
+        a_mean = np.nanmean(a) if np.any(~np.isnan(a)) else np.nan
+        a = np.where(np.isnan(a), a_mean, a)
+        B = np.where(np.isnan(B), a_mean, B)
+    diff = a[:, None] - B
+    # days each pair can use, NaN days only drop out with 'drop'
+    M = ~np.isnan(diff)
+    diff0 = np.where(M, diff, 0.)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if metric == 'Euclidean':
+            D = np.sqrt(W @ diff0**2)
+            if handle_na != 'drop':
+                D[:, ~M.all(axis=0)] = np.nan
+        elif metric == 'L1':
+            D = W @ np.abs(diff0)
+            if handle_na != 'drop':
+                D[:, ~M.all(axis=0)] = np.nan
+        elif metric == 'Linf':
+            absdiff = np.where(M, np.abs(diff), -np.inf)
+            if handle_na != 'drop':
+                absdiff[:, ~M.all(axis=0)] = np.nan
+            D = np.empty((len(W), B.shape[1]))
+            for r0 in range(0, len(W), chunk):
+                used = W[r0:r0+chunk, :, None] > 0
+                D[r0:r0+chunk] = np.max(np.where(used, absdiff[None], -np.inf), axis=1)
+            D[np.isneginf(D)] = np.nan
+        else:
+            Mf = M.astype(float)
+            a0 = np.where(np.isnan(a), 0., a - np.nanmean(a) if np.any(~np.isnan(a)) else 0.)
+            cnt = W @ Mf
+            ss_res = W @ diff0**2
+            ss_tot = W @ (Mf*a0[:, None]**2) - (W @ (Mf*a0[:, None]))**2/cnt
+            tiny = 1e-12*(W @ (Mf*a0[:, None]**2))
+            # sklearn convention for a constant ``a``
+            D = np.where(ss_tot <= tiny, (ss_res > tiny).astype(float),
+                         ss_res/ss_tot)
+            if handle_na != 'drop':
+                D[:, ~M.all(axis=0)] = np.nan
+            D[cnt < 2] = np.nan
+    return D
+
+
+@profiled('distance', items=lambda D: D.size)
+def feature_dist_mats(X, shift=False, metric='Euclidean', handle_na='interpolate',
+                      max_shift=7, band=7, dtype=float):
+    '''
+    Parameters
+    ----------
+
+    X (ndarray): features x days x years array of observations.
+
+    shift, metric, handle_na, max_shift, band:
+        see ``dist``.
+
+    dtype:
+        (default float) floating point type of the data and of ``D``.
+
+    Returns
+    ----------
+
+    D (ndarray): features x years x years array, D[f] equals ``dist_mat(X[f])``.
+
+    NOTE: missing values are handled for every (feature, year) series on its
+    own, so nothing bleeds across features. Unshifted Euclidean, L1 and Linf
+    distances are computed for all features at once, one row of years at a
+    time; other settings go through ``dist_mat`` feature by feature.
+    '''
+    X = np.asarray(X, dtype=dtype)
+    F, L, Y = X.shape
+    if shift or handle_na == 'fill' or metric not in ('Euclidean', 'L1', 'Linf'):
+        return np.stack([dist_mat(X[f], shift=shift, metric=metric,
+                                  handle_na=handle_na, max_shift=max_shift,
+                                  band=band, dtype=dtype) for f in range(F)])
+
+    # days x (feature, year) columns, so every series is prepared on its own
+    X = _prepare(X.transpose(1, 0, 2).reshape(L, F*Y), handle_na, dtype)
+    X = X.reshape(L, F, Y).transpose(1, 0, 2)
+    D = np.full((F, Y, Y), np.inf, dtype=dtype)
+    with warnings.catch_warnings():
+        # all-NaN pairs give NaN, as in ``dist``
+        warnings.simplefilter("ignore")
+        for i in range(Y):
+            diff = np.abs(X[:, :, i:i+1] - X[:, :, i:])
+            if metric == 'Euclidean':
+                d = np.sqrt(np.nansum(diff**2, axis=1) if handle_na == 'drop'
+                            else np.sum(diff**2, axis=1))
+            elif metric == 'L1':
+                d = (np.nansum(diff, axis=1) if handle_na == 'drop'
+                     else np.sum(diff, axis=1))
+            elif not L:
+                d = np.full((F, Y-i), np.nan)
+            else:
+                d = (np.nanmax(diff, axis=1) if handle_na == 'drop'
+                     else np.max(diff, axis=1))
+            D[:, i, i:] = np.where(np.isnan(d), np.inf, d)
+    iu = np.triu_indices(Y, 1)
+    D[:, iu[1], iu[0]] = D[:, iu[0], iu[1]]
+    return D
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import pandas as pd
+
+# the entries of a GRO selection that identify a data series
+ID_KEYS = ['item_id', 'metric_id', 'region_id', 'frequency_id', 'source_id']
+
+def series_key(arg_dict):
+    '''hash of the ids in a resolved GRO selection
+    '''
+    ids = {key: arg_dict.get(key) for key in ID_KEYS}
+    return hashlib.sha1(json.dumps(ids, sort_keys=True).encode()).hexdigest()
+
+class GroCache:
+    """on-disk cache of GRO data points.
+
+    Every data series is stored as a pickled DataFrame, keyed by the ids in
+    its resolved selection, next to a json file with the selection, the time
+    it was fetched and its last ``end_date``. We also remember which
+    selection each set of ``get_gro_data`` inputs resolved to, so cached
+    series can be found (e.g. in offline mode) without searching GRO.
+    """
+    def __init__(self, cache_dir, ttl = 86400):
+        """
+        Inputs:
+            ``cache_dir`` - directory to keep the cache in
+            ``ttl`` - number of seconds a cached series is fresh for
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        # series are fetched from several threads at once. Re-entrant, since
+        # ``update`` stores under it
+        self._lock = threading.RLock()
+
+    def _path(self, arg_dict, ext):
+        return os.path.join(self.cache_dir, series_key(arg_dict) + ext)
+
+    @staticmethod
+    def _replace(path, write):
+        # write next to ``path`` and rename over it, so other readers (and
+        # other processes sharing the directory) never see half a file
+        tmp_file = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        write(tmp_file)
+        os.replace(tmp_file, path)
+
+    @staticmethod
+    def _write_json(obj):
+        def write(path):
+            with open(path, 'w') as f:
+                json.dump(obj, f, default=str)
+        return write
+
+    def _read_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file) as f:
+            return json.load(f)
+
+    @staticmethod
+    def input_key(inputs):
+        """key for a dict of unresolved ``get_gro_data`` inputs
+        """
+        return json.dumps({k: inputs[k] for k in sorted(inputs)}, default=str)
+
+    def resolve(self, inputs):
+        """the selection ``inputs`` resolved to last time, or None
+        """
+        return self._read_index().get(self.input_key(inputs))
+
+    def remember(self, inputs, arg_dict):
+        """records that ``inputs`` resolved to the selection ``arg_dict``
+        """
+        with self._lock:
+            index = self._read_index()
+            index[self.input_key(inputs)] = arg_dict
+            self._replace(self.index_file, self._write_json(index))
+
+    def meta(self, arg_dict):
+        """metadata of a cached series, or None if it isn't cached
+        """
+        path = self._path(arg_dict, '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def is_fresh(self, arg_dict):
+        meta = self.meta(arg_dict)
+        return meta is not None and time.time() - meta['fetched_at'] < self.ttl
+
+    def load(self, arg_dict):
+        """cached data points of a series, or None if it isn't cached
+        """
+        if self.meta(arg_dict) is None:
+            return None
+        return pd.read_pickle(self._path(arg_dict, '.pkl'))
+
+    def store(self, arg_dict, df):
+        """replaces the cached data points of a series
+        """
+        df = df.reset_index(drop=True)
+        last = None
+        if 'end_date' in df.columns and len(df):
+            last = str(pd.to_datetime(df['end_date']).max().date())
+        meta = {'arg_dict': arg_dict, 'fetched_at': time.time(),
+                'last_end_date': last}
+        with self._lock:
+            self._replace(self._path(arg_dict, '.pkl'), df.to_pickle)
+            self._replace(self._path(arg_dict, '.json'), self._write_json(meta))
+
+    def update(self, arg_dict, new_df):
+        """adds newly fetched points to a cached series. Points for dates we
+        already have replace the old ones, since GRO may revise them.
+        """
+        # under the lock, so two updates of a series don't lose each other's
+        # points
+        with self._lock:
+            old_df = self.load(arg_dict)
+            if old_df is None or not len(old_df):
+                df = new_df
+            elif not len(new_df):
+                df = old_df
+            else:
+                new_dates = set(pd.to_datetime(new_df['end_date']))
+                old_df = old_df[~pd.to_datetime(old_df['end_date']).isin(new_dates)]
+                df = pd.concat([old_df, new_df], ignore_index=True)
+                df = df.iloc[pd.to_datetime(df['end_date']).argsort(kind='stable')]
+            self.store(arg_dict, df)
+        return df.reset_index(drop=True)
+
+class FakeGroClient:
+    """stand-in for ``GroClient`` that serves data points from memory, so
+    ``get_gro_data`` can be run without a token or network.
+    """
+    def __init__(self, points, entities = None):
+        """
+        Inputs:
+            ``points`` - list of data points (dicts with ``end_date`` and
+                         ``value``) returned for every series, or a dict
+                         mapping ``region_id`` to such a list
+            ``entities`` - (default None) dict mapping (kind, name), e.g.
+                           ('regions', 'Nanjing'), to ids. Unknown names get
+                           a new id.
+        """
+        self.points = points
+        self.entities = dict(entities) if entities else {}
+        self.calls = []
+
+    def search_for_entity(self, kind, name):
+        self.calls.append(('search_for_entity', kind, name))
+        if (kind, name) not in self.entities:
+            self.entities[(kind, name)] = len(self.entities) + 1
+        return self.entities[(kind, name)]
+
+    def get_data_series(self, **selection):
+        self.calls.append(('get_data_series', selection))
+        return [dict(selection)]
+
+    def get_data_points(self, **selection):
+        self.calls.append(('get_data_points', selection))
+        points = self.points
+        if isinstance(points, dict):
+            points = points[selection.get('region_id')]
+        start = selection.get('start_date')
+        if start:
+            start = pd.to_datetime(start, utc=True)
+            points = [p for p in points
+                      if pd.to_datetime(p['end_date'], utc=True) >= start]
+        return [dict(p) for p in points]
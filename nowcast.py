@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+"""
+
+import numpy as np
+
+class Nowcast:
+    """analog years of a season still in progress, kept up to date as daily
+    observations arrive.
+
+    Instead of re-running ``get_sorted_years`` with ``end_day`` set to the
+    latest day, every historical year keeps running sums over the days seen
+    so far (overlap count, sums of the current year and of its squares, sum of
+    squared or absolute differences, largest difference). A new or revised
+    observation only changes the sums of the days it touches, so an update
+    costs O(years) and the ranking is read from the sums in O(years).
+
+    Example:
+        nc = Nowcast(df, 2019)           # df as for ``get_sorted_years``
+        nc.update(152, 24.3)             # today's value
+        nc.update(140, 21.0)             # a revision of an earlier day
+        nc.sorted_years(k=5)
+    """
+    def __init__(self, df, year = None, years = None, start_day = 1,
+                 similarity = 'Euclidean', handle_na = 'interpolate',
+                 min_overlap = 0):
+        """
+        Inputs:
+            ``df`` - DataFrame of preprocessed GRO data, as for
+                     ``get_sorted_years``
+            ``year`` - (default None) column of ``df`` holding the current
+                       season. Its observed values seed the nowcast
+            ``years`` - (default all other years in ``df``) years to compare to
+            ``start_day`` - (default 1) first day of the comparison period
+            ``similarity`` - (default Euclidean) one of Euclidean, L1, Linf or
+                             R2. DTW and shifted distances change for every
+                             day when a day is added, so they are not supported
+            ``handle_na`` - (default interpolate) ``interpolate`` fills the
+                            gaps of the current season linearly between the
+                            observed days (and back-fills before the first
+                            one), ``drop`` only compares observed days.
+                            Missing historical values are interpolated once
+                            over the whole season either way
+            ``min_overlap`` - (default 0) years sharing fewer days with the
+                              current season get an infinite score
+        """
+        if similarity not in ('Euclidean', 'L1', 'Linf', 'R2'):
+            raise ValueError("``similarity`` should be one of 'Euclidean', 'L1', 'Linf' or 'R2'")
+        if handle_na not in ('interpolate', 'drop'):
+            raise ValueError("``handle_na`` should be 'interpolate' or 'drop'")
+        self.similarity = similarity
+        self.handle_na = handle_na
+        self.min_overlap = min_overlap
+
+        # Sometimes the first column contains feature names
+        yr_ind = 2 if df.columns[0] == 'feature' else 1
+        df = df[df['day'] >= start_day]
+        if years is None:
+            years = [y for y in df.columns[yr_ind:] if y != year]
+        self.year = year
+        self.years = list(years)
+        self.days = [int(d) for d in df['day']]
+        self._day_ind = {d: i for i, d in enumerate(self.days)}
+
+        H = df[self.years].values.astype(float)
+        if handle_na == 'interpolate':
+            # the same as ``dist_mat`` does once per column
+            from distance_fn import _prepare
+            H = _prepare(H, 'interpolate')
+        # work relative to the mean, so the sums don't lose precision for data
+        # far from zero
+        self._center = np.nanmean(H) if (~np.isnan(H)).any() else 0.
+        self._valid = ~np.isnan(H)
+        self._H = np.where(self._valid, H - self._center, 0.)
+
+        # raw observations of the current season, and the values that take
+        # part in the sums (interpolated, NaN past the last observation)
+        self._obs = np.full(len(self.days), np.nan)
+        self._used = np.full(len(self.days), np.nan)
+        if year is not None:
+            self._obs[:] = df[year].values.astype(float) - self._center
+        self.recompute()
+
+    def recompute(self):
+        """rebuilds the running sums from the observations. Updates never need
+        this, but it removes any rounding error accumulated over a long season.
+        """
+        n = len(self.years)
+        self._cnt = np.zeros(n)
+        self._sum = np.zeros(n)
+        self._sum_sq = np.zeros(n)
+        self._res = np.zeros(n)
+        self._max = np.full(n, -np.inf)
+        self._used[:] = np.nan
+        obs = np.flatnonzero(~np.isnan(self._obs))
+        if len(obs):
+            self._refill(0, obs[-1])
+
+    def _apply(self, rows, values, sign):
+        """adds (``sign`` 1) or removes (-1) ``values`` of the current season
+        on ``rows`` from the sums of every year
+        """
+        keep = ~np.isnan(values)
+        rows, values = rows[keep], values[keep]
+        if not len(rows):
+            return
+        V = self._valid[rows]
+        x = values[:, None]
+        diff = np.where(V, np.abs(x - self._H[rows]), 0.)
+        self._cnt += sign*V.sum(axis = 0)
+        self._sum += sign*(V*x).sum(axis = 0)
+        self._sum_sq += sign*(V*x**2).sum(axis = 0)
+        if self.similarity == 'L1':
+            self._res += sign*diff.sum(axis = 0)
+        elif self.similarity == 'Linf':
+            diff = np.where(V, diff, -np.inf).max(axis = 0)
+            if sign > 0:
+                self._max = np.maximum(self._max, diff)
+            else:
+                # only the years whose largest difference was removed need to
+                # look at their other days again
+                self._stale |= diff >= self._max
+        else:
+            self._res += sign*(diff**2).sum(axis = 0)
+
+    def _refill(self, lo, hi):
+        """recomputes the values of the current season taking part in the sums
+        on rows ``lo`` to ``hi``, and updates the sums with the change
+        """
+        rows = np.arange(lo, hi + 1)
+        new = self._obs[lo:hi + 1].copy()
+        seen = np.flatnonzero(~np.isnan(self._obs))
+        last = seen[-1] if len(seen) else -1
+        if self.handle_na == 'interpolate' and len(seen):
+            # the neighbours of the gaps are inside the span, see ``update``
+            known = np.flatnonzero(~np.isnan(new))
+            if len(known):
+                new = np.interp(rows, rows[known], new[known])
+            new[rows > last] = np.nan
+
+        old = self._used[lo:hi + 1]
+        changed = ~((old == new) | (np.isnan(old) & np.isnan(new)))
+        if not changed.any():
+            return
+        self._stale = np.zeros(len(self.years), dtype=bool)
+        self._apply(rows[changed], old[changed], -1)
+        self._used[lo:hi + 1] = new
+        self._apply(rows[changed], new[changed], 1)
+        if self.similarity == 'Linf' and self._stale.any():
+            cols = np.flatnonzero(self._stale)
+            used = np.flatnonzero(~np.isnan(self._used))
+            diff = np.abs(self._used[used, None] - self._H[np.ix_(used, cols)])
+            diff = np.where(self._valid[np.ix_(used, cols)], diff, -np.inf)
+            self._max[cols] = diff.max(axis = 0) if len(used) else -np.inf
+
+    def update(self, day, value):
+        """sets the current season's value on ``day``, which is either a new
+        day or a revision of a day already seen. A NaN ``value`` withdraws the
+        observation.
+
+        Inputs:
+            ``day`` - day of the observation, one of the days of ``df``
+            ``value`` - the observation, preprocessed like ``df``
+        """
+        if day not in self._day_ind:
+            raise ValueError('day ' + str(day) + ' is not in the nowcast period')
+        i = self._day_ind[day]
+        value = float(value) - self._center
+        if value == self._obs[i] or (np.isnan(value) and np.isnan(self._obs[i])):
+            return
+        self._obs[i] = value
+        if self.handle_na == 'drop':
+            self._refill(i, i)
+            return
+        # with interpolation, the rows between the closest observations on
+        # either side depend on this one. Without a later observation, the
+        # season now ends at (or before) this row
+        seen = np.flatnonzero(~np.isnan(self._obs))
+        before = seen[seen < i]
+        after = seen[seen > i]
+        lo = before[-1] if len(before) else 0
+        hi = after[0] if len(after) else i
+        self._refill(lo, hi)
+
+    def update_many(self, values):
+        """``update`` for every day -> value of ``values`` (a dict or a Series
+        indexed by day)
+        """
+        for day, value in dict(values).items():
+            self.update(day, value)
+
+    @property
+    def end_day(self):
+        """last observed day of the current season, None before the first one
+        """
+        seen = np.flatnonzero(~np.isnan(self._obs))
+        return self.days[seen[-1]] if len(seen) else None
+
+    def scores(self):
+        """distance from the current season (up to ``end_day``) to every year
+        of ``years``, the same as the distances of ``get_sorted_years`` with
+        that ``end_day`` up to rounding. Years sharing no day with the current
+        season get NaN.
+
+        NOTE - with ``interpolate``, a historical gap running past ``end_day``
+        is filled from the days after it rather than forward-filled, since the
+        historical years are interpolated over the whole season.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.similarity == 'Euclidean':
+                d = np.sqrt(np.maximum(self._res, 0))
+            elif self.similarity == 'L1':
+                d = np.maximum(self._res, 0)
+            elif self.similarity == 'Linf':
+                d = self._max.copy()
+            else:
+                ss_res = np.maximum(self._res, 0)
+                ss_tot = np.maximum(self._sum_sq - self._sum**2/self._cnt, 0)
+                # what is left of an exact zero after rounding
+                tiny = 1e-10*self._sum_sq
+                # sklearn convention for a constant current season
+                d = np.where(ss_tot <= tiny, (ss_res > tiny).astype(float),
+                             ss_res/ss_tot)
+                d[self._cnt < 2] = np.nan
+        cnt = np.rint(self._cnt)
+        d[cnt == 0] = np.nan
+        if self.min_overlap:
+            d[cnt < self.min_overlap] = np.inf
+        return d
+
+    def sorted_years(self, k = None):
+        """years most similar to the current season so far
+
+        Inputs:
+            ``k`` - (default None) if given, only the ``k`` most similar years,
+                    picked without sorting the others
+        Outputs:
+            a list of tuples of the form (similarity_to_current_season, year),
+            like ``get_sorted_years``, with NaN scores last
+        """
+        d = self.scores()
+        key = np.where(np.isnan(d), np.inf, d)
+        if k is not None and k < len(d):
+            inds = np.argpartition(key, k - 1)[:k]
+        else:
+            inds = np.arange(len(d))
+        inds = inds[np.argsort(key[inds], kind='stable')]
+        return [(d[i], self.years[i]) for i in inds]
@@ -10,23 +10,119 @@ non-commercial applications. However, we retain the right to use this code or
 parts of this code for any purpose.
 """
 
-from sklearn.manifold import Isomap
-from sklearn.manifold import TSNE
-from sklearn.decomposition import PCA
+import os
+import json
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from result_cache import ResultCache, hash_data
+from distance_fn import square_mat
 
+# 2d embeddings already computed, by data and parameters
+embedding_cache = ResultCache(max_bytes = 64*2**20)
 
-import matplotlib.pyplot as plt
+def _mds(D):
+    '''classical (Torgerson) MDS: the 2d coordinates whose Euclidean distances
+    best match ``D``. On Euclidean distances of the raw data this is PCA.
+    '''
+    n = len(D)
+    J = np.eye(n) - 1/n
+    B = -J @ (D**2) @ J/2
+    vals, vecs = np.linalg.eigh(B)
+    top = np.argsort(vals)[::-1][:2]
+    return vecs[:, top]*np.sqrt(np.maximum(vals[top], 0))
+
+def embed(D = None, method = 'MDS', X = None, random_state = 0):
+    '''
+    2d coordinates of every year, from a distance matrix or from the data
+
+    Input:
+    D: years x years distance matrix, e.g. from ``get_mat`` (condensed is fine).
+    method {"MDS","PCA","TSNE","ISOMAP"}: with ``D``, TSNE and ISOMAP use the
+    distances directly and MDS/PCA is classical MDS. Without ``D`` they are fit
+    on the rows of ``X``.
+    X: years x days array, only used if ``D`` is None.
+    random_state: seed for TSNE.
+
+    Embeddings are cached in ``embedding_cache`` by a hash of the data and
+    the parameters, so re-plotting the same data is instant.
+    '''
+    data = X if D is None else D
+    key = hash_data(np.asarray(data, dtype=float)) + json.dumps(
+        [D is None, method, random_state])
+    Y = embedding_cache.get(key)
+    if Y is not None:
+        return Y
+
+    # sklearn is slow to import, so only load it here
+    from sklearn.manifold import Isomap
+    from sklearn.manifold import TSNE
+    from sklearn.decomposition import PCA
+    if D is not None:
+        D = np.asarray(D, dtype=float)
+        if D.ndim == 1:
+            D = square_mat(D)
+        # R2 scores aren't symmetric, and missing data gives infinite scores
+        D = (D + D.T)/2
+        finite = np.isfinite(D)
+        D[~finite] = 2*np.max(D[finite]) if finite.any() else 1.
+        np.fill_diagonal(D, 0)
+        n = len(D)
+        if method in ('MDS', 'PCA'):
+            Y = _mds(D)
+        elif method == 'TSNE':
+            Y = TSNE(n_components=2, perplexity=min(15, n - 1), metric='precomputed',
+                     init='random', random_state=random_state).fit_transform(D)
+        elif method == 'ISOMAP':
+            Y = Isomap(n_neighbors=min(3, n - 1), n_components=2,
+                       metric='precomputed').fit_transform(D)
+        else:
+            raise ValueError('method must be one of MDS, PCA, TSNE or ISOMAP')
+    else:
+        if method in ('MDS', 'PCA'):
+            plot_method = PCA(n_components=2)
+        elif method == 'TSNE':
+            plot_method = TSNE(n_components=2, perplexity=15,
+                               random_state=random_state)
+        elif method == 'ISOMAP':
+            plot_method = Isomap(n_neighbors = 3, n_components= 2)
+        else:
+            raise ValueError('method must be one of MDS, PCA, TSNE or ISOMAP')
+        Y = plot_method.fit_transform(X)
+    embedding_cache.put(key, Y)
+    return Y
+
+def _background(ax, x, Y, **style):
+    '''draws every column of ``Y`` against ``x`` as a single LineCollection,
+    much faster than one ``plot`` call per year
+    '''
+    Y = np.asarray(Y, dtype=float)
+    if not Y.size:
+        return None
+    segments = np.stack([np.broadcast_to(np.asarray(x, dtype=float)[:, None], Y.shape),
+                         Y], axis=-1).transpose(1, 0, 2)
+    lines = LineCollection(segments, **style)
+    ax.add_collection(lines)
+    ax.autoscale_view()
+    return lines
 
-def plot_side(X, special_years, method, legend=True, **kwpar):
+def plot_side(X, special_years, method, legend=True, D=None, **kwpar):
     '''
     Input: 
     X: the dataframe to be ploted, presumbably a 365*20 dataframe
     
     special years: list of year to be highlighted, presumbably contains only 2 years.
     
-    method {"PCA","TSNE","ISOMAP"}: method to use for dimensionality reduction.
+    method {"PCA","TSNE","ISOMAP","MDS"}: method to use for dimensionality reduction.
+
+    D: (default None) the distance matrix of the years, or the (matrix, years)
+    pair returned by ``get_mat``. If given, the 2d plot shows these distances
+    (so the similarity measure used for them) instead of Euclidean distances
+    of the raw data. See ``embed``.
     
     **kwpar: parameters used to control figure size, and set up axis labels, etc.
+    ``title`` replaces the figure title, and ``similarity`` names the distances
+    in the MDS title.
     
     plots on the left the line chart, on the right the 2d plot of the original data after the dimensionality
     reduction
@@ -55,12 +151,12 @@ def plot_side(X, special_years, method, legend=True, **kwpar):
     years = X.columns[2:]
     sp_color= iter(["black", "red"])
     
-    #plotting the line chart for time series.
+    #plotting the line chart for time series, the other years all at once.
+    _background(ax[0], X.index, X[[y for y in years if y not in special_years]],
+                color='lightgrey', linestyle='dashed', alpha=0.3)
     for year in years:
         if year in special_years:
             ax[0].plot(X[year], label=year, color=next(sp_color),linewidth = 2)
-        else:
-            ax[0].plot(X[year], label='_nolegend_', color='lightgrey', linestyle='dashed',alpha=0.3,)
 
     ax[0].set_xlabel(x_label, fontsize=14)
     ax[0].set_ylabel(y_label, fontsize=14)
@@ -69,20 +165,34 @@ def plot_side(X, special_years, method, legend=True, **kwpar):
 
     #plotting 2d visualization using preferred dimensionally reduction methods, probably should add titles for other use case, but for now I know I only generate those
     #three charts...
-    if method == 'PCA':
-        plot_method = PCA(n_components=2)
+    if 'title' in kwpar:
+        fig.suptitle(kwpar['title'], fontsize=25)
+
+    elif method == 'PCA':
         fig.suptitle('Weekly Temperature Comparison Using Euclidean Distance and PCA', fontsize=25)
 
     elif method == 'TSNE':
-        plot_method = TSNE(n_components=2,perplexity=15)
         fig.suptitle('Weekly Rainfall Comparison Using R-squared and TSNE', fontsize=25)
 
     elif method == 'ISOMAP':
-        plot_method = Isomap(n_neighbors = 3, n_components= 2)
         fig.suptitle('NDVI Comparison Using $L^{\infty}$ Distance and ISOMAP', fontsize=25)
 
-    
-    Y = plot_method.fit_transform(X[years].T)
+    elif method == 'MDS':
+        # MDS is only used on the distances in ``D``, whatever measure they are
+        similarity = kwpar.get('similarity')
+        fig.suptitle('Comparison Using MDS of ' +
+                     (similarity + ' ' if similarity else '') + 'Distances',
+                     fontsize=25)
+
+    if D is None:
+        Y = embed(method=method, X=X[years].T.values)
+    else:
+        if isinstance(D, tuple):
+            # only the years the matrix was computed for
+            D, years = D
+        if len(D) != len(years) and np.ndim(D) == 2:
+            raise ValueError('``D`` must have a row for every year')
+        Y = embed(D, method)
     sp_color_2= iter(["black", "red"])
     ax[1].scatter(Y[:, 0], Y[:, 1])
     for i,year in enumerate(years):
@@ -131,23 +241,23 @@ def plot_compare(X, Y, special_year, legend=True, **titles):
     years = X.columns[2:]
     sp_color= iter(["black", "red"])
     
-    #plotting the line chart for time series.
+    #plotting the line chart for time series, the other years all at once.
+    _background(ax[0], X.index, X[[y for y in years if y not in special_year]],
+                color='lightgrey', linestyle='dashed', alpha=0.3)
     for year in years:
         if year in special_year:
             ax[0].plot(X[year], label=year, color=next(sp_color),linewidth = 2)
-        else:
-            ax[0].plot(X[year], label='_nolegend_', color='lightgrey', linestyle='dashed',alpha=0.3,)
 
     ax[0].set_xlabel(x_label, fontsize=14)
     ax[0].set_ylabel(y_label, fontsize=14)
     
     sp_color= iter(["black", "red"])
     #plotting the line chart for time series.
+    _background(ax[1], Y.index, Y[[y for y in years if y not in special_year]],
+                color='lightgrey', linestyle='dashed', alpha=0.3)
     for year in years:
         if year in special_year:
             ax[1].plot(Y[year], label=year, color=next(sp_color),linewidth = 2)
-        else:
-            ax[1].plot(Y[year], label='_nolegend_', color='lightgrey', linestyle='dashed',alpha=0.3,)
 
     ax[1].set_xlabel(x_label, fontsize=14)
     ax[1].set_ylabel(y_label, fontsize=14)
@@ -158,17 +268,104 @@ def plot_compare(X, Y, special_year, legend=True, **titles):
     ax[1].set_title(T2)
     fig.tight_layout(rect=[0, 0.03, 1, 0.95])
     
-def plot_similar_yrs(df, year=2019, n=5, shift=False, feat=None, similarity='Euclidean'):
-    '''plots years similar to ``year``
-    '''
-    L = get_sorted_years(year, df, similarity=similarity, shift=shift)[:n]
-    for yr in L:
-        plt.plot(df[['day']],df[yr[1]], label=yr[1])
-    plt.xlabel('day')
-    plt.ylabel(feat)
+def _ranked_years(ranking):
+    # ``get_sorted_years`` gives (score, year) pairs, but plain years work too
+    return [r[1] if isinstance(r, (tuple, list)) else r for r in ranking]
+
+def _draw_similar(ax, df, years, title, feat=None):
+    for yr in years:
+        ax.plot(df['day'], df[yr], label=yr)
+    ax.set_xlabel('day')
+    ax.set_ylabel(feat)
+    ax.set_title(title)
+    ax.legend()
+
+def _similar_title(similarity, shift):
     if not shift:
-        plt.title('Similar Years - ' + similarity + ' similarity ')
-    else:
-        plt.title('Similar Years - shifted ' + similarity + ' similarity ')
-    plt.legend()
-    plt.show()
\ No newline at end of file
+        return 'Similar Years - ' + similarity + ' similarity '
+    return 'Similar Years - shifted ' + similarity + ' similarity '
+
+def plot_similar_yrs(df, year=2019, n=5, shift=False, feat=None, similarity='Euclidean',
+                     ranking=None, ax=None):
+    '''plots years similar to ``year``. ``ranking`` is the output of
+    ``get_sorted_years`` if it was already computed, and ``ax`` the axes to
+    draw on (by default a new pyplot figure, which is shown).
+    '''
+    if ranking is None:
+        from year_score_comp import get_sorted_years
+        ranking = get_sorted_years(year, df, similarity=similarity, shift=shift, k=n)
+    years = _ranked_years(ranking)[:n]
+    if ax is not None:
+        _draw_similar(ax, df, years, _similar_title(similarity, shift), feat)
+        return
+    _draw_similar(plt.gca(), df, years, _similar_title(similarity, shift), feat)
+    plt.show()
+
+# figure reused by every report drawn in this process
+_report_fig = None
+
+def _init_renderer(figsize, dpi):
+    global _report_fig
+    # a bare Agg figure, so no pyplot state or display is involved
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    _report_fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(_report_fig)
+    _report_fig.add_subplot(111)
+
+def _render_report(args):
+    job, out_dir, fmt = args
+    df, year = job['df'], job['year']
+    similarity = job.get('similarity', 'Euclidean')
+    shift = job.get('shift', False)
+    analogs = [y for y in _ranked_years(job['ranking']) if y != year]
+    analogs = analogs[:job.get('n', len(analogs))]
+
+    ax = _report_fig.axes[0]
+    ax.cla()
+    years = [y for y in df.columns if y not in ('day', 'feature')]
+    _background(ax, df['day'], df[[y for y in years
+                                   if y != year and y not in analogs]],
+                color='lightgrey', linewidth=0.8, alpha=0.5)
+    if year in df.columns:
+        ax.plot(df['day'], df[year], label=year, color='black', linewidth=2)
+    title = job.get('title', _similar_title(similarity, shift) + 'to ' + str(year))
+    _draw_similar(ax, df, analogs, title, job.get('feat'))
+
+    path = os.path.join(out_dir, str(job.get('name', year)) + '.' + fmt)
+    _report_fig.savefig(path, format=fmt)
+    return path
+
+def render_similar_yrs(jobs, out_dir, fmt='png', processes=None, figsize=(8, 5),
+                       dpi=100):
+    '''
+    Input:
+    jobs: list of dicts, one per image, with
+        df: preprocessed data (day, yr1, yr2, ...)
+        year: the year the others are compared to
+        ranking: ``get_sorted_years`` output, or a list of years, most similar first
+        and optionally n (analogs to draw), name (file name, default the year),
+        title, feat (y axis label), similarity and shift (for the title).
+
+    out_dir: directory the images are written to.
+
+    fmt {"png","svg"}: image format.
+
+    processes: worker processes, by default the number of CPUs. 1 draws in
+    this process.
+
+    Renders analog reports without pyplot: every worker draws all its reports
+    on one reused Agg figure, the years that aren't highlighted are a single
+    LineCollection, and the rankings are not recomputed.
+
+    Returns the paths of the images, in the order of ``jobs``.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    args = [(job, out_dir, fmt) for job in jobs]
+    if processes == 1:
+        _init_renderer(figsize, dpi)
+        return [_render_report(a) for a in args]
+    from multiprocessing import Pool
+    with Pool(processes, initializer=_init_renderer,
+              initargs=(figsize, dpi)) as pool:
+        return pool.map(_render_report, args, chunksize=max(1, len(args)//64))
@@ -10,10 +10,16 @@ non-commercial applications. However, we retain the right to use this code or
 parts of this code for any purpose.
 """
 
+import time
+import json
+import threading
 import numpy as np
 import pandas as pd
-from api.client.gro_client import GroClient
+from concurrent.futures import ThreadPoolExecutor, Future
 from win_iter import smooth_windows
+from gro_cache import GroCache
+from cube_store import CubeStore
+from profiling import profiled
 
 def combine_series(L, names, to_file = None):
     '''Combines a list of preprocessed data series.
@@ -40,10 +46,11 @@ def combine_series(L, names, to_file = None):
     else:
         return ret_df
 
+@profiled('preprocess', items=lambda df: None if df is None else df.shape[1]-1)
 def preprocess(df, to_file = None,
                years = False, leapyear = None,
                standardization = None, handle_na = None,
-               start_day = 1, end_day = 366):
+               start_day = 1, end_day = 366, dtype = float):
     '''preprocess the dataframe so that rows represent Julian days and columns 
     represent observations in each year
     
@@ -62,13 +69,15 @@ def preprocess(df, to_file = None,
                                         years, and will interpolate for day 366.
         start_day(int) -- start day
         end_day(int) -- ending day
+        dtype -- (default float) type of the values, ``np.float32`` halves
+                 the memory used
     '''
     # some dates are strings...
     df['end_date'] = pd.to_datetime(df['end_date'])
     # add columns for year, Julian day
-    df['year'] = [d.year for d in df['end_date']]
-    #df['month'] = [d.month for d in df['end_date']]
-    df['day'] = [d.dayofyear for d in df['end_date']]
+    df['year'] = df['end_date'].dt.year.values
+    #df['month'] = df['end_date'].dt.month.values
+    df['day'] = df['end_date'].dt.dayofyear.values
   
     # build the dataframe to return
     # there may be a slight problem with leap years... 
@@ -78,31 +87,26 @@ def preprocess(df, to_file = None,
         years = np.unique(df['year'])
     
     if leapyear:
-        A = np.zeros((365,len(years)))
+        A = np.full((365,len(years)), np.nan, dtype=dtype)
     else:
-        A = np.zeros((366,len(years)))
-    A[:] = np.nan
+        A = np.full((366,len(years)), np.nan, dtype=dtype)
     
-    for j in range(len(years)):
-        year = years[j]
-        #if leapyear:
-        #    A = np.zeros(365)
-        #else:
-        #    A = np.zeros(366)
+    # row and column of every observation, so we can fill A in one go
+    yr = df['year'].values
+    day = df['day'].values
+    col = pd.Index(years).get_indexer(yr)
+    row = day - 1
+    keep = col >= 0
+    if leapyear:
+        # in leap years, drop ``leapyear`` and move later days up by one
+        is_leap = (yr % 4) == 0
+        keep &= ~(is_leap & (day == leapyear))
+        row = np.where(is_leap & (day > leapyear), day - 2, row)
 
-        #A[:] = np.nan
-        yr_df = df[df['year'] == year]
-        for i in range(yr_df.shape[0]):
-            row = yr_df.iloc[i]
-            # checks if leap year
-            if leapyear and not year%4:
-                # fill in normally here
-                if row['day'] < leapyear:
-                    A[row['day']-1,j] = row['value']
-                elif row['day'] > leapyear:
-                    A[row['day']-2,j] = row['value']
-            else:
-                A[row['day']-1,j] = row['value']
+    # if a day shows up twice, the last observation wins
+    idx = pd.DataFrame({'row': row[keep], 'col': col[keep]})
+    last = ~idx.duplicated(keep='last').values
+    A[row[keep][last], col[keep][last]] = df['value'].values[keep][last]
         
     if standardization == 'zscore':
         m = np.mean(A[np.logical_not(np.isnan(A))])
@@ -120,8 +124,7 @@ def preprocess(df, to_file = None,
     else:
         ret_df = pd.DataFrame({'day':range(1,367)})
 
-    for i in range(len(years)):
-        ret_df[years[i]] = A[:,i]
+    ret_df = pd.concat([ret_df, pd.DataFrame(A, columns=years)], axis=1)
         
     # fill in missing values
     if handle_na == 'interpolate':
@@ -133,11 +136,55 @@ def preprocess(df, to_file = None,
     else:
         return ret_df
 
+def _gro_client(host, gro_token):
+    # the API client is only imported once we talk to GRO, so cached and
+    # offline runs don't pay for it
+    from api.client.gro_client import GroClient
+    return GroClient(host, gro_token)
+
+# entity ids we already looked up (as futures, so a lookup running in one
+# thread is waited for by the others), shared by every call and thread
+_entity_ids = {}
+_entity_lock = threading.Lock()
+
+def _client_scope(client):
+    # ids are only shared between clients of the same API host. Clients
+    # without one (e.g. ``FakeGroClient``) only share them with themselves,
+    # and are kept alive by the key so their id can't be reused
+    host = getattr(client, 'api_host', None)
+    if host is not None:
+        return (type(client).__name__, host)
+    return client
+
+def search_for_entity(client, search, name):
+    '''``client.search_for_entity``, but every (search, name) pair is only
+    looked up once per session and API host, even by concurrent threads
+    '''
+    key = (_client_scope(client), search, name)
+    with _entity_lock:
+        future = _entity_ids.get(key)
+        owner = future is None
+        if owner:
+            future = _entity_ids[key] = Future()
+    if not owner:
+        return future.result()
+    try:
+        future.set_result(client.search_for_entity(search, name))
+    except Exception as e:
+        # let the next call try again, but fail the ones waiting on us
+        with _entity_lock:
+            del _entity_ids[key]
+        future.set_exception(e)
+    return future.result()
+
+@profiled('fetch', items=lambda ret: len(ret[0]) if isinstance(ret, tuple) else len(ret))
 def get_gro_data(gro_token = None, item = None, 
             region = None, source = None, 
             similarity = 'Euclidean',
             host = 'api.gro-intelligence.com',
-            frequency = 1, metric = None, ret_args = False, **kwargs):
+            frequency = 1, metric = None, ret_args = False,
+            cache = None, cache_ttl = 86400, offline = False,
+            client = None, **kwargs):
     '''
     returns GRO data series as a DataFrame
     
@@ -148,12 +195,40 @@ def get_gro_data(gro_token = None, item = None,
         source (string or int) -- source of data on ``item`` in ``region``
         frequency (string or int) -- (default 1) frequency of observations
         metric (string or int) -- how to measure ``item``
+        cache (GroCache or string) -- (default None) cache, or directory of
+                                      the cache, to keep data points in
+        cache_ttl (int) -- (default 86400) seconds a cached series is used
+                           without asking GRO for newer points, if ``cache``
+                           is a directory
+        offline (boolean) -- (default False) if True, only use the cache
+        client (GroClient) -- (default None) client to use, e.g. a
+                              ``FakeGroClient`` for tests
         
     Outputs::
         DataFrame
     '''
+    if isinstance(cache, str):
+        cache = GroCache(cache, ttl = cache_ttl)
+    if offline and cache is None:
+        raise ValueError('offline mode needs a cache')
+
+    inputs = {'item': item, 'metric': metric, 'region': region,
+              'frequency': frequency, 'source': source}
+
+    # serve fresh (or, offline, any) cached data without talking to GRO
+    if cache is not None:
+        arg_dict = cache.resolve(inputs)
+        if arg_dict is not None and (offline or cache.is_fresh(arg_dict)):
+            df = cache.load(arg_dict)
+            if ret_args:
+                return df, arg_dict
+            return df
+        if offline:
+            raise ValueError('series ' + str(inputs) + ' is not in the cache')
+
     # initialize client
-    client = GroClient(host, gro_token)
+    if client is None:
+        client = _gro_client(host, gro_token)
 
     keys = ['item_id', 'metric_id', 'region_id', 'frequency_id', 'source_id']
     var_list = [item, metric, region, frequency, source]
@@ -169,7 +244,7 @@ def get_gro_data(gro_token = None, item = None,
             search = search_names[i]
             
             if isinstance(var, str):
-                arg_dict[key] = client.search_for_entity(search, var)
+                arg_dict[key] = search_for_entity(client, search, var)
             elif isinstance(var, int):
                 arg_dict[key] = var
             else:
@@ -181,86 +256,152 @@ def get_gro_data(gro_token = None, item = None,
     arg_dict = client.get_data_series(**arg_dict)[0]
     
     # get data from gro
+    if cache is None:
+        df = pd.DataFrame(client.get_data_points(**arg_dict))
+    else:
+        # only ask for points since the last one we have
+        cache.remember(inputs, arg_dict)
+        meta = cache.meta(arg_dict)
+        selection = dict(arg_dict)
+        if meta is not None and meta['last_end_date']:
+            selection['start_date'] = meta['last_end_date']
+        df = cache.update(arg_dict,
+                          pd.DataFrame(client.get_data_points(**selection)))
+
     if ret_args:
-        return pd.DataFrame(client.get_data_points(**arg_dict)), arg_dict
-    return pd.DataFrame(client.get_data_points(**arg_dict))
+        return df, arg_dict
+    return df
+
+def get_gro_data_many(specs, gro_token = None,
+                      host = 'api.gro-intelligence.com', client = None,
+                      max_workers = 8, retries = 3, backoff = 1., **kwargs):
+    '''
+    fetches many GRO data series concurrently
+    
+    Inputs::
+        specs (list of dicts) -- ``get_gro_data`` inputs (item, region, etc.)
+                                 for every series
+        gro_token (string) -- token for GRO account
+        host (string) -- GRO API host
+        client (GroClient) -- (default None) client to share between requests,
+                              by default a new one
+        max_workers (int) -- (default 8) most requests running at once
+        retries (int) -- (default 3) times to retry a failed series
+        backoff (float) -- (default 1.) seconds to wait before the first retry,
+                           doubled for every following one
+        kwargs -- passed to every ``get_gro_data`` call, e.g. ``cache``
+        
+    Outputs::
+        list of DataFrames, in the order of ``specs``
+    '''
+    if client is None and not kwargs.get('offline'):
+        client = _gro_client(host, gro_token)
+    if isinstance(kwargs.get('cache'), str):
+        kwargs['cache'] = GroCache(kwargs['cache'],
+                                   ttl = kwargs.pop('cache_ttl', 86400))
+
+    def fetch(spec):
+        args = dict(kwargs)
+        args.update(spec)
+        for attempt in range(retries + 1):
+            try:
+                return get_gro_data(gro_token, host = host, client = client,
+                                    **args)
+            except Exception as e:
+                # bad input (a ValueError) won't get better by trying again,
+                # but a cut off response (a JSONDecodeError, which is also a
+                # ValueError) may
+                bad_input = (isinstance(e, ValueError) and
+                             not isinstance(e, json.JSONDecodeError))
+                if bad_input or attempt == retries:
+                    raise
+                time.sleep(backoff * 2**attempt)
+
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        return list(pool.map(fetch, specs))
 
 def test():
     gro_token = open('GROAPI_TOKEN_BEN.txt','r').read().strip()
+    # every series is fetched several times below, only the first goes to GRO
+    cache = GroCache('gro_cache')
     args_T = {'item': 'Land Temperature', 'region': 'Nanjing'}
-    df_T = get_gro_data(gro_token, **args_T)
+    df_T = get_gro_data(gro_token, cache=cache, **args_T)
     processed_T = preprocess(df_T, handle_na = 'interpolate',
                            standardization = 'zscore', leapyear=366)
     
     args_R = {'item': 'Rainfall (modeled)', 'region': 'Nanjing'}
-    df_R = get_gro_data(gro_token, **args_R)
+    df_R = get_gro_data(gro_token, cache=cache, **args_R)
     processed_R = preprocess(df_R, handle_na = 'interpolate',
                            standardization = 'zscore', leapyear=366)
 
     args_N = {'item': 'Vegetation (NDVI)', 'region': 'Nanjing',
               'frequency':3}
-    df_N = get_gro_data(gro_token, **args_N)
+    df_N = get_gro_data(gro_token, cache=cache, **args_N)
     processed_N = preprocess(df_N, handle_na = 'interpolate',
                            standardization = 'zscore', leapyear=366)
-    combine_series([processed_T, processed_R, processed_N],
-                         ['Temperature', 'Rainfall', 'NDVI'], 
-                         to_file = 'nanjing_normalized.csv')
+    CubeStore.from_frame('nanjing_normalized.cube',
+                         combine_series([processed_T, processed_R, processed_N],
+                                        ['Temperature', 'Rainfall', 'NDVI']),
+                         'Nanjing')
     
     
     args_T = {'item': 'Land Temperature', 'region': 'Nanjing'}
-    df_T = get_gro_data(gro_token, **args_T)
+    df_T = get_gro_data(gro_token, cache=cache, **args_T)
     processed_T = preprocess(df_T, handle_na = 'interpolate', leapyear=366)
     
     args_R = {'item': 'Rainfall (modeled)', 'region': 'Nanjing'}
-    df_R = get_gro_data(gro_token, **args_R)
+    df_R = get_gro_data(gro_token, cache=cache, **args_R)
     processed_R = preprocess(df_R, handle_na = 'interpolate', leapyear=366)
 
     args_N = {'item': 'Vegetation (NDVI)', 'region': 'Nanjing',
               'frequency':3}
-    df_N = get_gro_data(gro_token, **args_N)
+    df_N = get_gro_data(gro_token, cache=cache, **args_N)
     processed_N = preprocess(df_N, handle_na = 'interpolate', leapyear=366)
-    combine_series([processed_T, processed_R, processed_N],
-                         ['Temperature', 'Rainfall', 'NDVI'], 
-                         to_file = 'nanjing.csv')
+    CubeStore.from_frame('nanjing.cube',
+                         combine_series([processed_T, processed_R, processed_N],
+                                        ['Temperature', 'Rainfall', 'NDVI']),
+                         'Nanjing')
     
     args_T = {'item': 'Land Temperature', 'region': 'Nanjing'}
-    df_T = get_gro_data(gro_token, **args_T)
+    df_T = get_gro_data(gro_token, cache=cache, **args_T)
     processed_T = smooth_windows(preprocess(df_T, handle_na = 'interpolate',
                            standardization = 'zscore', leapyear=366))
     
     args_R = {'item': 'Rainfall (modeled)', 'region': 'Nanjing'}
-    df_R = get_gro_data(gro_token, **args_R)
+    df_R = get_gro_data(gro_token, cache=cache, **args_R)
     processed_R = smooth_windows(preprocess(df_R, handle_na = 'interpolate',
                            standardization = 'zscore', leapyear=366))
 
     args_N = {'item': 'Vegetation (NDVI)', 'region': 'Nanjing',
               'frequency':3}
-    df_N = get_gro_data(gro_token, **args_N)
+    df_N = get_gro_data(gro_token, cache=cache, **args_N)
     processed_N = smooth_windows(preprocess(df_N, handle_na = 'interpolate',
                            standardization = 'zscore', leapyear=366))
-    combine_series([processed_T, processed_R, processed_N],
-                         ['Temperature', 'Rainfall', 'NDVI'], 
-                         to_file = 'nanjing_normalized_smooth.csv')
+    CubeStore.from_frame('nanjing_normalized_smooth.cube',
+                         combine_series([processed_T, processed_R, processed_N],
+                                        ['Temperature', 'Rainfall', 'NDVI']),
+                         'Nanjing')
     
     
     args_T = {'item': 'Land Temperature', 'region': 'Nanjing'}
-    df_T = get_gro_data(gro_token, **args_T)
+    df_T = get_gro_data(gro_token, cache=cache, **args_T)
     processed_T = smooth_windows(preprocess(df_T, handle_na = 'interpolate', 
                                             leapyear=366))
     
     args_R = {'item': 'Rainfall (modeled)', 'region': 'Nanjing'}
-    df_R = get_gro_data(gro_token, **args_R)
+    df_R = get_gro_data(gro_token, cache=cache, **args_R)
     processed_R = smooth_windows(preprocess(df_R, handle_na = 'interpolate', 
                                             leapyear=366))
 
     args_N = {'item': 'Vegetation (NDVI)', 'region': 'Nanjing',
               'frequency':3}
-    df_N = get_gro_data(gro_token, **args_N)
+    df_N = get_gro_data(gro_token, cache=cache, **args_N)
     processed_N = smooth_windows(preprocess(df_N, handle_na = 'interpolate', 
                                             leapyear=366))
-    combine_series([processed_T, processed_R, processed_N],
-                         ['Temperature', 'Rainfall', 'NDVI'], 
-                         to_file = 'nanjing_smooth.csv')
+    CubeStore.from_frame('nanjing_smooth.cube',
+                         combine_series([processed_T, processed_R, processed_N],
+                                        ['Temperature', 'Rainfall', 'NDVI']),
+                         'Nanjing')
     
 if __name__=='__main__':
     test()
\ No newline at end of file
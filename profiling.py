@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+"""
+
+import os
+import json
+import time
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# everything is off until ``enable`` is called, so marking a stage costs one
+# check of this flag
+_state = {'enabled': False, 'records': [], 't0': 0.}
+_local = threading.local()
+
+def enable(trace_memory = True):
+    '''starts recording stages (and their peak memory, using tracemalloc)
+    '''
+    _state['enabled'] = True
+    _state['records'] = []
+    _state['t0'] = time.perf_counter()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    _state['enabled'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def is_enabled():
+    return _state['enabled']
+
+@contextmanager
+def stage(name, items = None):
+    '''marks a stage of the pipeline. Records wall time, CPU time, peak
+    traced memory and the number of items handled, which can also be set
+    inside the block:
+
+        with stage('fetch') as rec:
+            df = ...
+            rec['items'] = len(df)
+
+    tracemalloc keeps a single peak for the whole process, and measuring a
+    stage resets it, so peak memory is only recorded for stages on the main
+    thread. Stages on other threads get ``peak_mem`` None, and the peak of a
+    main thread stage includes whatever other threads allocated meanwhile.
+    '''
+    if not _state['enabled']:
+        yield {}
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    rec = {'stage': name, 'items': items, 'thread': threading.get_ident()}
+    tracing = (tracemalloc.is_tracing() and
+               threading.current_thread() is threading.main_thread())
+    if tracing:
+        # the peak of an enclosing stage has to survive our reset
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        tracemalloc.reset_peak()
+        rec['_start_mem'] = current
+    rec['_peak'] = 0
+    stack.append(rec)
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        yield rec
+    finally:
+        rec['wall'] = time.perf_counter() - wall0
+        rec['cpu'] = time.process_time() - cpu0
+        rec['start'] = wall0 - _state['t0']
+        stack.pop()
+        if tracing:
+            peak = max(rec.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            rec['peak_mem'] = peak - rec.pop('_start_mem')
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        else:
+            rec.pop('_peak')
+            rec['peak_mem'] = None
+        rec['depth'] = len(stack)
+        _state['records'].append(rec)
+
+def profiled(name, items = None):
+    '''decorator marking every call of a function as stage ``name``.
+    ``items`` is an optional function of the result giving the item count.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return fn(*args, **kwargs)
+            with stage(name) as rec:
+                ret = fn(*args, **kwargs)
+                if items is not None:
+                    rec['items'] = items(ret)
+            return ret
+        return wrapper
+    return decorator
+
+def summary():
+    '''totals by stage: calls, wall and CPU time, largest peak memory, items
+    '''
+    out = {}
+    for rec in _state['records']:
+        s = out.setdefault(rec['stage'], {'calls': 0, 'wall': 0., 'cpu': 0.,
+                                          'peak_mem': None, 'items': None})
+        s['calls'] += 1
+        s['wall'] += rec['wall']
+        s['cpu'] += rec['cpu']
+        if rec.get('peak_mem') is not None:
+            s['peak_mem'] = max(s['peak_mem'] or 0, rec['peak_mem'])
+        if rec['items'] is not None:
+            s['items'] = (s['items'] or 0) + rec['items']
+    return out
+
+def write_report(path):
+    '''writes the stage summary and every recorded stage to a json file. The
+    ``traceEvents`` list can be opened in chrome://tracing or Perfetto.
+    '''
+    events = [{'name': rec['stage'], 'ph': 'X', 'pid': os.getpid(),
+               'tid': rec['thread'], 'ts': rec['start']*1e6,
+               'dur': rec['wall']*1e6,
+               'args': {k: rec.get(k) for k in ('cpu', 'peak_mem', 'items')}}
+              for rec in _state['records']]
+    with open(path, 'w') as f:
+        json.dump({'stages': summary(), 'records': _state['records'],
+                   'traceEvents': events}, f, indent=1, default=str)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import inspect
+import functools
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+def hash_data(data):
+    '''content hash of a DataFrame or array
+    '''
+    h = hashlib.sha1()
+    if isinstance(data, pd.DataFrame):
+        h.update(repr(list(data.columns)).encode())
+        h.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    else:
+        data = np.ascontiguousarray(data)
+        h.update(repr((data.shape, data.dtype.str)).encode())
+        h.update(data.tobytes())
+    return h.hexdigest()
+
+def _nbytes(value):
+    '''size of the arrays and frames in ``value``, a cheap estimate of its
+    pickled size
+    '''
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(index=True)))
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(x) for x in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(x) for x in value.values())
+    return 0
+
+class ResultCache:
+    """memoizes results by key, in an in-memory LRU holding at most
+    ``max_bytes`` of (pickled) results, and optionally on disk as well.
+    """
+    def __init__(self, max_bytes = 256*2**20, cache_dir = None,
+                 max_disk_bytes = 2**30):
+        """
+        Inputs:
+            ``max_bytes`` - size of the in-memory tier, 0 turns caching off
+            ``cache_dir`` - (default None) directory of the on-disk tier
+            ``max_disk_bytes`` - (default 1GB) size of the on-disk tier. The
+                                 least recently used files are removed first,
+                                 None keeps everything
+        """
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._items = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0,
+                      'disk_evictions': 0, 'too_big': 0}
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """cached value for ``key``, or None
+        """
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.stats['hits'] += 1
+                return pickle.loads(self._items[key])
+        blob = self._read_disk(key) if self.cache_dir else None
+        if blob is not None:
+            with self._lock:
+                self.stats['disk_hits'] += 1
+            self._remember(key, blob)
+            return pickle.loads(blob)
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        # results too big for memory are never pickled just to be thrown away
+        small = _nbytes(value) <= self.max_bytes
+        if not small:
+            with self._lock:
+                self.stats['too_big'] += 1
+            if not self.cache_dir:
+                return
+        blob = pickle.dumps(value) if small else None
+        size = len(blob) if small else _nbytes(value)
+        if self.cache_dir and (self.max_disk_bytes is None or
+                               size <= self.max_disk_bytes):
+            with open(self._disk_path(key), 'wb') as f:
+                if small:
+                    f.write(blob)
+                else:
+                    pickle.dump(value, f)
+            self._trim_disk()
+        if small:
+            self._remember(key, blob)
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            # the disk tier is evicted by modification time, so a hit makes
+            # the file the most recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # not cached, or just evicted by another process
+            return None
+        return blob
+
+    def _disk_files(self):
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, entry.path))
+        return files
+
+    def _trim_disk(self):
+        # the directory may be shared with other processes, so it is listed
+        # rather than tracked here
+        if self.max_disk_bytes is None:
+            return
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.stats['disk_evictions'] += 1
+
+    def _remember(self, key, blob):
+        # values are kept pickled, so callers can't modify what we hold
+        if len(blob) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._sizes[key]
+            self._items[key] = blob
+            self._items.move_to_end(key)
+            self._sizes[key] = len(blob)
+            self.nbytes += len(blob)
+            while self.nbytes > self.max_bytes:
+                old_key, _ = self._items.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old_key)
+                self.stats['evictions'] += 1
+
+    def clear(self, disk = False):
+        """empties the in-memory tier, and the on-disk one too if ``disk``,
+        and resets the statistics
+        """
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            for k in self.stats:
+                self.stats[k] = 0
+        if disk and self.cache_dir:
+            for _, _, path in self._disk_files():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+# used by ``get_mat`` and ``get_sorted_years``
+default_cache = ResultCache()
+
+def _cacheable(ret):
+    # memory maps and results sent elsewhere (None) are not worth keeping
+    items = ret if isinstance(ret, tuple) else (ret,)
+    return not any(x is None or isinstance(x, np.memmap) for x in items)
+
+def cached(fn = None, bypass = ()):
+    '''memoizes ``fn`` in ``default_cache``. The key is a hash of the data
+    (the ``df`` argument) together with every other named argument, so the
+    same data and parameters are only computed once. Results holding None or
+    a memory map are not cached.
+
+    Calls where any argument named in ``bypass`` is set (not None or False)
+    always run ``fn``, for arguments with side effects the key can't capture,
+    e.g. an output array or a callback:
+
+        @cached(bypass=('out', 'callback'))
+        def fn(df, out = None, callback = None): ...
+    '''
+    if fn is None:
+        return functools.partial(cached, bypass = bypass)
+    sig = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        cache = default_cache
+        if not cache.max_bytes and not cache.cache_dir:
+            return fn(*args, **kwargs)
+        bound = sig.bind(*args, **kwargs)
+        if any(bound.arguments.get(name) is not None and
+               bound.arguments.get(name) is not False for name in bypass):
+            return fn(*args, **kwargs)
+        bound.apply_defaults()
+        params = {}
+        for name, val in bound.arguments.items():
+            kind = sig.parameters[name].kind
+            if name == 'df' or kind == inspect.Parameter.VAR_KEYWORD:
+                continue
+            params[name] = val
+        key = hashlib.sha1((fn.__name__ + hash_data(bound.arguments['df']) +
+                            json.dumps(params, sort_keys=True, default=str)
+                            ).encode()).hexdigest()
+        ret = cache.get(key)
+        if ret is None:
+            ret = fn(*args, **kwargs)
+            if _cacheable(ret):
+                cache.put(key, ret)
+        return ret
+    return wrapper
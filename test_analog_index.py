@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the cross-region analog index against a brute force search. Run
+with ``python -m pytest test_analog_index.py``.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from cube_store import CubeStore
+from analog_index import AnalogIndex
+from distance_fn import dist_mat
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+@pytest.mark.parametrize('sketch', ['paa', 'pca'])
+def test_probing_every_list_is_exact(tmp_path, sketch):
+    stores = [CubeStore.from_frame(str(tmp_path / region), _frame(seed = seed),
+                                   region, 'T')
+              for seed, region in enumerate(['A', 'B', 'C'])]
+    path = str(tmp_path / 'index')
+    AnalogIndex.build(path, stores, sketch = sketch, dims = 4, n_lists = 4,
+                      dtype = np.float64)
+    index = AnalogIndex(path)
+    assert len(index) == 36
+
+    series = {(s.regions[0], y): s.to_frame(s.regions[0], 'T')[y].values
+              for s in stores for y in s.years}
+    a = series[('B', 2003)]
+    want = sorted((dist_mat(a, x)[0, 0], region, year)
+                  for (region, year), x in series.items()
+                  if (region, year) != ('B', 2003))[:5]
+    got = index.query_label('B', 2003, k = 5, nprobe = 4, candidates = 36)
+    assert [g[1:] for g in got] == [w[1:] for w in want]
+    np.testing.assert_allclose([g[0] for g in got], [w[0] for w in want],
+                               rtol=1e-9)
+    assert index.label(index.position('C', 2010)) == ('C', 2010)
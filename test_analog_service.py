@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the analog query service, directly and over HTTP. Run with
+``python -m pytest test_analog_service.py``.
+"""
+
+import json
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from cube_store import CubeStore
+from analog_service import AnalogService, make_server
+from year_score_comp import get_sorted_years
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+# every year but 2011, which ``get_sorted_years`` would otherwise compare to
+# itself
+OTHERS = list(range(2000, 2011))
+
+@pytest.fixture
+def cubes(tmp_path):
+    CubeStore.from_frame(str(tmp_path / 'nanjing.cube'), _frame(missing = 0.05),
+                         'Nanjing', 'Temperature')
+    return str(tmp_path)
+
+def test_query_matches_sorted_years(cubes):
+    service = AnalogService([cubes])
+    ret = service.query({'cube': 'nanjing', 'year': 2011, 'k': 3,
+                         'similarity': 'L1'})
+    want = get_sorted_years(2011, _frame(missing = 0.05), years = OTHERS,
+                            similarity = 'L1', k = 3)
+    assert [r['year'] for r in ret['results']] == [y for _, y in want]
+    np.testing.assert_allclose([r['score'] for r in ret['results']],
+                               [d for d, _ in want], rtol=1e-9)
+    with pytest.raises(ValueError):
+        service.query({'cube': 'shanghai', 'year': 2011})
+    with pytest.raises(ValueError):
+        service.query({'year': 1990})
+    with pytest.raises(ValueError):
+        service.query({'year': 2011, 'colour': 'red'})
+
+def test_http(cubes):
+    server = make_server([cubes], port = 0)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        with urlopen(url + '/query?year=2011&k=3&smooth=7,0', timeout = 10) as r:
+            assert len(json.load(r)['results']) == 3
+        with urlopen(url + '/cubes', timeout = 10) as r:
+            assert json.load(r)['nanjing']['regions'] == ['Nanjing']
+        with pytest.raises(HTTPError) as e:
+            urlopen(url + '/query?year=1990', timeout = 10)
+        assert e.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_query_with_gaps_at_the_edges(tmp_path):
+    df = _frame()
+    # the season in progress, and a year missing its first day
+    df.loc[300:, 2011] = np.nan
+    df.loc[0, 2004] = np.nan
+    CubeStore.from_frame(str(tmp_path / 'nanjing.cube'), df, 'Nanjing', 'T')
+    ret = AnalogService([str(tmp_path)]).query({'year': 2011})
+    assert sorted(r['year'] for r in ret['results']) == [y for y in OTHERS
+                                                         if y != 2004]
+    assert all(r['score'] is not None for r in ret['results'])
+    # nothing left to compare to
+    ret = AnalogService([str(tmp_path)]).query({'year': 2011, 'years': [2004]})
+    assert ret['results'] == []
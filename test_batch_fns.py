@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the batch runners against computing every series on its own. Run
+with ``python -m pytest test_batch_fns.py``.
+"""
+
+import os
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from batch_fns import run_batch, expand_jobs, run_manifest, has_parquet
+from preprocessing_fns import preprocess
+from year_score_comp import get_mat, get_sorted_years
+from gro_cache import FakeGroClient
+
+def _points(start, end, seed = 0):
+    dates = pd.date_range(start, end, freq='D')
+    values = np.random.default_rng(seed).normal(size=len(dates)).cumsum()
+    return [{'start_date': str(d.date()), 'end_date': str(d.date()),
+             'value': float(v)} for d, v in zip(dates, values)]
+
+def test_run_batch_matches_get_mat():
+    data = [pd.DataFrame(_points('2015-01-01', '2018-12-31', seed))
+            for seed in (1, 2)]
+    specs = [('Temperature', 'A', 'GHCN Daily', 'Temperature'),
+             ('Temperature', 'B', 'GHCN Daily', 'Temperature')]
+    out = run_batch(specs, data = data, processes = 2,
+                    mat_args = {'similarity': 'L1', 'smooth': (7, 0)})
+    for spec, raw in zip(specs, data):
+        mat, years = get_mat(preprocess(raw.copy(), handle_na = 'interpolate'),
+                             similarity = 'L1', smooth = (7, 0))
+        got = out.xs(spec[1], level = 'region')
+        assert list(got.index.get_level_values('year')) == years
+        np.testing.assert_allclose(got[years].values, mat, rtol=1e-9)
+
+MANIFEST = {'defaults': {'source': 'GHCN Daily', 'metric': 'Temperature'},
+            'jobs': [{'items': ['Temperature max', 'Temperature min'],
+                      'regions': ['Nanjing', 'Shanghai'],
+                      'similarities': ['Euclidean', 'L1'],
+                      'windows': [[1, 365], [91, 273]],
+                      'rank': [2017], 'k': 2}]}
+
+def test_expand_jobs():
+    runs = expand_jobs(MANIFEST)
+    assert len(runs) == 16
+    assert {(r['item'], r['region'], r['similarity'], tuple(r['window']))
+            for r in runs} == set(itertools.product(
+                ['Temperature max', 'Temperature min'], ['Nanjing', 'Shanghai'],
+                ['Euclidean', 'L1'], [(1, 365), (91, 273)]))
+    assert all(r['source'] == 'GHCN Daily' and r['rank'] == [2017] for r in runs)
+
+def test_run_manifest(tmp_path):
+    client = FakeGroClient(_points('2015-01-01', '2018-12-31'))
+    matrices, rankings = run_manifest(MANIFEST, out = str(tmp_path), fmt = 'csv',
+                                      processes = 2, client = client)
+    # 4 series, fetched once each, and 4 years
+    assert len(_fetches(client)) == 4
+    assert len(matrices) == 16*16 and len(rankings) == 16*2
+    one = rankings[(rankings['region'] == 'Nanjing') &
+                   (rankings['similarity'] == 'L1') &
+                   (rankings['start_day'] == 1)]
+    df = preprocess(pd.DataFrame(_points('2015-01-01', '2018-12-31')),
+                    handle_na = 'interpolate')
+    want = [y for _, y in get_sorted_years(2017, df, similarity = 'L1')
+            if y != 2017][:2]
+    assert list(one['analog_year'][:2]) == want
+    assert os.path.isdir(os.path.join(str(tmp_path), 'rankings',
+                                      'item=Temperature max', 'region=Nanjing'))
+
+def _fetches(client):
+    return [c[1] for c in client.calls if c[0] == 'get_data_points']
+
+def test_expand_jobs_takes_scalars():
+    runs = expand_jobs({'jobs': [{'regions': 'Nanjing', 'similarities': 'L1',
+                                  'rank': 2017, 'years': 2016}]})
+    assert len(runs) == 1
+    assert runs[0]['region'] == 'Nanjing' and runs[0]['similarity'] == 'L1'
+    assert runs[0]['rank'] == [2017] and runs[0]['years'] == [2016]
+
+@pytest.mark.skipif(has_parquet(), reason = 'parquet is installed')
+def test_run_manifest_checks_for_parquet_first(tmp_path):
+    client = FakeGroClient([])
+    with pytest.raises(ValueError):
+        run_manifest(MANIFEST, out = str(tmp_path), fmt = 'parquet',
+                     client = client)
+    assert not client.calls
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the synthetic data and the benchmark runner. Run with
+``python -m pytest test_benchmark.py``.
+"""
+
+import numpy as np
+from benchmark import run, synthetic_points
+from preprocessing_fns import preprocess
+
+def test_synthetic_points():
+    df = synthetic_points(n_years = 3, n_regions = 2, missing = 0.2)
+    assert sorted(set(df['region_id'])) == [0, 1]
+    one = df[df['region_id'] == 0].drop(columns = 'region_id')
+    processed = preprocess(one, leapyear = 366)
+    assert list(processed.columns) == ['day', 2000, 2001, 2002]
+    observed = 1 - np.isnan(processed[[2000, 2001, 2002]].values).mean()
+    assert 0.75 < observed < 0.85
+
+def test_run_times_every_stage():
+    results = run(years_list = (3,), repeat = 1)
+    stages = {r['stage'] for r in results}
+    assert {'preprocess', 'smooth_windows', 'get_mat', 'end_to_end'} <= stages
+    assert all(0 < r['best'] <= r['median'] for r in results)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the year cube store. Run with ``python -m pytest test_cube_store.py``.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from cube_store import CubeStore
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+def test_write_and_read_back(tmp_path):
+    path = str(tmp_path / 'test.cube')
+    df = _frame(missing = 0.1)
+    years = list(df.columns[1:])
+    store = CubeStore.create(path, ['T', 'R'], ['A', 'B', 'C'], range(1, 366),
+                             years, region_chunk = 2)
+    store.write('R', 'C', df)
+
+    store = CubeStore(path)
+    np.testing.assert_array_equal(store.read('R', 'C'), df[years].values)
+    assert np.isnan(store.read('T', 'C')).all()
+    assert np.isnan(store.read('R', 'A')).all()
+    pd.testing.assert_frame_equal(store.to_frame('C', 'R'), df)
+    cube = store.cube(['R'], ['B', 'C'])
+    assert cube.shape == (1, 2, 365, len(years))
+    np.testing.assert_array_equal(cube[0, 1], df[years].values)
+    with pytest.raises(ValueError):
+        store.write('R', 'A', df)
+
+def test_from_frame_keeps_the_features(tmp_path):
+    T, R = _frame(seed = 1), _frame(seed = 2)
+    df = pd.concat([T.assign(feature = 'T'), R.assign(feature = 'R')],
+                   ignore_index = True)
+    df = df[['feature'] + list(T.columns)]
+    CubeStore.from_frame(str(tmp_path / 'nanjing.cube'), df, 'Nanjing')
+    store = CubeStore(str(tmp_path / 'nanjing.cube'))
+    assert store.features == ['T', 'R']
+    pd.testing.assert_frame_equal(store.to_frame('Nanjing'), df)
+
+def test_to_parquet_writes_a_row_group_per_region(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'test.cube')
+    store = CubeStore.create(path, ['T', 'R'], ['A', 'B', 'C'], range(1, 366),
+                             range(2000, 2012), region_chunk = 2)
+    for i, region in enumerate(store.regions):
+        store.write('T', region, _frame(seed = i))
+    store.to_parquet(str(tmp_path / 'test.parquet'))
+
+    expected = pd.concat([store.to_frame(r).assign(region = r)
+                          for r in store.regions], ignore_index = True)
+    expected = expected[['feature', 'region', 'day'] + store.years]
+    expected.columns = [str(c) for c in expected.columns]
+    pd.testing.assert_frame_equal(pd.read_parquet(str(tmp_path / 'test.parquet')),
+                                  expected)
+    assert pq.ParquetFile(str(tmp_path / 'test.parquet')).num_row_groups == 3
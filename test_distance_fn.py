@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the batched distance functions against ``dist``, the pair by pair
+function they replaced, and against brute force. Run with
+``python -m pytest test_distance_fn.py``.
+"""
+
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from distance_fn import dist, dist_mat, top_k, condensed_index, condensed_row, square_mat, tiled_dist_mat, overlap_counts, resample_weights, resampled_dists
+
+def _series(days, n, seed = 0, missing = 0.):
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(days, n)).cumsum(axis=0)
+    A[rng.random(A.shape) < missing] = np.nan
+    return A
+
+@pytest.mark.parametrize('metric, handle_na',
+                         list(itertools.product(['Euclidean', 'L1', 'Linf', 'R2', 'DTW'],
+                                                ['interpolate', 'fill', 'drop'])))
+def test_dist_mat_matches_dist(metric, handle_na):
+    A = _series(60, 5, 0, 0.1)
+    B = _series(60, 4, 1, 0.1)
+    D = dist_mat(A, B, metric = metric, handle_na = handle_na)
+    for i in range(A.shape[1]):
+        for j in range(B.shape[1]):
+            d = dist(pd.Series(A[:, i]), pd.Series(B[:, j]), metric = metric,
+                     handle_na = handle_na)
+            # dist_mat reports distances it can't compute as infinite
+            if np.isnan(d):
+                assert np.isinf(D[i, j])
+            else:
+                assert D[i, j] == pytest.approx(d, rel=1e-9, abs=1e-9)
+
+def test_dist_mat_of_one_array_compares_it_to_itself():
+    A = _series(50, 6, 2, 0.05)
+    np.testing.assert_allclose(dist_mat(A), dist_mat(A, A.copy()),
+                               rtol=1e-9, atol=1e-6)
+
+@pytest.mark.parametrize('metric', ['Euclidean', 'L1', 'Linf', 'R2'])
+def test_shifted_dist_mat_matches_dist(metric):
+    A = _series(80, 3, 3)
+    B = _series(80, 4, 4)
+    D, lags = dist_mat(A, B, shift = True, metric = metric, return_lag = True)
+    for i in range(A.shape[1]):
+        for j in range(B.shape[1]):
+            d = dist(pd.Series(A[:, i]), pd.Series(B[:, j]), shift = True,
+                     metric = metric)
+            assert D[i, j] == pytest.approx(d, rel=1e-9, abs=1e-9)
+            # and the lag found is the one giving that distance
+            rolled = dist_mat(A[:, i], np.roll(B[:, j], lags[i, j]),
+                              metric = metric)[0, 0]
+            assert rolled == pytest.approx(d, rel=1e-9, abs=1e-9)
+
+@pytest.mark.parametrize('metric', ['Euclidean', 'L1', 'Linf', 'R2', 'DTW'])
+def test_top_k_matches_full_sort(metric):
+    A = _series(120, 41, 5)
+    full = dist_mat(A[:, 0], A[:, 1:], metric = metric)[0]
+    inds, d = top_k(A[:, 0], A[:, 1:], k = 5, metric = metric)
+    order = np.argsort(d, kind='stable')[:5]
+    want = np.argsort(full, kind='stable')[:5]
+    np.testing.assert_array_equal(inds[order], want)
+    np.testing.assert_allclose(d[order], full[want], rtol=1e-9)
+
+def test_dtw_band():
+    A = _series(60, 4, 6)
+    euclid = dist_mat(A, metric = 'Euclidean')
+    # without room to warp DTW is the Euclidean distance, and more room never
+    # makes it larger
+    np.testing.assert_allclose(dist_mat(A, metric = 'DTW', band = 0), euclid,
+                               rtol=1e-9, atol=1e-9)
+    narrow = dist_mat(A, metric = 'DTW', band = 3)
+    wide = dist_mat(A, metric = 'DTW', band = 10)
+    assert (wide <= narrow + 1e-9).all() and (narrow <= euclid + 1e-9).all()
+
+@pytest.mark.parametrize('metric', ['Euclidean', 'L1', 'DTW'])
+def test_condensed_matches_square(metric):
+    A = _series(50, 7, 7, 0.05)
+    D = dist_mat(A, metric = metric)
+    C = dist_mat(A, metric = metric, condensed = True)
+    assert C.shape == (7*6//2,)
+    for i in range(7):
+        for j in range(i + 1, 7):
+            assert C[condensed_index(7, i, j)] == pytest.approx(D[i, j], rel=1e-9)
+    np.testing.assert_allclose(square_mat(C), D, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(condensed_row(C, 3), D[3], rtol=1e-9, atol=1e-9)
+    # R2 isn't symmetric
+    with pytest.raises(ValueError):
+        dist_mat(A, metric = 'R2', condensed = True)
+
+def test_float32():
+    A = _series(50, 7, 8)
+    D = dist_mat(A)
+    D32 = dist_mat(A, dtype = np.float32)
+    assert D32.dtype == np.float32
+    np.testing.assert_allclose(D32, D, rtol=1e-4, atol=1e-4)
+
+@pytest.mark.parametrize('metric', ['Euclidean', 'R2'])
+def test_tiled_dist_mat_matches_dist_mat(tmp_path, metric):
+    A = _series(40, 30, 9, 0.05)
+    D = dist_mat(A, metric = metric)
+    out = str(tmp_path / 'D.npy')
+    tiled_dist_mat(A, out = out, metric = metric, memory = 20000, threads = 2)
+    np.testing.assert_allclose(np.load(out), D, rtol=1e-9, atol=1e-9)
+
+    got = np.full(D.shape, np.nan)
+    def callback(i0, j0, tile):
+        got[i0:i0 + tile.shape[0], j0:j0 + tile.shape[1]] = tile
+    tiled_dist_mat(A, callback = callback, metric = metric, memory = 20000)
+    done = ~np.isnan(got)
+    np.testing.assert_allclose(got[done], D[done], rtol=1e-9, atol=1e-9)
+    # every pair is sent at least once
+    assert (done | done.T).all()
+
+def test_min_overlap():
+    A = _series(30, 4, 10)
+    A[:20, 1] = np.nan
+    A[5:10, 2] = np.nan
+    counts = overlap_counts(A)
+    assert counts[0, 1] == 10 and counts[1, 2] == 10 and counts[0, 2] == 25
+    D = dist_mat(A, handle_na = 'drop', min_overlap = 15)
+    assert np.isinf(D[0, 1]) and np.isinf(D[1, 2])
+    assert np.isfinite(D[0, 2]) and np.isfinite(D[0, 3])
+
+@pytest.mark.parametrize('metric, handle_na',
+                         list(itertools.product(['Euclidean', 'L1', 'Linf', 'R2'],
+                                                ['interpolate', 'drop'])))
+def test_resampled_dists_match_dist_mat(metric, handle_na):
+    A = _series(40, 6, 11, 0.1)
+    W = resample_weights(40, n = 5, block = 4, seed = 1)
+    D = resampled_dists(A[:, 0], A[:, 1:], np.concatenate([np.ones((1, 40)), W]),
+                        metric = metric, handle_na = handle_na)
+    # all days once is dist_mat itself
+    np.testing.assert_allclose(D[0], dist_mat(A[:, 0], A[:, 1:], metric = metric,
+                                              handle_na = handle_na)[0],
+                               rtol=1e-9, atol=1e-9)
+    # and a replicate is dist_mat on the days it uses, repeated
+    days = np.repeat(np.arange(40), W[2].astype(int))
+    if metric != 'R2' and handle_na == 'drop':
+        np.testing.assert_allclose(D[3], dist_mat(A[days, 0], A[days, 1:],
+                                                  metric = metric,
+                                                  handle_na = handle_na)[0],
+                                   rtol=1e-9, atol=1e-9)
+
+def test_resample_weights():
+    W = resample_weights(30, n = 10, block = 4)
+    assert W.shape == (10, 30) and (W.sum(axis = 1) == 30).all()
+    J = resample_weights(30, method = 'jackknife', block = 4)
+    assert J.shape == (8, 30)
+    np.testing.assert_array_equal(J.sum(axis = 0), 7)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the GRO data cache, through ``FakeGroClient`` so no token or
+network is needed. Run with ``python -m pytest test_gro_cache.py``.
+"""
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+from gro_cache import GroCache, FakeGroClient
+from preprocessing_fns import get_gro_data
+
+def _points(start, end, seed = 0):
+    dates = pd.date_range(start, end, freq='D')
+    values = np.random.default_rng(seed).normal(size=len(dates)).cumsum()
+    return [{'start_date': str(d.date()), 'end_date': str(d.date()),
+             'value': float(v)} for d, v in zip(dates, values)]
+
+def _fetches(client):
+    return [c[1] for c in client.calls if c[0] == 'get_data_points']
+
+ARGS = {'item': 'Land Temperature', 'region': 'Nanjing'}
+
+def test_cache_serves_fresh_series_without_gro(tmp_path):
+    client = FakeGroClient(_points('2017-01-01', '2018-12-31'))
+    cache = GroCache(str(tmp_path), ttl = 3600)
+    first = get_gro_data(client = client, cache = cache, **ARGS)
+    second = get_gro_data(client = client, cache = cache, **ARGS)
+    assert len(_fetches(client)) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+def test_cache_refresh_only_fetches_new_points(tmp_path):
+    points = _points('2017-01-01', '2018-06-30')
+    client = FakeGroClient(points)
+    cache = GroCache(str(tmp_path), ttl = 0)
+    get_gro_data(client = client, cache = cache, **ARGS)
+
+    # GRO revises the last day and publishes a few more
+    revised = dict(points[-1], value = 1000.)
+    client.points = points[:-1] + [revised] + _points('2018-07-01', '2018-07-10', 1)
+    df = get_gro_data(client = client, cache = cache, **ARGS)
+
+    assert _fetches(client)[1]['start_date'] == '2018-06-30'
+    assert len(df) == len(client.points)
+    dates = pd.to_datetime(df['end_date'])
+    assert dates.is_monotonic_increasing and dates.is_unique
+    assert df['value'].values[dates == pd.Timestamp('2018-06-30')][0] == 1000.
+
+def test_offline_mode(tmp_path):
+    client = FakeGroClient(_points('2017-01-01', '2018-12-31'))
+    cache = GroCache(str(tmp_path), ttl = 0)
+    online = get_gro_data(client = client, cache = cache, **ARGS)
+
+    # stale, but offline we use it anyway, and never build a client
+    offline = get_gro_data(cache = cache, offline = True, **ARGS)
+    pd.testing.assert_frame_equal(online, offline)
+    with pytest.raises(ValueError):
+        get_gro_data(cache = cache, offline = True, item = 'Rainfall',
+                     region = 'Nanjing')
+    with pytest.raises(ValueError):
+        get_gro_data(offline = True, **ARGS)
+
+def test_concurrent_updates_keep_every_point(tmp_path):
+    cache = GroCache(str(tmp_path))
+    arg_dict = {'item_id': 1, 'region_id': 2}
+    cache.store(arg_dict, pd.DataFrame(_points('2018-01-01', '2018-01-31')))
+    months = [_points('2018-%02d-01' % m, '2018-%02d-28' % m, m)
+              for m in range(2, 10)]
+    threads = [threading.Thread(target = cache.update,
+                                args = (arg_dict, pd.DataFrame(points)))
+               for points in months]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    df = cache.load(arg_dict)
+    assert len(df) == 31 + 8*28
+    assert pd.to_datetime(df['end_date']).is_monotonic_increasing
+    # and nothing is left half written
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.tmp')]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the incremental nowcast against ``get_sorted_years``. Run with
+``python -m pytest test_nowcast.py``.
+"""
+
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from nowcast import Nowcast
+from year_score_comp import get_sorted_years
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+# every year but 2011, which ``get_sorted_years`` would otherwise compare to
+# itself
+OTHERS = list(range(2000, 2011))
+
+@pytest.mark.parametrize('similarity, handle_na',
+                         list(itertools.product(['Euclidean', 'L1', 'Linf', 'R2'],
+                                                ['interpolate', 'drop'])))
+def test_nowcast_matches_sorted_years(similarity, handle_na):
+    df = _frame()
+    df.loc[20:30, 2003] = np.nan
+    season = df[2011].values.copy()
+    df[2011] = np.nan
+    nc = Nowcast(df, 2011, similarity = similarity, handle_na = handle_na)
+    # days arrive in order, some are never seen, one is revised later
+    for day in range(1, 151):
+        if day % 9:
+            nc.update(day, season[day - 1])
+    nc.update(100, season[99] + 5)
+    nc.update(150, season[149])
+
+    seen = df.copy()
+    observed = [d for d in range(1, 151) if d % 9 or d == 150]
+    seen.loc[[d - 1 for d in observed], 2011] = season[[d - 1 for d in observed]]
+    seen.loc[99, 2011] += 5
+    want = get_sorted_years(2011, seen, years = OTHERS, end_day = 150,
+                            similarity = similarity, handle_na = handle_na)
+    got = nc.sorted_years()
+    assert nc.end_day == 150
+    assert [y for _, y in got] == [y for _, y in want]
+    np.testing.assert_allclose([d for d, _ in got], [d for d, _ in want],
+                               rtol=1e-7)
+    assert [y for _, y in nc.sorted_years(k = 3)] == [y for _, y in want[:3]]
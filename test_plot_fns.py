@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the embeddings and of the headless report rendering. Run with
+``python -m pytest test_plot_fns.py``.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import matplotlib.pyplot as plt
+from plot_fns import embed, plot_side, render_similar_yrs
+from distance_fn import dist_mat
+from year_score_comp import get_sorted_years, get_mat
+
+def test_mds_keeps_distances_in_the_plane():
+    X = np.random.default_rng(0).normal(size=(10, 2))
+    D = np.sqrt(((X[:, None] - X[None])**2).sum(axis = 2))
+    Y = embed(D, method = 'MDS')
+    DY = np.sqrt(((Y[:, None] - Y[None])**2).sum(axis = 2))
+    np.testing.assert_allclose(DY, D, atol=1e-8)
+    # condensed distances give the same, from the cache or not
+    np.testing.assert_allclose(embed(D[np.triu_indices(10, 1)]), Y)
+    np.testing.assert_allclose(embed(D), Y)
+
+def test_mds_of_distances_is_pca_of_the_data():
+    X = np.random.default_rng(1).normal(size=(60, 8)).cumsum(axis = 0)
+    Y = embed(dist_mat(X), method = 'MDS')
+    P = embed(X = X.T, method = 'PCA')
+    # the same up to the sign of each axis
+    np.testing.assert_allclose(np.abs(Y), np.abs(P), atol=1e-8)
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_render_similar_yrs_writes_every_report(tmp_path, processes):
+    df = _frame(6)
+    jobs = [{'df': df, 'year': year, 'ranking': get_sorted_years(year, df),
+             'n': 3} for year in (2003, 2005)]
+    jobs.append({'df': df, 'year': 2001, 'ranking': [2002, 2000],
+                 'name': 'short'})
+    paths = render_similar_yrs(jobs, str(tmp_path), processes = processes)
+    assert [os.path.basename(p) for p in paths] == ['2003.png', '2005.png',
+                                                   'short.png']
+    for path in paths:
+        with open(path, 'rb') as f:
+            assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+
+def test_plot_side_titles_mds():
+    df = _frame(6)
+    df.insert(0, 'feature', 'temperature')
+    try:
+        plot_side(df, [2003, 2005], 'MDS', D = get_mat(df),
+                  similarity = 'Euclidean')
+        assert plt.gcf()._suptitle.get_text() == \
+            'Comparison Using MDS of Euclidean Distances'
+        plot_side(df, [2003, 2005], 'MDS', D = get_mat(df), title = 'Analogs')
+        assert plt.gcf()._suptitle.get_text() == 'Analogs'
+    finally:
+        plt.close('all')
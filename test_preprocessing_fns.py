@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of preprocessing and fetching, through ``FakeGroClient`` so no token
+or network is needed. Run with ``python -m pytest test_preprocessing_fns.py``.
+"""
+
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+from preprocessing_fns import preprocess, get_gro_data_many, get_gro_data
+from gro_cache import FakeGroClient
+
+def _points(start, end, seed = 0):
+    dates = pd.date_range(start, end, freq='D')
+    values = np.random.default_rng(seed).normal(size=len(dates)).cumsum()
+    return [{'start_date': str(d.date()), 'end_date': str(d.date()),
+             'value': float(v)} for d, v in zip(dates, values)]
+
+def _loop_preprocess(df, years = False, leapyear = None,
+                     standardization = None, handle_na = None):
+    '''``preprocess`` as it was before it was vectorized, filling the array
+    one observation at a time
+    '''
+    df = df.copy()
+    df['end_date'] = pd.to_datetime(df['end_date'])
+    df['year'] = [d.year for d in df['end_date']]
+    df['day'] = [d.dayofyear for d in df['end_date']]
+    if not years:
+        years = np.unique(df['year'])
+    A = np.full((365 if leapyear else 366, len(years)), np.nan)
+    for j, year in enumerate(years):
+        yr_df = df[df['year'] == year]
+        for i in range(yr_df.shape[0]):
+            row = yr_df.iloc[i]
+            if leapyear and not year%4:
+                if row['day'] < leapyear:
+                    A[int(row['day'])-1,j] = row['value']
+                elif row['day'] > leapyear:
+                    A[int(row['day'])-2,j] = row['value']
+            else:
+                A[int(row['day'])-1,j] = row['value']
+    valid = A[~np.isnan(A)]
+    if standardization == 'zscore':
+        A = A/np.std(valid) - np.mean(valid)/np.std(valid)
+    elif standardization == 'minmax':
+        A = (A - np.min(valid))/(np.max(valid) - np.min(valid))
+    ret_df = pd.DataFrame({'day': range(1, A.shape[0] + 1)})
+    for i, year in enumerate(years):
+        ret_df[year] = A[:,i]
+    if handle_na == 'interpolate':
+        ret_df = ret_df.interpolate(limit_direction='both')
+    return ret_df
+
+@pytest.mark.parametrize('leapyear, standardization, handle_na, years',
+                         list(itertools.product([None, 60],
+                                                [None, 'zscore', 'minmax'],
+                                                [None, 'interpolate'],
+                                                [False, [2016, 2018]])))
+def test_preprocess_matches_loop(leapyear, standardization, handle_na, years):
+    points = _points('2015-03-01', '2018-10-31')
+    # with some days missing
+    df = pd.DataFrame(points).drop(index=range(100, 400, 7)).reset_index(drop=True)
+    got = preprocess(df.copy(), years = years, leapyear = leapyear,
+                     standardization = standardization, handle_na = handle_na)
+    want = _loop_preprocess(df, years = years, leapyear = leapyear,
+                            standardization = standardization,
+                            handle_na = handle_na)
+    np.testing.assert_array_equal(got.columns, want.columns)
+    np.testing.assert_allclose(got.values, want.values, rtol=1e-12, atol=1e-12)
+
+def _fetches(client):
+    return [c[1] for c in client.calls if c[0] == 'get_data_points']
+
+def test_get_gro_data_many_keeps_the_order_of_specs():
+    points = {1: _points('2018-01-01', '2018-03-31', 1),
+              2: _points('2018-01-01', '2018-03-31', 2)}
+    client = FakeGroClient(points, {('regions', 'Many A'): 1,
+                                    ('regions', 'Many B'): 2})
+    specs = [{'region': 'Many B'}, {'region': 'Many A'}, {'region': 'Many B'}]
+    dfs = get_gro_data_many(specs, client = client, max_workers = 3)
+    for df, region in zip(dfs, [2, 1, 2]):
+        assert list(df['value']) == [p['value'] for p in points[region]]
+    # every name is looked up once
+    assert sum(c[0] == 'search_for_entity' for c in client.calls) == 2
+
+class _FlakyClient(FakeGroClient):
+    def __init__(self, points, fails, error = ConnectionError('try again')):
+        FakeGroClient.__init__(self, points)
+        self.fails = fails
+        self.error = error
+
+    def get_data_points(self, **selection):
+        if self.fails:
+            self.fails -= 1
+            raise self.error
+        return FakeGroClient.get_data_points(self, **selection)
+
+def test_get_gro_data_many_retries_failed_series():
+    points = _points('2018-01-01', '2018-01-31')
+    client = _FlakyClient(points, 2)
+    dfs = get_gro_data_many([{'region': 'Flaky'}], client = client,
+                            retries = 3, backoff = 0)
+    assert list(dfs[0]['value']) == [p['value'] for p in points]
+    with pytest.raises(ConnectionError):
+        get_gro_data_many([{'region': 'Flaky'}], client = _FlakyClient(points, 5),
+                          retries = 2, backoff = 0)
+
+def test_get_gro_data_many_retries_cut_off_responses_only():
+    points = _points('2018-01-01', '2018-01-31')
+    cut_off = json.JSONDecodeError('Expecting value', '{"data": [', 10)
+    client = _FlakyClient(points, 2, cut_off)
+    dfs = get_gro_data_many([{'region': 'Flaky'}], client = client,
+                            retries = 3, backoff = 0)
+    assert list(dfs[0]['value']) == [p['value'] for p in points]
+    # other ValueErrors are bad input, and fail at once
+    client = _FlakyClient(points, 2, ValueError('no such item'))
+    with pytest.raises(ValueError):
+        get_gro_data_many([{'region': 'Flaky'}], client = client,
+                          retries = 3, backoff = 0)
+    assert client.fails == 1
+
+def test_entity_ids_are_not_shared_between_clients():
+    a = FakeGroClient([], {('regions', 'Nanjing'): 1})
+    b = FakeGroClient([], {('regions', 'Nanjing'): 2})
+    get_gro_data(client = a, region = 'Nanjing')
+    get_gro_data(client = b, region = 'Nanjing')
+    get_gro_data(client = a, region = 'Nanjing')
+    assert _fetches(a)[-1]['region_id'] == 1
+    assert _fetches(b)[-1]['region_id'] == 2
+    assert sum(c[0] == 'search_for_entity' for c in a.calls) == 1
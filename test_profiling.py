@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the stage profiler. Run with ``python -m pytest test_profiling.py``.
+"""
+
+import threading
+import numpy as np
+import profiling
+
+def test_stages_nest_and_record_memory():
+    profiling.enable()
+    try:
+        with profiling.stage('outer'):
+            with profiling.stage('inner', items = 3):
+                x = np.ones(10**6)
+            del x
+        s = profiling.summary()
+    finally:
+        profiling.disable()
+    assert s['outer']['calls'] == 1 and s['inner']['items'] == 3
+    assert s['inner']['peak_mem'] >= 8*10**6
+    assert s['outer']['peak_mem'] >= s['inner']['peak_mem']
+    assert s['outer']['wall'] >= s['inner']['wall']
+
+def test_profiled_functions():
+    @profiling.profiled('ones', items = len)
+    def ones(n):
+        return np.ones(n)
+    ones(5)
+    profiling.enable()
+    try:
+        ones(10)
+        ones(20)
+    finally:
+        profiling.disable()
+    assert profiling.summary()['ones']['calls'] == 2
+    assert profiling.summary()['ones']['items'] == 30
+
+def test_disabled_stages_record_nothing():
+    profiling.enable()
+    profiling.disable()
+    with profiling.stage('off') as rec:
+        pass
+    assert rec == {} and profiling.summary() == {}
+
+def test_threaded_stages_leave_the_peak_alone():
+    def work():
+        with profiling.stage('worker'):
+            np.ones(10)
+    profiling.enable()
+    try:
+        with profiling.stage('main'):
+            x = np.ones(10**6)
+            del x
+            # would reset the peak of 'main' if it measured its own
+            t = threading.Thread(target = work)
+            t.start()
+            t.join()
+        s = profiling.summary()
+    finally:
+        profiling.disable()
+    assert s['worker']['calls'] == 1 and s['worker']['peak_mem'] is None
+    assert s['main']['peak_mem'] >= 8*10**6
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the result cache and of the memoized functions. Run with
+``python -m pytest test_result_cache.py``.
+"""
+
+import os
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from result_cache import ResultCache, default_cache
+from year_score_comp import get_mat
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+def test_hits_and_lru_eviction():
+    a, b, c = (np.full(1000, float(i)) for i in range(3))
+    cache = ResultCache(max_bytes = 2*len(pickle.dumps(a)) + 100)
+    cache.put('a', a)
+    cache.put('b', b)
+    # a hit makes ``a`` the most recently used, so ``b`` goes first
+    assert cache.get('a')[0] == 0.
+    cache.put('c', c)
+    assert cache.get('b') is None
+    assert cache.get('a')[0] == 0. and cache.get('c')[0] == 2.
+    assert cache.stats['hits'] == 3 and cache.stats['misses'] == 1
+    assert cache.stats['evictions'] == 1
+
+def test_results_are_copies():
+    cache = ResultCache()
+    cache.put('a', np.zeros(10))
+    cache.get('a')[:] = 1
+    assert not cache.get('a').any()
+
+def test_disk_tier(tmp_path):
+    a = np.arange(10.)
+    ResultCache(cache_dir = str(tmp_path)).put('a', a)
+    cache = ResultCache(cache_dir = str(tmp_path))
+    np.testing.assert_array_equal(cache.get('a'), a)
+    assert cache.stats['disk_hits'] == 1
+
+def test_disk_tier_is_bounded(tmp_path):
+    a, b, c = (np.full(1000, float(i)) for i in range(3))
+    # no memory tier, so every get reads the file
+    cache = ResultCache(max_bytes = 0, cache_dir = str(tmp_path),
+                        max_disk_bytes = 2*len(pickle.dumps(a)) + 100)
+    # file times are only a few ms apart at best
+    for key, value in (('a', a), ('b', b)):
+        cache.put(key, value)
+        time.sleep(0.05)
+    assert cache.get('a')[0] == 0.
+    time.sleep(0.05)
+    cache.put('c', c)
+    assert cache.get('b') is None
+    assert cache.get('a')[0] == 0. and cache.get('c')[0] == 2.
+    assert cache.stats['disk_evictions'] == 1
+    cache.clear(disk = True)
+    assert not os.listdir(str(tmp_path))
+
+def test_get_mat_is_memoized():
+    df = _frame(missing = 0.1)
+    default_cache.clear()
+    hits = default_cache.stats['hits']
+    mat, years = get_mat(df, similarity = 'L1')
+    # equal data is enough, it needn't be the same object
+    mat2, years2 = get_mat(df.copy(), similarity = 'L1')
+    assert default_cache.stats['hits'] == hits + 1
+    np.testing.assert_array_equal(mat, mat2)
+    assert years == years2
+    get_mat(df, similarity = 'Euclidean')
+    assert default_cache.stats['hits'] == hits + 1
+
+def test_results_too_big_for_the_cache_are_not_kept():
+    cache = ResultCache(max_bytes = 1000)
+    cache.put('a', np.zeros(1000))
+    assert cache.get('a') is None
+    assert cache.stats['too_big'] == 1 and cache.nbytes == 0
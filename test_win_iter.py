@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of ``smooth_windows`` against the window by window loop it replaced.
+Run with ``python -m pytest test_win_iter.py``.
+"""
+
+import itertools
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+from win_iter import WinSeries, smooth_windows
+
+def _loop_smooth(df, summary, win_len, overlap):
+    # ``smooth_windows`` as it was, one window at a time
+    rows = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for win in WinSeries(df, win_size=win_len, overlap=overlap):
+            rows.append(getattr(np, 'nan' + summary)(win, axis = 0))
+    return pd.DataFrame(rows, columns = df.columns)
+
+@pytest.mark.parametrize('summary, win_len, overlap',
+                         list(itertools.product(['mean', 'min', 'max', 'var'],
+                                                [7, 10], [0, 3])))
+def test_smooth_windows_matches_loop(summary, win_len, overlap):
+    rng = np.random.default_rng(0)
+    A = rng.normal(size=(365, 4)).cumsum(axis=0)
+    A[rng.random(A.shape) < 0.2] = np.nan
+    # a window with nothing in it
+    A[50:70, 1] = np.nan
+    df = pd.DataFrame(A, columns = [2015, 2016, 2017, 2018])
+    df.insert(0, 'day', range(1, 366))
+    got = smooth_windows(df, summary = summary, win_len = win_len,
+                         overlap = overlap)
+    want = _loop_smooth(df, summary, win_len, overlap)
+    np.testing.assert_array_equal(got.columns, want.columns)
+    np.testing.assert_allclose(got.values, want.values, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Jul 26 11:18:19 2019
+
+Authors::
+    Xing Ling, Ben Strasser, Rahim Taghikhani, Tianyu Tao, Yiqing Cai
+
+Others have the right to freely use this code in both commercial and
+non-commercial applications. However, we retain the right to use this code or
+parts of this code for any purpose.
+
+Tests of the similarity functions against the plain computations they
+speed up. Run with ``python -m pytest test_year_score_comp.py``.
+"""
+
+import os
+import itertools
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+from year_score_comp import get_sorted_years, get_mat, get_feature_mats, get_rank_stability
+from preprocessing_fns import combine_series
+
+def _frame(n_years = 12, seed = 0, missing = 0.):
+    # day x year random walks, with some days missing but never the first or
+    # the last
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(365, n_years)).cumsum(axis=0)
+    A[1:-1][rng.random((363, n_years)) < missing] = np.nan
+    df = pd.DataFrame(A, columns = list(range(2000, 2000 + n_years)))
+    df.insert(0, 'day', range(1, 366))
+    return df
+
+# every year but 2011, which ``get_sorted_years`` would otherwise compare to
+# itself
+OTHERS = list(range(2000, 2011))
+
+@pytest.mark.parametrize('similarity', ['Euclidean', 'L1', 'R2'])
+def test_sorted_years_k_matches_full_sort(similarity):
+    df = _frame(missing = 0.1)
+    full = get_sorted_years(2011, df, similarity = similarity)
+    top = get_sorted_years(2011, df, similarity = similarity, k = 4)
+    assert [y for _, y in top] == [y for _, y in full[:4]]
+    np.testing.assert_allclose([d for d, _ in top], [d for d, _ in full[:4]],
+                               rtol=1e-9)
+
+def test_feature_mats_are_weighted_sums():
+    T, R = _frame(seed = 1, missing = 0.1), _frame(seed = 2, missing = 0.1)
+    df = combine_series([T, R], ['T', 'R'])
+    mat, years, by_feature = get_feature_mats(df, weights = {'T': 2, 'R': 0.5},
+                                              smooth = (7, 0))
+    for name, f_df in (('T', T), ('R', R)):
+        f_mat, f_years = get_mat(f_df, smooth = (7, 0))
+        assert f_years == years
+        np.testing.assert_allclose(by_feature[name], f_mat, rtol=1e-9)
+    np.testing.assert_allclose(mat, 2*by_feature['T'] + 0.5*by_feature['R'],
+                               rtol=1e-9)
+
+def test_feature_mats_check_the_weights():
+    df = combine_series([_frame(seed = 1), _frame(seed = 2)], ['T', 'R'])
+    with pytest.raises(ValueError):
+        get_feature_mats(df, weights = {'T': 1, 'Rain': 1})
+    with pytest.raises(ValueError):
+        get_feature_mats(df, weights = {'T': 1})
+    mat, years, by_feature = get_feature_mats(df, weights = {'T': 1, 'R': 0})
+    np.testing.assert_allclose(mat, by_feature['T'])
+
+def test_imports_skip_plotting_and_sklearn():
+    code = ('import sys, year_score_comp, preprocessing_fns, distance_fn; '
+            'print(sorted(m for m in ("matplotlib", "sklearn", "groclient") '
+            'if m in sys.modules))')
+    out = subprocess.run([sys.executable, '-c', code], capture_output = True,
+                         text = True, check = True,
+                         cwd = os.path.dirname(os.path.abspath(__file__)))
+    assert out.stdout.strip() == '[]'
+
+def test_rank_stability_scores_match_sorted_years():
+    df = _frame(missing = 0.05)
+    ret = get_rank_stability(2011, df, n_boot = 50, block = 7)
+    want = get_sorted_years(2011, df, years = OTHERS)
+    assert list(ret.index) == [y for _, y in want]
+    np.testing.assert_allclose(ret['score'], [d for d, _ in want], rtol=1e-9)
+    assert list(ret['rank']) == list(range(1, 12))
+    assert ((ret['p_top_k'] >= 0) & (ret['p_top_k'] <= 1)).all()
+    jk = get_rank_stability(2011, df, method = 'jackknife', block = 30)
+    np.testing.assert_allclose(jk['score'], ret['score'])
+
+@pytest.mark.parametrize('handle_na', ['interpolate', 'fill'])
+def test_shifted_rank_stability_matches_sorted_years(handle_na):
+    df = _frame(missing = 0.05)
+    ret = get_rank_stability(2011, df, shift = True, handle_na = handle_na,
+                             n_boot = 10)
+    want = get_sorted_years(2011, df, years = OTHERS, shift = True,
+                            handle_na = handle_na)
+    assert list(ret.index) == [y for _, y in want]
+    np.testing.assert_allclose(ret['score'], [d for d, _ in want], rtol=1e-9)
+
+def test_rank_stability_drops_years_with_nan_edges():
+    df = _frame(missing = 0.05)
+    df.loc[0, 2003] = np.nan
+    df.loc[364, [2005, 2006]] = np.nan
+    ret = get_rank_stability(2011, df, n_boot = 20)
+    want = get_sorted_years(2011, df, years = OTHERS)
+    assert list(ret.index) == [y for _, y in want]
+    assert not {2003, 2005, 2006} & set(ret.index)
+    assert len(get_rank_stability(2011, df, dropnasim = False, n_boot = 20)) == 11
+
+def test_tiled_get_mat_always_writes_its_output(tmp_path):
+    df = _frame(missing = 0.1)
+    mat, years = get_mat(df)
+    # the same call twice, each must fill its own file
+    for name in ('a.npy', 'b.npy'):
+        out = str(tmp_path / name)
+        get_mat(df, tiled = True, out = out, memory = 20000)
+        np.testing.assert_allclose(np.load(out), mat, rtol=1e-9, atol=1e-9)
+
+def test_dropnasim_leaves_out_every_year_with_nan_edges():
+    df = _frame()
+    df.loc[0, 2003] = np.nan
+    # next to each other, so removing one while looping would skip the other
+    df.loc[364, [2005, 2006]] = np.nan
+    kept = [y for y in OTHERS if y not in (2003, 2005, 2006)]
+    mat, years = get_mat(df)
+    assert years == kept + [2011]
+    candidates = list(OTHERS)
+    for k in (None, 3):
+        ret = get_sorted_years(2011, df, years = candidates, k = k)
+        assert set(y for _, y in ret) <= set(kept) and len(ret) == (k or 8)
+    assert candidates == OTHERS
+    # the year compared to may have gaps, e.g. a season in progress
+    df.loc[300:, 2011] = np.nan
+    assert len(get_sorted_years(2011, df, years = OTHERS)) == 8
+    assert get_sorted_years(2011, df, years = [2003, 2005]) == []
+    # with smoothing the edges are those of the windows, for both
+    mat, years = get_mat(df, smooth = (7, 0))
+    ret = get_sorted_years(2011, df, years = OTHERS, smooth = (7, 0))
+    assert sorted(y for _, y in ret) == [y for y in years if y != 2011]
+
+@pytest.mark.parametrize('similarity, handle_na, dropnasim',
+                         list(itertools.product(['Euclidean', 'R2', 'DTW'],
+                                                ['interpolate', 'drop'],
+                                                [True, False])))
+def test_sorted_years_do_not_depend_on_the_order_of_years(similarity, handle_na,
+                                                           dropnasim):
+    df = _frame(missing = 0.1)
+    df.loc[:20, 2002] = np.nan
+    df.loc[340:, [2004, 2005]] = np.nan
+    df[2007] = np.nan
+    args = {'similarity': similarity, 'handle_na': handle_na,
+            'dropnasim': dropnasim}
+    full = get_sorted_years(2011, df, years = OTHERS, **args)
+    for seed in range(3):
+        years = [int(y) for y in np.random.default_rng(seed).permutation(OTHERS)]
+        for k in (None, 4):
+            ret = get_sorted_years(2011, df, years = years, k = k, **args)
+            assert [y for _, y in ret] == [y for _, y in full[:k]]
+            np.testing.assert_allclose([d for d, _ in ret],
+                                       [d for d, _ in full[:k]], rtol=1e-9)
@@ -12,6 +12,8 @@ parts of this code for any purpose.
 import numpy as np
 import pandas as pd
 import warnings
+from numpy.lib.stride_tricks import sliding_window_view
+from profiling import profiled
 
 # something I wrote for the last project. I think this functionality is built
 # in somewhere, but I was having a hard time finding exactly what I wanted.
@@ -74,38 +76,91 @@ class WinSeries:
         self.t = start_t
         return ret_A
 
-def smooth_windows(df, summary = 'mean', win_len = 7, overlap = 0):
+def _window_bounds(times, win_size = 7, overlap = 0):
+    """start and end (exclusive) row of every window ``WinSeries`` would
+    return, without walking the rows one at a time.
+
+    ``times`` must be sorted. A window starting at row ``i`` holds the rows
+    with time before ``times[i] + win_size``, and the next window starts at the
+    first row with time at least ``times[i] + win_size - overlap``. Like
+    ``WinSeries``, we stop once a window runs into the end of the series or
+    starts at the last time.
+    """
+    times = np.asarray(times, dtype=float)
+    if overlap >= win_size:
+        raise ValueError('``overlap`` must be smaller than ``win_size``')
+    n = len(times)
+    ends = np.searchsorted(times, times + win_size, side='left').tolist()
+    nexts = np.searchsorted(times, times + win_size - overlap,
+                            side='left').tolist()
+    max_time = times[-1] if n else None
+
+    starts, stops = [], []
+    i = 0
+    while n and times[i] < max_time:
+        starts.append(i)
+        stops.append(min(ends[i], n))
+        if ends[i] >= n:
+            break
+        i = nexts[i]
+    return np.array(starts, dtype=int), np.array(stops, dtype=int)
+
+@profiled('smooth', items=len)
+def smooth_windows(df, summary = 'mean', win_len = 7, overlap = 0, dtype = None):
     """returns a new timeseries consisting of windows of size ``win_len``
     overlapping by a factor of ``overlap``
     
     ``summary`` is the summary statistic used - can be mean, min, max, or var
+
+    ``dtype`` is the type of the returned values, by default float
   
-    NOTE - there is built in functionality IF you don't have to deal with NaNs...
-    NOTE - this can be optimized if needed, just let me know if its too slow!
+    NOTE - NaNs are ignored, like np.nanmean etc. on each window of
+    ``WinSeries``. Means and variances come from cumulative sums and counts,
+    and minima and maxima from a sliding window view, so all windows are
+    computed at once.
     """
-    # this iterator is quick
-    windows = WinSeries(df, win_size=win_len, overlap=overlap)
-  
-    # this part may be slow on a long timeseries
-    # we can optimize it by initializing an array of the
-    # appropriate size first and then filling out the array
-    ret_rows = []
-    
-    # hack to avoid a RuntimeWarning I keep getting (even though it doesn't
-    # seem accurate)
-    with warnings.catch_warnings():
+    if summary not in ('mean', 'min', 'max', 'var'):
+        raise ValueError('statistic ', str(summary), ' must be `mean`, `var`, `min`, or `max`')
+
+    X = np.array(df, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    starts, stops = _window_bounds(X[:,0], win_size=win_len, overlap=overlap)
+    if not len(starts):
+        return pd.DataFrame([], columns = df.columns)
+
+    valid = ~np.isnan(X)
+    # hack to avoid a RuntimeWarning for windows with only NaNs, which give NaN
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
         warnings.simplefilter("ignore")
-        for win in windows:
-            # mean ignoring nans
+        if summary in ('mean', 'var'):
+            # center the columns so the variance doesn't lose precision
+            center = np.nanmean(X, axis = 0)
+            center[np.isnan(center)] = 0
+            X0 = np.where(valid, X - center, 0)
+            zero = np.zeros((1, X.shape[1]))
+            cnt = np.concatenate([zero, np.cumsum(valid, axis = 0)])
+            tot = np.concatenate([zero, np.cumsum(X0, axis = 0)])
+            cnt = cnt[stops] - cnt[starts]
+            mean = (tot[stops] - tot[starts])/cnt
             if summary == 'mean':
-                ret_rows.append(np.nanmean(win,axis = 0))
-            elif summary == 'min':
-                ret_rows.append(np.nanmin(win,axis = 0))
-            elif summary == 'max':
-                ret_rows.append(np.nanmax(win,axis = 0))
-            elif summary == 'var':
-                ret_rows.append(np.nanvar(win,axis = 0))
+                ret = mean + center
+            else:
+                tot_sq = np.concatenate([zero, np.cumsum(X0**2, axis = 0)])
+                ret = np.maximum((tot_sq[stops] - tot_sq[starts])/cnt - mean**2, 0)
+        else:
+            # pad so every window is a full view, then hide the rows past the end
+            # of the shorter windows
+            w = int(np.max(stops - starts))
+            pad = np.full((w, X.shape[1]), np.nan)
+            views = sliding_window_view(np.concatenate([X, pad]), w, axis = 0)
+            wins = views[starts]
+            past_end = np.arange(w)[None, :] >= (stops - starts)[:, None]
+            wins = np.where(past_end[:, None, :], np.nan, wins)
+            if summary == 'min':
+                ret = np.nanmin(wins, axis = 2)
             else:
-                raise ValueError('statistic ', str(summary), ' must be `mean`, `var`, `min`, or `max`')
-    return pd.DataFrame(ret_rows,columns = df.columns)
-  
\ No newline at end of file
+                ret = np.nanmax(wins, axis = 2)
+    if dtype is not None:
+        ret = ret.astype(dtype)
+    return pd.DataFrame(ret,columns = df.columns)
@@ -12,17 +12,42 @@ parts of this code for any purpose.
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics import r2_score
-#from fastdtw import fastdtw
-#from scipy.spatial.distance import euclidean
 from preprocessing_fns import *
-from distance_fn import dist
-from plot_fns import *
+from distance_fn import (dist_mat, top_k, feature_dist_mats, condensed_row,
+                         square_mat, tiled_dist_mat, resample_weights,
+                         resampled_dists, _roll_columns, _prepare)
+from result_cache import cached
+import profiling
+from profiling import stage
 
+# plotting pulls in matplotlib and sklearn, so ``plot_fns`` is only imported
+# when one of its functions is asked for
+_PLOT_FNS = ('plot_side', 'plot_compare', 'plot_similar_yrs')
+
+def __getattr__(name):
+    if name in _PLOT_FNS:
+        import plot_fns
+        return getattr(plot_fns, name)
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+def _drop_nan_edges(df, years):
+    '''``years`` without the ones that begin or end with NaN in ``df``, as a
+    new list
+    '''
+    if not len(df) or not len(years):
+        return list(years)
+    edges = np.isnan(df[years].iloc[[0, -1]].values.astype(float))
+    return [y for y, bad in zip(years, edges.any(axis = 0)) if not bad]
+
+# tiled results go to ``out`` or ``callback``, which the cache key can't hold
+@cached(bypass=('tiled', 'out', 'callback'))
 def get_mat(df, start_day = 1, end_day = 365,
             similarity = 'Euclidean',
             smooth = False, dropnasim = True,
-            handle_na = 'interpolate', shift = False, **kwargs):
+            handle_na = 'interpolate', shift = False, max_shift = 7,
+            band = 7, dtype = float, condensed = False, min_overlap = 0,
+            tiled = False, memory = 256*2**20, threads = None, out = None,
+            callback = None, **kwargs):
     '''
     returns matrix of similarity scores by year
     
@@ -30,14 +55,34 @@ def get_mat(df, start_day = 1, end_day = 365,
         df (DataFrame) -- DataFrame of preprocessed GRO data
         start_day (int) -- (default 1) int at start of comparison period
         end_day (int) -- (default 365) int at end of comparison period
-        similarity (str) -- (default "Eucludean") similarity measurement to use
+        similarity (str) -- (default "Eucludean") similarity measurement to use,
+                            one of Euclidean, L1, Linf, R2 or DTW
         smooth (tuple of ints) -- (default (7,0)) smoothing period, overlap
         dropnasim (boolean) -- (default True) if True, ignores years which
                                 begin or end with NaN
         shift (boolean) -- (default False) if true, considers shifted series
+        max_shift (int) -- (default 7) largest shift in days when ``shift`` is True
+        band (int) -- (default 7) Sakoe-Chiba band in days for DTW similarity
+        dtype -- (default float) type of the data and scores, ``np.float32``
+                 halves the memory used
+        condensed (boolean) -- (default False) if True, only return the upper
+                               triangle of the matrix as a flat array, see
+                               ``condensed_row`` and ``square_mat``. Not for R2
+        min_overlap (int) -- (default 0) years observed together on fewer
+                             days than this get an infinite score, see
+                             ``overlap_counts``. Not for ``tiled``
+        tiled (boolean) -- (default False) if True, compute the matrix tile by
+                           tile with ``tiled_dist_mat`` and send it to ``out``
+                           and/or ``callback`` instead of holding it in memory
+        memory (int) -- (default 256MB) bytes of working memory for ``tiled``
+        threads (int) -- (default number of CPUs) threads for ``tiled``
+        out (str or ndarray) -- (default None) .npy file to memory map, or
+                                array, the tiled matrix is written to
+        callback (function) -- (default None) called with each tile as
+                               ``callback(i0, j0, tile)``, see ``tiled_dist_mat``
         
     Outputs::
-        similarity matrix as an ndarray, list of years
+        similarity matrix as an ndarray (``out`` if ``tiled``), list of years
     
     '''
     if not isinstance(similarity, str):
@@ -60,30 +105,42 @@ def get_mat(df, start_day = 1, end_day = 365,
         # slight hack here since our window iterator only understands numerical
         # data and it assumes the first column represents times
         df = smooth_windows(df.iloc[:,yr_ind-1:],
-                            win_len = smooth[0], overlap = smooth[1])
+                            win_len = smooth[0], overlap = smooth[1],
+                            dtype = dtype)
         
     # if a year begins or ends with a string of NaN, our distance function
     # will return NaN. This function filters that
     years = list(df.columns[yr_ind:])
     if dropnasim:
-        for year in years:
-            if np.isnan(df[year].iloc[0]) or np.isnan(df[year].iloc[-1]):
-                years.remove(year)
+        years = _drop_nan_edges(df, years)
 
-    num_years = len(years)
-    sim_mat = np.zeros((num_years, num_years))
-    for i in range(num_years):
-        for j in range(num_years):
-            sim_mat[i,j] = dist(df[years[i]], df[years[j]],
-                                metric=similarity, handle_na=handle_na, shift=shift)
+    if tiled:
+        if condensed:
+            raise ValueError('``tiled`` writes the full matrix, it cannot be ``condensed``')
+        if min_overlap:
+            raise ValueError('``min_overlap`` is not supported with ``tiled``')
+        sim_mat = tiled_dist_mat(df[years].values, out=out, callback=callback,
+                                 memory=memory, threads=threads,
+                                 metric=similarity, handle_na=handle_na,
+                                 shift=shift, max_shift=max_shift, band=band,
+                                 dtype=dtype)
+        return sim_mat, years
+
+    # all pairs at once, missing data is handled once per year
+    sim_mat = dist_mat(df[years].values,
+                       metric=similarity, handle_na=handle_na, shift=shift,
+                       max_shift=max_shift, band=band, dtype=dtype,
+                       condensed=condensed, min_overlap=min_overlap)
 
     return sim_mat, years
 
+@cached
 def get_sorted_years(year, df, years = None,
                      start_day = 1, end_day = 365,
                      similarity = 'Euclidean',
                      smooth = False, dropnasim = True,
-                     handle_na = 'interpolate', shift = False):
+                     handle_na = 'interpolate', shift = False, max_shift = 7,
+                     band = 7, k = None, dtype = float):
     '''get a list of years and distances similar to a given year
     Inputs::
         year (int) -- year to compare other years to
@@ -91,11 +148,18 @@ def get_sorted_years(year, df, years = None,
         years (list of ints) -- (default all years in df) years to compare year to
         start_day (int) -- (default 1) int at start of comparison period
         end_day (int) -- (default 365) int at end of comparison period
-        similarity (str) -- (default "Eucludean") similarity measurement to use
+        similarity (str) -- (default "Eucludean") similarity measurement to use,
+                            one of Euclidean, L1, Linf, R2 or DTW
         smooth (tuple of ints) -- (default None) smoothing period, overlap
         dropnasim (boolean) -- (default True) if True, ignores years which
                                 begin or end with NaN
         shift (boolean) -- (default False) if true, considers shifted series
+        max_shift (int) -- (default 7) largest shift in days when ``shift`` is True
+        band (int) -- (default 7) Sakoe-Chiba band in days for DTW similarity
+        k (int) -- (default None) if given, only return the ``k`` most similar
+                   years. Same as the first ``k`` of the full list, but
+                   most years are never fully compared (see ``top_k``)
+        dtype -- (default float) type of the data and scores
         
     Outputs::
         a list of tuples of the form (similarity_to_given_year, year)
@@ -118,23 +182,210 @@ def get_sorted_years(year, df, years = None,
         # slight hack here since our window iterator only understands numerical
         # data and it assumes the first column represents times
         df = smooth_windows(df.iloc[:,yr_ind-1:],
-                            win_len = smooth[0], overlap = smooth[1])
+                            win_len = smooth[0], overlap = smooth[1],
+                            dtype = dtype)
     if not years:
         years = list(df.columns[yr_ind:])
         
+    # the same candidates as ``get_mat`` would keep. The year compared to
+    # may have gaps at either end, e.g. a season still in progress
     if dropnasim:
-        for y in years:
-            if np.isnan(df[year].iloc[0]) or np.isnan(df[year].iloc[-1]):
-                years.remove(year)
-    dists = []    
-    
-    for y in years:
-        dists.append((dist(df[year], df[y],
-                          metric=similarity, handle_na=handle_na, shift=shift),y))
-    dists = sorted(dists)
+        years = _drop_nan_edges(df, years)
+        if not years:
+            return []
+    if k is not None:
+        inds, d = top_k(df[year].values, df[years].values, k=k,
+                        metric=similarity, handle_na=handle_na, shift=shift,
+                        max_shift=max_shift, band=band)
+        return sorted(zip(d, [years[i] for i in inds]))[:k]
+
+    # distances from ``year`` to all candidates in one batch
+    d = dist_mat(df[[year]].values, df[years].values,
+                 metric=similarity, handle_na=handle_na, shift=shift,
+                 max_shift=max_shift, band=band, dtype=dtype)[0]
+    # years that can't be compared go last, as they do in ``top_k``, since
+    # sorting NaNs would depend on the order of ``years``
+    d = np.where(np.isnan(d), np.inf, d)
+    dists = sorted(zip(d, years))
     
     return dists
 
+@cached
+def get_rank_stability(year, df, years = None,
+                       start_day = 1, end_day = 365,
+                       similarity = 'Euclidean',
+                       smooth = False, dropnasim = True,
+                       handle_na = 'interpolate',
+                       shift = False, max_shift = 7, k = 5,
+                       method = 'bootstrap', n_boot = 200, block = 1, seed = 0):
+    '''how stable the ranking of years similar to a given year is, when the
+    days (or windows, if ``smooth``) compared are resampled
+    
+    Inputs::
+        year (int) -- year to compare other years to
+        df (DataFrame) -- DataFrame of preprocessed GRO data
+        years (list of ints) -- (default all other years in df) years to compare year to
+        start_day (int) -- (default 1) int at start of comparison period
+        end_day (int) -- (default 365) int at end of comparison period
+        similarity (str) -- (default "Eucludean") similarity measurement to use,
+                            one of Euclidean, L1, Linf or R2
+        smooth (tuple of ints) -- (default False) smoothing period, overlap
+        dropnasim (boolean) -- (default True) if True, ignores years which
+                                begin or end with NaN, as ``get_sorted_years``
+        shift (boolean) -- (default False) if true, every year keeps the shift
+                           that is best on all the days
+        max_shift (int) -- (default 7) largest shift in days when ``shift`` is True
+        k (int) -- (default 5) size of the top-k for the inclusion probabilities
+        method (str) -- (default "bootstrap") ``bootstrap`` or ``jackknife``,
+                        see ``resample_weights``
+        n_boot (int) -- (default 200) number of bootstrap replicates
+        block (int) -- (default 1) days (or windows) resampled together
+        seed (int) -- (default 0) random seed
+        
+    Outputs::
+        DataFrame indexed by year, most similar first, with the score and
+        rank on all the days, the mean, standard deviation and 5th/95th
+        percentiles of the rank over the replicates, the probability of
+        keeping the same rank (``p_same_rank``) and of being in the top
+        ``k`` (``p_top_k``)
+
+    NOTE: all replicates are scored at once by ``resampled_dists``, one matrix
+    product for Euclidean, L1 and R2.
+    '''
+    if smooth and not (isinstance(smooth,tuple) or isinstance(smooth,list)):
+        raise ValueError('``trans`` input must be a tuple or list of integers')
+
+    # Sometimes the first column contains feature names
+    if df.columns[0] == 'feature':
+        yr_ind = 2
+    else:
+        yr_ind = 1
+
+    df = df[df['day'].between(start_day, end_day)]
+    if smooth:
+        df = smooth_windows(df.iloc[:,yr_ind-1:],
+                            win_len = smooth[0], overlap = smooth[1])
+        yr_ind = 1
+    if not years:
+        years = list(df.columns[yr_ind:])
+    years = [y for y in years if y != year]
+    if dropnasim:
+        years = _drop_nan_edges(df, years)
+
+    a = df[year].values
+    B = df[years].values
+    if shift:
+        # roll the series with their gaps already handled, rolling the gaps
+        # around first would change how they are interpolated
+        a = _prepare(a, handle_na)[:, 0]
+        B = _prepare(B, handle_na)
+        _, lags = dist_mat(a, B, metric=similarity, handle_na=handle_na,
+                           shift=True, max_shift=max_shift, return_lag=True)
+        B = _roll_columns(B, lags[0])
+
+    ones = np.ones((1, len(a)))
+    W = np.concatenate([ones, resample_weights(len(a), n_boot, method, block, seed)])
+    D = resampled_dists(a, B, W, metric=similarity, handle_na=handle_na)
+    D = np.where(np.isnan(D), np.inf, D)
+
+    # rank of every year in every replicate, 1 is the most similar
+    ranks = np.empty(D.shape, dtype=int)
+    order = np.argsort(D, axis=1, kind='stable')
+    np.put_along_axis(ranks, order, np.arange(1, D.shape[1] + 1)[None, :], axis=1)
+    rank, boot = ranks[0], ranks[1:]
+
+    ret = pd.DataFrame({'score': D[0], 'rank': rank,
+                        'mean_rank': boot.mean(axis=0),
+                        'rank_std': boot.std(axis=0),
+                        'rank_p05': np.percentile(boot, 5, axis=0),
+                        'rank_p95': np.percentile(boot, 95, axis=0),
+                        'p_same_rank': (boot == rank).mean(axis=0),
+                        'p_top_k': (boot <= k).mean(axis=0)},
+                       index=pd.Index(years, name='year'))
+    return ret.sort_values('rank')
+
+@cached
+def get_feature_mats(df, weights = None, start_day = 1, end_day = 365,
+                     similarity = 'Euclidean',
+                     smooth = False, dropnasim = True,
+                     handle_na = 'interpolate', shift = False, max_shift = 7,
+                     band = 7, dtype = float, **kwargs):
+    '''
+    returns weighted similarity scores by year over several features, along
+    with the scores of each feature
+    
+    Inputs::
+        df (DataFrame) -- DataFrame of combined GRO data (``combine_series``)
+        weights (dict) -- (default all 1) weight of each feature, for every
+                          feature of df (0 leaves one out)
+        start_day (int) -- (default 1) int at start of comparison period
+        end_day (int) -- (default 365) int at end of comparison period
+        similarity (str) -- (default "Eucludean") similarity measurement to use,
+                            one of Euclidean, L1, Linf, R2 or DTW
+        smooth (tuple of ints) -- (default False) smoothing period, overlap
+        dropnasim (boolean) -- (default True) if True, ignores years which
+                                begin or end with NaN in any feature
+        shift (boolean) -- (default False) if true, considers shifted series
+        max_shift (int) -- (default 7) largest shift in days when ``shift`` is True
+        band (int) -- (default 7) Sakoe-Chiba band in days for DTW similarity
+        dtype -- (default float) type of the data and scores
+        
+    Outputs::
+        weighted sum of the feature similarity matrices as an ndarray,
+        list of years, dict of the similarity matrix of each feature
+
+    NOTE: unlike passing a combined frame to ``get_mat``, every feature is
+    smoothed and compared on its own, so windows and missing data never
+    cross from one feature into the next.
+    '''
+    if not isinstance(similarity, str):
+        raise ValueError('``similarity`` input must be a string')
+
+    if smooth and not (isinstance(smooth,tuple) or isinstance(smooth,list)):
+        raise ValueError('``trans`` input must be a tuple or list of integers')
+
+    if df.columns[0] != 'feature':
+        raise ValueError('``df`` must have a feature column, see ``combine_series``')
+
+    features = list(pd.unique(df['feature']))
+    if weights is None:
+        weights = {f: 1 for f in features}
+    # a misspelt feature would otherwise silently get no weight
+    unknown = set(weights) - set(features)
+    missing = [f for f in features if f not in weights]
+    if unknown or missing:
+        raise ValueError('``weights`` must give a weight for every feature of ``df``, '
+                         'unknown: ' + str(sorted(unknown, key=str)) +
+                         ', missing: ' + str(missing))
+    years = list(df.columns[2:])
+
+    # features x days x years
+    frames = []
+    for f in features:
+        f_df = df[df['feature'] == f].iloc[:,1:]
+        f_df = f_df[f_df['day'].between(start_day, end_day)]
+        if smooth:
+            f_df = smooth_windows(f_df, win_len = smooth[0], overlap = smooth[1],
+                                  dtype = dtype)
+        frames.append(f_df[years].values)
+    if len(set(A.shape[0] for A in frames)) > 1:
+        raise ValueError('every feature must cover the same days')
+    X = np.stack(frames)
+
+    if dropnasim:
+        keep = ~np.any(np.isnan(X[:, 0, :]) | np.isnan(X[:, -1, :]), axis=0)
+        X = X[:, :, keep]
+        years = [y for y, k in zip(years, keep) if k]
+
+    D = feature_dist_mats(X, metric=similarity, handle_na=handle_na,
+                          shift=shift, max_shift=max_shift, band=band,
+                          dtype=dtype)
+    by_feature = {f: D[i] for i, f in enumerate(features)}
+    sim_mat = np.tensordot(np.array([weights[f] for f in features],
+                                    dtype=D.dtype), D, axes=1)
+
+    return sim_mat, years, by_feature
+
 def _compute_from_input():
     '''helper function to compute distances from user input
     '''
@@ -150,9 +401,17 @@ def _compute_from_input():
     parser.add_argument('--source', help='source of data')
     parser.add_argument('--frequency', type=int, default=1,
                         help='frequency of observations')
+    parser.add_argument('--cache', type=str,
+                        help='directory to cache GRO data in')
+    parser.add_argument('--cache_ttl', type=int, default=86400,
+                        help='seconds cached data is used before asking GRO for newer points')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use data from ``--cache``, without the GRO API')
     # distance arguments
     parser.add_argument('--similarity', default='Euclidean', 
                         help='similarity measurement to use')
+    parser.add_argument('--band', type=int, default=7,
+                        help='Sakoe-Chiba band in days for DTW similarity')
     parser.add_argument('--year', type=int,
                         help='year to compare other years to')
     parser.add_argument('--years', type=int, nargs='+',
@@ -169,15 +428,26 @@ def _compute_from_input():
                         help='what to do when smilarities are NaN (typically occurs with incomplete data for the start or end of a year)')
     parser.add_argument('--handle_na', default='interpolate',
                         help='how to deal with missing data')
+    parser.add_argument('--dtype', default='float64',
+                        help='``float32`` to halve the memory used')
+    parser.add_argument('--condensed', action='store_true',
+                        help='only keep the upper triangle of the similarity matrix')
+    parser.add_argument('--min_overlap', type=int, default=0,
+                        help='fewest days two years must both be observed on to be compared')
     parser.add_argument('--make_plot', type=str,
                         help='``tseries`` to plot timeseries, ``years`` to plot years' )
     parser.add_argument('--verb', type=str, default='v',
                         help='``v`` for updates, ``n`` for no updates ')
+    parser.add_argument('--profile', type=str,
+                        help='json file to write time and memory used by each stage to')
     
     args = parser.parse_args()
     
     D = vars(args)
     
+    if D['profile']:
+        profiling.enable()
+
     # make sure the years includes year if it exists
     if D['year'] and D['years']:
         if D['year'] not in D['years']:
@@ -189,7 +459,7 @@ def _compute_from_input():
     
     if D['verb'] == 'v': 
         print('preprocessing data')
-    gro_data = preprocess(gro_data, handle_na=D['handle_na'])
+    gro_data = preprocess(gro_data, handle_na=D['handle_na'], dtype=D['dtype'])
     if D['verb'] == 'v': 
         print('computing '+ str(D['similarity']) + ' similarities \n')
 
@@ -207,30 +477,38 @@ def _compute_from_input():
         # not sure why we need the double index here, but I was having issues
         # doing this with a single slice
         inds = [yrs.index(yr) for yr in D['years']]
+        if D['condensed']:
+            mat = square_mat(mat)
         mat = mat[inds,:][:,inds]
         yrs = sorted(D['years'])
+        D['condensed'] = False
     
-    # later, we'll only compute what we need using Rahim's function
-    if D['year']:
-        dists = []
-        if D['year'] not in yrs:
-            raise ValueError('year ' + str(D['year'])+ ' not in data series')
+    with stage('output', items=len(yrs)):
+        # later, we'll only compute what we need using Rahim's function
+        if D['year']:
+            dists = []
+            if D['year'] not in yrs:
+                raise ValueError('year ' + str(D['year'])+ ' not in data series')
         
-        for i in range(len(yrs)):
-            if yrs[i] != D['year']:
-                dists.append((mat[yrs.index(D['year']), i], yrs[i]))
+            if D['condensed']:
+                row = condensed_row(mat, yrs.index(D['year']))
+            else:
+                row = mat[yrs.index(D['year'])]
+            for i in range(len(yrs)):
+                if yrs[i] != D['year']:
+                    dists.append((row[i], yrs[i]))
         
-        dists = sorted(dists)
+            dists = sorted(dists)
         
-        print('similarity scores to year: ' + str(D['year']))
-        for d in dists:
-            print(str(d[1]) + ':   ' + str(d[0]))
+            print('similarity scores to year: ' + str(D['year']))
+            for d in dists:
+                print(str(d[1]) + ':   ' + str(d[0]))
     
-    else:
-        print(str(D['similarity']) + ' similarity matrix:')
-        print(mat)
-        print('\nyears:')
-        print(yrs)
+        else:
+            print(str(D['similarity']) + ' similarity matrix:')
+            print(mat)
+            print('\nyears:')
+            print(yrs)
         
     if D['make_plot']:
         
@@ -238,6 +516,9 @@ def _compute_from_input():
             print("will plot timeseries " + str(yrs))
         if D['make_plot'] == '2d':
             print("will plot 2d " + str(yrs))
+
+    if D['profile']:
+        profiling.write_report(D['profile'])
     
 def test():
     # sample code - end to end script does not currently handle multiple 
@@ -283,11 +564,47 @@ def test():
             print(year[1], year[0])
         print()
     
+def _batch_from_input(argv):
+    '''helper function to run a manifest of jobs from user input, e.g.
+    ``python year_score_comp.py batch jobs.yaml --out results``
+    '''
+    # batch_fns imports this module, so only import it here
+    from batch_fns import run_manifest, has_parquet
+    parser = argparse.ArgumentParser(prog='year_score_comp.py batch',
+                                     description='Run a manifest of similarity jobs')
+    parser.add_argument('manifest', help='JSON or YAML file of jobs')
+    parser.add_argument('--out', required=True,
+                        help='directory to write matrices and rankings to')
+    parser.add_argument('--format', choices=['parquet', 'csv'],
+                        help='``parquet`` (needs pyarrow) or ``csv``, by '
+                             'default parquet if pyarrow is installed')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes')
+    parser.add_argument('--gro_token', help='token for GRO API')
+    parser.add_argument('--host', default='api.gro-intelligence.com',
+                        help='GROAPI host')
+    parser.add_argument('--cache', type=str,
+                        help='directory to cache GRO data in')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use data from ``--cache``, without the GRO API')
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = 'parquet' if has_parquet() else 'csv'
+
+    matrices, rankings = run_manifest(args.manifest, out=args.out,
+                                      gro_token=args.gro_token, host=args.host,
+                                      processes=args.processes, fmt=args.format,
+                                      cache=args.cache, offline=args.offline)
+    print('wrote ' + str(len(matrices)) + ' scores and ' + str(len(rankings)) +
+          ' rankings to ' + args.out)
+
 if __name__=='__main__':
     import sys
+    import argparse
     # check if we got system arguments
-    if len(sys.argv) > 1:
-        import argparse
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        _batch_from_input(sys.argv[2:])
+    elif len(sys.argv) > 1:
         _compute_from_input()
     # otherwise, run our test script
     else: